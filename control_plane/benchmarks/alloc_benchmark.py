@@ -0,0 +1,56 @@
+# -*- coding:UTF-8 -*-
+"""
+Churn the memory allocator of a CMU-Group with random task adds and deletes.
+Usage: python benchmarks/alloc_benchmark.py [-n 10000] [-c 3] [-s 65536]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flymonlib.cmu_group import CMU_Group, MAX_DIV
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_ops", dest="num_ops", type=int, default=10000, help="e.g., 10000")
+    parser.add_argument("-c", "--cmu_num", dest="cmu_num", type=int, default=3, help="e.g., 3")
+    parser.add_argument("-s", "--cmu_size", dest="cmu_size", type=int, default=65536, help="e.g., 65536")
+    args = parser.parse_args()
+    random.seed(0)
+    cmug = CMU_Group(1, 1, args.cmu_num, args.cmu_size, 0, {"hdr.ipv4.src_addr": 32}, {})
+    # Blocks are at least one bucket, even if the CMU is smaller than MAX_DIV buckets.
+    mem_sizes = [int(args.cmu_size / 2**i) for i in range(int.bit_length(min(MAX_DIV, args.cmu_size)))]
+    running = []
+    adds = 0
+    rejects = 0
+    deletes = 0
+    start = time.time()
+    for task_id in range(1, args.num_ops + 1):
+        if len(running) != 0 and random.random() < 0.5:
+            victim = running.pop(random.randrange(len(running)))
+            cmug.release_memory(victim, None)
+            deletes += 1
+            continue
+        cmu_id = random.randint(1, args.cmu_num)
+        if cmug.allocate_memory(cmu_id, task_id, random.choice(mem_sizes)) is None:
+            rejects += 1
+        else:
+            running.append(task_id)
+            adds += 1
+    elapsed = time.time() - start
+    for task_id in running:
+        cmug.release_memory(task_id, None)
+    print(f"{args.num_ops} operations: {adds} adds, {rejects} rejects, {deletes} deletes in {elapsed:.3f}s "
+          f"({elapsed / args.num_ops * 1e6:.1f} us/op).")
+    for cmu_id in range(1, args.cmu_num + 1):
+        if cmug.allocate_memory(cmu_id, 0, args.cmu_size) is None:
+            print(f"[Failed] CMU-{cmu_id} is not fully recycled.")
+            return
+    print("All memory is recycled.")
+
+
+if __name__ == '__main__':
+    main()
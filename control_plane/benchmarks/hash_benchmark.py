@@ -0,0 +1,45 @@
+# -*- coding:UTF-8 -*-
+"""
+Compare the vectorized crc engine (Hasher.compute_batch) against hashing key by key with crcmod (Hasher.compute).
+Usage: python benchmarks/hash_benchmark.py [-n 100000] [-l 13]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flymonlib.hash import HASHES_16, HASHES_32
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_keys", dest="num_keys", type=int, default=100000, help="e.g., 100000")
+    parser.add_argument("-l", "--key_len", dest="key_len", type=int, default=13, help="bytes of a key, e.g., 13 (5-tuple)")
+    args = parser.parse_args()
+    keys = np.random.default_rng(0).integers(0, 256, (args.num_keys, args.key_len)).astype(np.uint8)
+    key_bytes = [row.tobytes() for row in keys]
+    total_single = 0.0
+    total_batch = 0.0
+    for idx, hasher in enumerate(HASHES_16 + HASHES_32):
+        phy_bitw = 16 if idx < len(HASHES_16) else 32
+        start = time.time()
+        expected = [hasher.compute(phy_bitw, key) for key in key_bytes]
+        single = time.time() - start
+        start = time.time()
+        result = hasher.compute_batch(phy_bitw, keys)
+        batch = time.time() - start
+        if not np.array_equal(result, np.array(expected, dtype=np.int64)):
+            print(f"Mismatch of hasher {str(hasher)}")
+            return
+        total_single += single
+        total_batch += batch
+    print(f"{args.num_keys} keys x {len(HASHES_16) + len(HASHES_32)} hashers, {args.key_len} bytes for each key.")
+    print(f"crcmod per key : {total_single:.3f}s")
+    print(f"compute_batch  : {total_batch:.3f}s")
+    print(f"speedup        : {total_single / total_batch:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
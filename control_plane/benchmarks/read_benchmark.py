@@ -0,0 +1,57 @@
+# -*- coding:UTF-8 -*-
+"""
+Time a full poll of the CMU-Groups (DataCollector.read_group, each register by read_all), and a range read
+of half a register (DataCollector.read with keys, below WHOLE_READ_RATIO) for comparison.
+Runs against the switch (bfrt_grpc on localhost:50052) or, with --sim, against the offline emulator.
+Usage: python benchmarks/read_benchmark.py [-c cmu_groups.json] [-r 10] [--sim]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from data_collector import DataCollector
+from flymonlib.flymon_runtime_sim import FlyMonRuntime_Sim
+
+
+def make_runtime(cmug_configs, sim):
+    if sim:
+        return FlyMonRuntime_Sim(cmug_configs)
+    import bfrt_grpc.client as gc
+    from flymonlib.flymon_runtime import FlyMonRuntime_BfRt
+    interface = gc.ClientInterface('localhost:50052', client_id=0, device_id=0, notifications=None, perform_subscribe=True)
+    interface.bind_pipeline_config(None)
+    target = gc.Target(device_id=0, pipe_id=0xffff)
+    return FlyMonRuntime_BfRt(target, interface.bfrt_info_get(), cmug_configs, interface)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", dest="config", type=str, default="cmu_groups.json", help="e.g., cmu_groups.json")
+    parser.add_argument("-r", "--rounds", dest="rounds", type=int, default=10, help="e.g., 10")
+    parser.add_argument("--sim", dest="sim", action="store_true", help="read the offline emulator instead of a switch")
+    args = parser.parse_args()
+    cmug_configs = json.load(open(args.config, 'r'))
+    runtime = make_runtime(cmug_configs, args.sim)
+    data_collector = DataCollector(runtime, cmug_configs)
+    buckets = sum(cmug["cmu_num"] * cmug["cmu_size"] for cmug in cmug_configs)
+    start = time.time()
+    for _ in range(args.rounds):
+        for cmug in cmug_configs:
+            data_collector.read_group(cmug["id"])
+    poll = (time.time() - start) / args.rounds
+    print(f"Full poll of {len(cmug_configs)} CMU-Group(s), {buckets} buckets: {poll*1000:.1f} ms "
+          f"({poll / buckets * 1e6:.2f} us/bucket).")
+    cmug = cmug_configs[0]
+    half = cmug["cmu_size"] // 2 - 1
+    start = time.time()
+    for _ in range(args.rounds):
+        runtime.read(cmug["id"], cmug["type"], 1, 0, half, cmug["cmu_size"])
+    ranged = (time.time() - start) / args.rounds
+    print(f"Range read of {half} buckets with keys: {ranged*1000:.1f} ms ({ranged / half * 1e6:.2f} us/bucket).")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,29 @@ import traceback
 import json
 import cmd
 import argparse
+import itertools
 from scapy.all import Ether, IP, UDP, sendp
 import ipaddress
 import prettytable as pt
 
-import bfrt_grpc.client as gc
+try:
+    import bfrt_grpc.client as gc
+except ImportError:
+    # Only the offline mode (--sim) is available without bfrt_grpc.
+    gc = None
 from task_manager import TaskManager
 from resource_manager import ResourceManager
 from data_collector import DataCollector
+from defragmenter import Defragmenter, DEFRAG_INTERVAL
+from journal import Journal
+from counter_extender import CounterExtender, LINE_RATE
+from snapshot_store import SnapshotStore
+from topk_tracker import TopKTracker, TOPK
 from flymonlib.flymon_runtime import FlyMonRuntime_BfRt
+from flymonlib.flymon_runtime_sim import FlyMonRuntime_Sim
 from flymonlib.utils import loadJsonToDict
+from flymonlib.cmu_group import MemoryType
+from flymonlib.flow_attribute import AttributeType
 
 logger = logging.getLogger('FlyMon')
 if not len(logger.handlers):
@@ -58,25 +71,68 @@ class FlyMonController(cmd.Cmd):
 ----------------------------------------------------
     An on-the-fly network measurement system.       
     **NOTE**: FlyMon's controller will clear all previous data plane 
-              tasks/datas when setup.
+              tasks/datas when setup, unless they are restored from a journal.
     """
     prompt = 'flymon> '
 
-    def __init__(self, config_file = 'cmu_groups.json'):
+    def __init__(self, config_file = 'cmu_groups.json', sim = False, journal_file = None, store_path = None):
         cmd.Cmd.__init__(self)
         try:
             self.cmug_configs = json.load(open(config_file, 'r'))
             self.runtime = None
-            self.grpc_setup(0, 'flymon')
-            self.task_manager = TaskManager(self.runtime, self.cmug_configs)
-            self.resource_manager = ResourceManager(self.runtime, self.cmug_configs)
+            self.sim = sim
+            if sim:
+                # Offline mode, the CMU-Groups are emulated in process.
+                self.runtime = FlyMonRuntime_Sim(self.cmug_configs)
+            else:
+                self.grpc_setup(0, 'flymon')
+            self.journal = None
+            restored = False
+            if journal_file is not None:
+                self.journal = Journal(journal_file, self.cmug_configs)
+                if self.journal.exists():
+                    # Keep the rules and counters in the data plane, they are reconciled with the journal.
+                    self.task_manager = TaskManager(self.runtime, self.cmug_configs)
+                    self.resource_manager = ResourceManager(self.runtime, self.cmug_configs, clear=False)
+                    restored = self.journal.restore(self.task_manager, self.resource_manager)
+            if not restored:
+                self.task_manager = TaskManager(self.runtime, self.cmug_configs)
+                self.resource_manager = ResourceManager(self.runtime, self.cmug_configs)
             self.data_collector = DataCollector(self.runtime, self.cmug_configs)
+            self.defragmenter = Defragmenter(self.resource_manager, self.task_manager, self.data_collector, self.journal)
+            # Polls of the counters are exclusive with the commands and the moves of the defragmentation.
+            self.counter_extender = CounterExtender(self.task_manager, self.data_collector, self.defragmenter.lock)
+            # History of the epochs collected by read_task -e.
+            self.snapshot_store = SnapshotStore(store_path)
+            self.topk_trackers = {
+                # key : task id
+                # val : TopKTracker of the task
+            }
+            self.topk_candidates = {
+                # key : (task id, ground truth file)
+                # val : (key strings, key bytes) of the candidates
+            }
+            self.save_journal()
         except Exception as e:
             print(traceback.format_exc())
             print(f"{e} when loading configure file.")
             exit(1)
 
 
+    def precmd(self, line):
+        # Commands are exclusive with the background defragmentation.
+        self.defragmenter.lock.acquire()
+        return line
+
+    def postcmd(self, stop, line):
+        self.save_journal()
+        self.defragmenter.lock.release()
+        return stop
+
+    def save_journal(self):
+        if self.journal is not None:
+            self.journal.save(self.task_manager, self.resource_manager)
+
     def do_show_cmug(self, arg):
         """
         Show the status of a CMU-Group.
@@ -153,11 +209,29 @@ class FlyMonController(cmd.Cmd):
                 print(parser.error_message)
                 return
             task_instance = self.task_manager.register_task(args.filter, args.key, args.attribute, args.mem_size)
+            # The id can be reused from a deleted task (see TaskManager.register_task), forget what was kept for it.
+            self.snapshot_store.drop(task_instance.id)
+            self.topk_trackers.pop(task_instance.id, None)
+            for candidates_key in [key for key in self.topk_candidates if key[0] == task_instance.id]:
+                self.topk_candidates.pop(candidates_key)
+            shared_id = self.task_manager.find_identical(task_instance)
+            if shared_id is not None and not self.counter_extender.is_tracked(shared_id):
+                # An identical task is running, its rules and memory are shared.
+                # The counters are shared as well: the task reads what was counted since the other task was
+                # installed, and neither task can be reset (or drained by extend_task) while both are running.
+                # A tracked task is drained in the background, so it is not shared.
+                self.task_manager.share_task(task_instance.id, shared_id)
+                if not args.quiet:
+                    self.task_manager.show_task(task_instance.id)
+                    print(f"[Success] Allocate TaskID: {task_instance.id} (shared with task {shared_id}, "
+                          f"counting since task {shared_id} was installed) \n")
+                return
             if not args.quiet:
                 print("Required resources:")
                 for re in task_instance.resource_list():
                     print(str(re))
-            locations = self.resource_manager.allocate_resources(task_instance.id, task_instance.resource_list())
+            locations = self.resource_manager.allocate_resources(task_instance.id, task_instance.resource_list(),
+                                                                 excluded_cmus=self.task_manager.filter_conflicts(task_instance))
             if locations is not None:
                 task_instance.locations = locations
                 re = self.task_manager.install_task(task_instance.id)
@@ -179,28 +253,70 @@ class FlyMonController(cmd.Cmd):
         """
         Read the data of a task.
         Args list:
-            "-t" "--task_id" the ID of a task, e.g., 1
+            "-t" "--task_id" the ID of one or more tasks, e.g., 1 or 1 2 3
+            "-e" "--epoch" also reset the memory, closing the current measurement epoch of the tasks (kept in the history)
+            "-x" "--extended" read the 64-bit counters of the tasks tracked by extend_task
+            "-p" "--pipes" read every pipe and merge the data (the first pipe only by default)
         Return:
-            The data of the input task
+            The data of the input tasks
         Exception:
             Parse error?
         """
         parser = FlyMonArgumentParser()
-        parser.add_argument("-t", "--task_id", dest="task_id", type=int, required=True, help="e.g., 1")
+        parser.add_argument("-t", "--task_id", dest="task_id", type=int, nargs='+', required=True, help="e.g., 1 or 1 2 3")
+        parser.add_argument("-e", "--epoch", action="store_true", required=False, help="read and reset the memory")
+        parser.add_argument("-x", "--extended", action="store_true", required=False, help="read the 64-bit counters")
+        parser.add_argument("-p", "--pipes", action="store_true", required=False, help="merge the data of every pipe")
         try:
             args = parser.parse_args(arg.split())
             if parser.error_message or args is None:
                 print(parser.error_message)
                 return          
-            task_instance = self.task_manager.get_instance(args.task_id)
-            if task_instance is None:
-                print(f"Invalid task id {args.task_id}")
+            task_instances = []
+            for task_id in args.task_id:
+                task_instance = self.task_manager.get_instance(task_id)
+                if task_instance is None:
+                    print(f"Invalid task id {task_id}")
+                    return
+                task_instances.append(task_instance)
+            if args.extended:
+                for task_instance in task_instances:
+                    counters = self.counter_extender.read(task_instance.id)
+                    if counters is None:
+                        print(f"Task {task_instance.id} is not tracked by extend_task.")
+                        continue
+                    print(f"Read 64-bit counters for task: {task_instance.id}, saturated buckets: {self.counter_extender.saturated(task_instance.id)}")
+                    for row in counters:
+                        print(row)
+                    print("")
                 return
-            data = self.data_collector.read_task(task_instance)
-            print(f"Read all data for task: {task_instance.id}")
-            for row in data:
-                print(row)
-            print("")
+            if args.pipes:
+                for task_instance in task_instances:
+                    print(f"Read merged data of all pipes for task: {task_instance.id}")
+                    for row in self.data_collector.read_task_merged(task_instance):
+                        print(row)
+                    print("")
+                return
+            if args.epoch:
+                if not self._check_unshared(args.task_id):
+                    return
+                for task_instance in task_instances:
+                    snapshot = self.data_collector.collect_epoch(task_instance)
+                    # The extended counters start a new epoch as well.
+                    self.counter_extender.rebase(task_instance.id, clear=True)
+                    epoch = self.snapshot_store.add(snapshot)
+                    print(f"{snapshot} (epoch {epoch})")
+                    for row in snapshot.data:
+                        print(row)
+                    print("")
+                return
+            # Locations of all the tasks are read in parallel.
+            datas = self.data_collector.read_tasks_concurrently(task_instances)
+            for task_instance, data in zip(task_instances, datas):
+                print(f"Read all data for task: {task_instance.id}")
+                for row in data:
+                    print(row)
+                print("")
         except Exception as e:
             print(traceback.format_exc())
             print(e)
@@ -230,22 +346,149 @@ class FlyMonController(cmd.Cmd):
                 print(f"Invalid task id {args.task_id}")
                 return
             # data = self.data_collector.read_task(task_instance)
-            pcap_statistics = loadJsonToDict( args.gd_file )
+            key_strs, keys_bytes, reals = self.load_ground_truth(task_instance, args.gd_file)
+            # Query all the keys at once.
+            estimates = self.data_collector.query_keys(task_instance, keys_bytes)
             RE_SUM = 0.0
-            for ip_pair in pcap_statistics['ip_pair_pkt_cnt_table']:
-                key_str = ip_pair[1] + "," + ip_pair[0] + ",*,*,*"
-                key_bytes = task_instance.generate_key_bytes(key_str)
-                real = pcap_statistics['ip_pair_pkt_cnt_table'][ip_pair]
-                estimate = self.data_collector.query_task2(task_instance, key_bytes)
+            for key_str, real, estimate in zip(key_strs, reals, estimates):
                 print(f"key={key_str}, real={real}, estimate={estimate}")
                 RE_SUM += abs(estimate - real) / real
-            print(f"ARE = {RE_SUM/len(pcap_statistics['ip_pair_pkt_cnt_table'])}")
+            print(f"ARE = {RE_SUM/len(reals)}")
             print("")
         except Exception as e:
             print(traceback.format_exc())
             print(e)
             return
 
+    def load_ground_truth(self, task_instance, gd_file):
+        """
+        Returns:
+            the key strings, the key bytes (of the task) and the real counts of the flows in a ground truth file.
+        """
+        pcap_statistics = loadJsonToDict( gd_file )
+        key_strs = []
+        keys_bytes = []
+        reals = []
+        for ip_pair in pcap_statistics['ip_pair_pkt_cnt_table']:
+            key_str = ip_pair[1] + "," + ip_pair[0] + ",*,*,*"
+            key_strs.append(key_str)
+            keys_bytes.append(task_instance.generate_key_bytes(key_str))
+            reals.append(pcap_statistics['ip_pair_pkt_cnt_table'][ip_pair])
+        return key_strs, keys_bytes, reals
+
+    def do_detect_change(self, arg):
+        """
+        Detect the flows whose frequency changes a lot between two epochs in the history (see read_task -e).
+        Args list:
+            "-t" "--task_id" the ID of a frequency task, e.g., 1
+            "-f" "--gd_file" the candidate flows (in the format of the ground truth file), e.g., xxxx.json
+            "-T" "--threshold" the least absolute change of a reported flow, e.g., 1000
+            "-n" "--epoch" compare the epoch with the one before it, e.g., 3. Default: the last epoch.
+        Return:
+            The flows with heavy changes, the largest changes first.
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-t", "--task_id", dest="task_id", type=int, required=True, help="e.g., 1")
+        parser.add_argument("-f", "--gd_file", dest="gd_file", type=str, required=True, help="e.g., xxxx.json")
+        parser.add_argument("-T", "--threshold", dest="threshold", type=int, required=True, help="e.g., 1000")
+        parser.add_argument("-n", "--epoch", dest="epoch", type=int, required=False, default=None, help="e.g., 3")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            task_instance = self.task_manager.get_instance(args.task_id)
+            if task_instance is None:
+                print(f"Invalid task id {args.task_id}")
+                return
+            epochs = self.snapshot_store.epochs(args.task_id)
+            epoch = epochs[-1] if args.epoch is None and len(epochs) > 0 else args.epoch
+            prev_snapshot = self.snapshot_store.get(args.task_id, epoch - 1) if epoch is not None else None
+            snapshot = self.snapshot_store.get(args.task_id, epoch) if epoch is not None else None
+            if prev_snapshot is None or snapshot is None:
+                print(f"Two epochs of task {args.task_id} are needed in the history.")
+                return
+            key_strs, keys_bytes, _ = self.load_ground_truth(task_instance, args.gd_file)
+            indexes = self.data_collector.key_indexes(task_instance, keys_bytes)
+            result = self.data_collector.detect_changes(task_instance, prev_snapshot, snapshot, indexes, args.threshold)
+            if result is None:
+                return
+            for position, change in zip(*result):
+                print(f"key={key_strs[position]}, change={change:+g}")
+            print(f"{len(result[0])} heavy change(s) between epoch {epoch - 1} and {epoch} of task {args.task_id}.")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
+    def do_topk(self, arg):
+        """
+        Report the heavy hitters of a frequency task, tracked across epochs.
+        Args list:
+            "-t" "--task_id" the ID of a frequency task, e.g., 1
+            "-k" "--topk" the number of heavy hitters, e.g., 10
+            "-f" "--gd_file" the candidate flows (in the format of the ground truth file), e.g., xxxx.json.
+                             Default: only the heavy hitters of the earlier epochs.
+            "-n" "--epoch" score an epoch in the history (see read_task -e), e.g., 3. Default: the current memory.
+            "-r" "--reset" forget the heavy hitters of the earlier epochs.
+        Return:
+            The heavy hitters of the epoch and across the epochs.
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-t", "--task_id", dest="task_id", type=int, required=True, help="e.g., 1")
+        parser.add_argument("-k", "--topk", dest="topk", type=int, required=False, default=TOPK, help=f"e.g., {TOPK}")
+        parser.add_argument("-f", "--gd_file", dest="gd_file", type=str, required=False, default=None, help="e.g., xxxx.json")
+        parser.add_argument("-n", "--epoch", dest="epoch", type=int, required=False, default=None, help="e.g., 3")
+        parser.add_argument("-r", "--reset", action="store_true", required=False, help="forget the earlier epochs")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            task_instance = self.task_manager.get_instance(args.task_id)
+            if task_instance is None:
+                print(f"Invalid task id {args.task_id}")
+                return
+            tracker = self.topk_trackers.get(args.task_id)
+            if tracker is None or args.reset or tracker.k != args.topk:
+                tracker = TopKTracker(self.data_collector, task_instance, args.topk)
+                self.topk_trackers[args.task_id] = tracker
+            # The task can be modified since the last epoch.
+            tracker.task_instance = task_instance
+            tracker.data_collector = self.data_collector
+            if args.gd_file is not None:
+                if (args.task_id, args.gd_file) not in self.topk_candidates:
+                    key_strs, keys_bytes, _ = self.load_ground_truth(task_instance, args.gd_file)
+                    self.topk_candidates[(args.task_id, args.gd_file)] = (key_strs, keys_bytes)
+                key_strs, keys_bytes = self.topk_candidates[(args.task_id, args.gd_file)]
+            else:
+                key_strs, keys_bytes = None, tracker.candidates()
+                if len(keys_bytes) == 0:
+                    print(f"No candidate flows of task {args.task_id}, give a ground truth file.")
+                    return
+            if args.epoch is not None:
+                snapshot = self.snapshot_store.get(args.task_id, args.epoch)
+                if snapshot is None:
+                    print(f"Epoch {args.epoch} of task {args.task_id} is not in the history.")
+                    return
+                data = snapshot.data
+            else:
+                data = self.data_collector.read_task(task_instance)
+            start = time.time()
+            epoch_top = tracker.update(data, keys_bytes, key_strs)
+            spent = time.time() - start
+            table = pt.PrettyTable(["Rank", "Flow", "Estimate", "Heaviest Estimate"])
+            heavy = dict((key, estimate) for estimate, key in tracker.top())
+            for rank, (estimate, key) in enumerate(epoch_top):
+                label = tracker.labels.get(key, key)
+                table.add_row([rank + 1, label, estimate, heavy.get(label, "-")])
+            print(table)
+            print(f"Scored {len(keys_bytes)} candidate(s) in {spent*1000:.3f} ms, {tracker.epochs} epoch(s) tracked.")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
     def do_read_cmug(self, arg):
         """
         Read the data of a task.
@@ -293,8 +536,16 @@ class FlyMonController(cmd.Cmd):
             if task_instance is None:
                 print(f"Invalid task id {args.task_id}")
                 return
+            self.counter_extender.untrack(args.task_id)
+            self.topk_trackers.pop(args.task_id, None)
+            shared = self.task_manager.is_shared(args.task_id)
+            if not self.task_manager.uninstall_task(args.task_id):
+                print(f"[Failed] when delete rules for task {args.task_id}\n")
+                return
+            if shared:
+                # Other tasks still use the rules and memory.
+                return
             self.resource_manager.release_task(task_instance)
-            self.task_manager.uninstall_task(task_instance.id)
             if args.clear:
                 self.data_collector.clear_task(task_instance)
         except Exception as e:
@@ -302,6 +553,291 @@ class FlyMonController(cmd.Cmd):
             print(e)
             return
 
+    def do_modify_task(self, arg):
+        """
+        Modify the filter, the attribute or the memory size of a task without stopping it.
+        The task keeps its id, and its counters if the attribute is not changed and a row stays in the same CMU
+        (they are folded into a smaller memory or copied into a larger one).
+        Args list:
+            "-t" "--task_id" the ID of the task, e.g., 1
+            "-f" "--filter" the new filter, e.g., 10.0.0.0/8,*
+            "-a" "--attribute" the new attribute, e.g., frequency(1)
+            "-m" "--mem_size" the new memory size, e.g., 32768
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-t", "--task_id", dest="task_id", type=int, required=True, help="e.g., 1")
+        parser.add_argument("-f", "--filter", dest="filter", type=str, required=False, default=None, help="e.g., 10.0.0.0/8,*")
+        parser.add_argument("-a", "--attribute", dest="attribute", type=str, required=False, default=None, help="e.g., frequency(1)")
+        parser.add_argument("-m", "--mem_size", dest="mem_size", type=int, required=False, default=None, help="e.g., 32768")
+        parser.add_argument("-q", "--quiet", "--flag", action="store_true", required=False, help="do not need the log?")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            task_instance = self.task_manager.get_instance(args.task_id)
+            if task_instance is None:
+                print(f"Invalid task id {args.task_id}")
+                return
+            new_instance = self.task_manager.derive_task(task_instance.id, args.filter, args.attribute, args.mem_size)
+            locations = self.resource_manager.reallocate_resources(task_instance.id, new_instance.resource_list(),
+                                                                   self.task_manager.filter_conflicts(new_instance))
+            if locations is None:
+                print(f"[Failed] when allocating resources for task {task_instance.id}\n")
+                return
+            new_instance.locations = locations
+            # Count the updates of the old memory before it is folded.
+            self.counter_extender.poll([task_instance.id])
+            keep = new_instance.spec[2] == task_instance.spec[2]
+            # Fold into the new memory before the rules point at it, then only the updates in between are merged.
+            folds = []
+            for old_loc in task_instance.locations:
+                for loc in new_instance.locations:
+                    if keep and (loc.group_id, loc.cmu_id, loc.hkeys) == (old_loc.group_id, old_loc.cmu_id, old_loc.hkeys):
+                        folds.append((old_loc, loc, self.data_collector.fold_memory(old_loc, loc, new_instance.attribute.operation)))
+            if not self.task_manager.modify_task(task_instance.id, new_instance):
+                for _, loc, _ in folds:
+                    self.data_collector.clear_memory(loc, loc.memory_idx)
+                self.resource_manager.abort_reallocation(task_instance.id, locations)
+                print(f"[Failed] when modify rules for task {task_instance.id}\n")
+                return
+            for old_loc, loc, folded in folds:
+                self.data_collector.fold_delta(old_loc, loc, new_instance.attribute.operation, folded)
+            for old_loc in task_instance.locations:
+                self.data_collector.clear_memory(old_loc, old_loc.memory_idx)
+            self.resource_manager.commit_reallocation(task_instance)
+            self.counter_extender.rebase(task_instance.id, clear=not keep)
+            if not args.quiet:
+                self.task_manager.show_task(new_instance.id)
+                print(f"[Success] Modify TaskID: {new_instance.id} \n")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
+    def _check_unshared(self, task_ids):
+        """ The memory of a shared task (see TaskManager.share_task) also holds the data of the other tasks
+        using it, so it is not reset, neither at the end of an epoch nor drained by extend_task.
+        Returns:
+            True if none of the tasks is shared.
+        """
+        for task_id in task_ids:
+            if self.task_manager.get_instance(task_id) is not None and self.task_manager.is_shared(task_id):
+                print(f"Task {task_id} shares its memory with other tasks, it cannot be reset.")
+                return False
+        return True
+
+    def do_reset_task(self, arg):
+        """
+        Reset the memory of one or more tasks (e.g., at the end of a measurement epoch).
+        Args list:
+            "-t" "--task_id" the ID of one or more tasks, e.g., 1 or 1 2 3
+        Return:
+            The time spent on the reset.
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-t", "--task_id", dest="task_id", type=int, nargs='+', required=True, help="e.g., 1 or 1 2 3")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            task_instances = []
+            for task_id in args.task_id:
+                task_instance = self.task_manager.get_instance(task_id)
+                if task_instance is None:
+                    print(f"Invalid task id {task_id}")
+                    return
+                task_instances.append(task_instance)
+            if not self._check_unshared(args.task_id):
+                return
+            reset_time = self.data_collector.reset_tasks(task_instances)
+            for task_instance in task_instances:
+                self.counter_extender.rebase(task_instance.id, clear=True)
+            print(f"Reset {len(task_instances)} task(s) in {reset_time*1000:.3f} ms.")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
+    def do_defrag(self, arg):
+        """
+        Defragment the CMU memory by moving the memory blocks of running tasks.
+        Args list:
+            "-m" "--mem_size" compact each CMU until a block of the size is free, e.g., 32768. Default: compact all memory.
+            "-p" "--plan" only show the planned moves.
+            "-b" "--background" move one block each interval in the background.
+            "-i" "--interval" the interval (in seconds) of the background moves.
+            "-s" "--stop" stop the background defragmentation.
+        Return:
+            The number of moves.
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-m", "--mem_size", dest="mem_size", type=int, required=False, default=None, help="e.g., 32768")
+        parser.add_argument("-p", "--plan", action="store_true", required=False, help="only show the planned moves")
+        parser.add_argument("-b", "--background", action="store_true", required=False, help="run in the background")
+        parser.add_argument("-i", "--interval", dest="interval", type=float, required=False, default=DEFRAG_INTERVAL, help=f"e.g., {DEFRAG_INTERVAL}")
+        parser.add_argument("-s", "--stop", action="store_true", required=False, help="stop the background defragmentation")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            if args.stop:
+                self.defragmenter.stop()
+                print(f"Defragmentation stopped, {self.defragmenter.moved} block(s) moved in total.")
+                return
+            if args.plan:
+                moves = self.defragmenter.plan(args.mem_size)
+                for group_id, cmu_id, task_id, memory_type, memory_idx, new_idx in moves:
+                    print(f"Task {task_id}: CMU-Group {group_id} CMU-{cmu_id} {MemoryType(memory_type).name} offset:{memory_idx} -> offset:{new_idx}")
+                print(f"{len(moves)} move(s) planned.")
+                return
+            if args.background:
+                if self.defragmenter.start(args.mem_size, args.interval):
+                    print("Defragmentation started in the background.")
+                return
+            moved = self.defragmenter.run(args.mem_size)
+            print(f"Defragmentation done, {moved} block(s) moved.")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
+    def do_audit(self, arg):
+        """
+        Check the rule tables of the data plane against the shadow of written entries.
+        It reads each rule table once, so it is cheap enough to run periodically.
+        Args list:
+            "-r" "--repair" rewrite the inconsistent entries.
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-r", "--repair", action="store_true", required=False, help="rewrite the inconsistent entries")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            report = self.runtime.audit(args.repair)
+            if len(report) == 0:
+                print("All rule tables are consistent.")
+                return
+            table = pt.PrettyTable(["Table", "Missing", "Extra", "Different"])
+            for name, diff in report.items():
+                table.add_row([name, diff["missing"], diff["extra"], diff["different"]])
+            print(table)
+            if args.repair:
+                print("Repaired.")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
+    def do_history(self, arg):
+        """
+        Show the epochs of a task kept in the history (see read_task -e), without reading the switch.
+        Args list:
+            "-t" "--task_id" the ID of the task, e.g., 1
+            "-b" "--begin" only the epochs which end after the time (time.time()), e.g., 1700000000
+            "-e" "--end" only the epochs which end before the time
+            "-n" "--epoch" print the data of an epoch, e.g., 3
+            "-m" "--merge" merge the epochs (in the time range) into one and print it.
+            "-s" "--stats" show the usage of the history.
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-t", "--task_id", dest="task_id", type=int, required=False, default=None, help="e.g., 1")
+        parser.add_argument("-b", "--begin", dest="begin", type=float, required=False, default=None, help="e.g., 1700000000")
+        parser.add_argument("-e", "--end", dest="end", type=float, required=False, default=None, help="e.g., 1700000060")
+        parser.add_argument("-n", "--epoch", dest="epoch", type=int, required=False, default=None, help="e.g., 3")
+        parser.add_argument("-m", "--merge", action="store_true", required=False, help="merge the epochs")
+        parser.add_argument("-s", "--stats", action="store_true", required=False, help="show the usage of the history")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            if args.stats or args.task_id is None:
+                print(self.snapshot_store.stats())
+                return
+            if args.epoch is not None:
+                snapshot = self.snapshot_store.get(args.task_id, args.epoch)
+                if snapshot is None:
+                    print(f"Epoch {args.epoch} of task {args.task_id} is not in the history.")
+                    return
+                print(str(snapshot))
+                for row in snapshot.data:
+                    print(row)
+                return
+            epochs = self.snapshot_store.epochs(args.task_id, args.begin, args.end)
+            if args.merge:
+                task_instance = self.task_manager.get_instance(args.task_id)
+                if task_instance is None or len(epochs) == 0:
+                    print(f"No epoch of task {args.task_id} to merge.")
+                    return
+                snapshot = self.data_collector.merge_snapshots(task_instance, self.snapshot_store.range(args.task_id, args.begin, args.end))
+                if snapshot is None:
+                    return
+                print(f"{snapshot} (merged {len(epochs)} epochs)")
+                for row in snapshot.data:
+                    print(row)
+                if task_instance.attribute.type == AttributeType.SingleKeyDistinct:
+                    print(f"Distinct: {task_instance.attribute.analyze(snapshot.data)}")
+                return
+            for epoch in epochs:
+                snapshot = self.snapshot_store.get(args.task_id, epoch)
+                print(f"Epoch {epoch}: [{snapshot.epoch_start}, {snapshot.epoch_end}]")
+            print(f"{len(epochs)} epoch(s) of task {args.task_id}.")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
+    def do_extend_task(self, arg):
+        """
+        Extend the 16-bit buckets of CondADD tasks (e.g., frequency) to 64-bit counters,
+        by polling their memory in the background (see CounterExtender).
+        Args list:
+            "-t" "--task_id" the ID of one or more tasks to track, e.g., 1 or 1 2 3
+            "-r" "--line_rate" the rate (in Gbps) of the traffic counted into a bucket, the poll interval is derived from it.
+            "-i" "--interval" poll each interval (in seconds) instead.
+            "-u" "--untrack" stop tracking the tasks.
+            "-s" "--stop" stop the background polls.
+        Return:
+            The poll interval.
+        """
+        parser = FlyMonArgumentParser()
+        parser.add_argument("-t", "--task_id", dest="task_id", type=int, nargs='+', required=False, default=[], help="e.g., 1 or 1 2 3")
+        parser.add_argument("-r", "--line_rate", dest="line_rate", type=float, required=False, default=LINE_RATE, help=f"e.g., {LINE_RATE}")
+        parser.add_argument("-i", "--interval", dest="interval", type=float, required=False, default=None, help="e.g., 0.01")
+        parser.add_argument("-u", "--untrack", action="store_true", required=False, help="stop tracking the tasks")
+        parser.add_argument("-s", "--stop", action="store_true", required=False, help="stop the background polls")
+        try:
+            args = parser.parse_args(arg.split())
+            if parser.error_message or args is None:
+                print(parser.error_message)
+                return
+            if args.stop:
+                self.counter_extender.stop()
+                print(f"Counter extension stopped, {self.counter_extender.stats()}")
+                return
+            if not args.untrack and not self._check_unshared(args.task_id):
+                return
+            for task_id in args.task_id:
+                if args.untrack:
+                    self.counter_extender.untrack(task_id)
+                    continue
+                interval = self.counter_extender.track(task_id, args.line_rate)
+                if interval is not None:
+                    print(f"Task {task_id} is tracked, poll interval: {interval*1000:.3f} ms.")
+            if args.untrack:
+                return
+            if self.counter_extender.start(args.interval):
+                print("Counter extension started in the background.")
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return
+
     def do_add_port(self, arg):
         '''
         Enable a port on tofino
@@ -448,28 +984,28 @@ class FlyMonController(cmd.Cmd):
                 return
             net_src = ipaddress.ip_network(args.srcip)
             net_dst = ipaddress.ip_network(args.dstip)
-            count = 0
-            skip_num = 0
-            while count != packet_num:
-                for src_ip in net_src.hosts():
-                    pos = 0
-                    for dst_ip in net_dst.hosts():
-                        if pos < skip_num:
-                            pos += 1
-                            continue
-                        if count < packet_num:
-                            pkt = Ether(src="00:00:00:00:00:00", dst="ff:ff:ff:ff:ff:ff") / IP(src=src_ip, dst=dst_ip) / UDP(dport=4321, sport=1234)
-                            pkt = pkt / ('a'* (packet_size-4 - len(pkt)))
-                            sendp(pkt, iface=VPORT_DICT[port], verbose=0)
-                            skip_num += 1
-                            if skip_num >= 2**(32 - net_dst.prefixlen):
-                                skip_num = 0
-                            count += 1
-                            print(f"Send a packet with src_ip={src_ip}, dst_ip={dst_ip}, pktlen={packet_size}.")
-                            break
-                        else:
-                            print("Done.")
-                            return
+            # Pick the addresses of all the packets first, then send them at once.
+            # The i-th packet goes from the i-th source host to the i-th destination host, both wrapping around.
+            src_hosts = list(itertools.islice(net_src.hosts(), packet_num))
+            dst_hosts = list(itertools.islice(net_dst.hosts(), packet_num))
+            src_ips = [src_hosts[idx % len(src_hosts)] for idx in range(packet_num)]
+            dst_ips = [dst_hosts[idx % len(dst_hosts)] for idx in range(packet_num)]
+            if self.sim:
+                # The simulator processes the whole send as one batch.
+                self.runtime.process({"hdr.ipv4.src_addr" : [int(src_ip) for src_ip in src_ips],
+                                      "hdr.ipv4.dst_addr" : [int(dst_ip) for dst_ip in dst_ips],
+                                      "hdr.ports.src_port": [1234] * packet_num,
+                                      "hdr.ports.dst_port": [4321] * packet_num,
+                                      "hdr.ipv4.protocol" : [17] * packet_num,
+                                      "pkt_size" : [packet_size] * packet_num})
+                print(f"Send {packet_num} packets, pktlen={packet_size}.")
+            else:
+                for src_ip, dst_ip in zip(src_ips, dst_ips):
+                    pkt = Ether(src="00:00:00:00:00:00", dst="ff:ff:ff:ff:ff:ff") / IP(src=src_ip, dst=dst_ip) / UDP(dport=4321, sport=1234)
+                    pkt = pkt / ('a'* (packet_size-4 - len(pkt)))
+                    sendp(pkt, iface=VPORT_DICT[port], verbose=0)
+                    print(f"Send a packet with src_ip={src_ip}, dst_ip={dst_ip}, pktlen={packet_size}.")
+            print("Done.")
         except Exception as e:
             print(traceback.format_exc())
             print(e)
@@ -481,12 +1017,14 @@ class FlyMonController(cmd.Cmd):
             -t : integer, task_id.
             -k : keys (no space), src_ip/prefix1,dst_ip/prefix2,src_port/prefix3,dst_port/prefix4,protocol/prefix5
                  e.g., 10.0.0.0/24,*,*,*,*
+            -x : query the 64-bit counters of a task tracked by extend_task.
         """
         parser = FlyMonArgumentParser()
         parser.add_argument("-t", "--task_id", dest="task_id", type=int, required=True, help="e.g., 1")
         parser.add_argument("-k", "--key", dest="key", type=str, required=False, default= None,
                                      help="e.g., 10.0.0.0/24,*,*,*,*, \
                                            need to follow the seq of : src_ip/prefix1,dst_ip/prefix2,src_port/prefix3,dst_port/prefix4,protocol/prefix5")
+        parser.add_argument("-x", "--extended", action="store_true", required=False, help="query the 64-bit counters")
         try:
             args = parser.parse_args(arg.split())
             if parser.error_message or args is None:
@@ -496,6 +1034,13 @@ class FlyMonController(cmd.Cmd):
             if task_instance is None:
                 print(f"Invalid task id {args.task_id}")
                 return
+            if args.extended:
+                if not self.counter_extender.is_tracked(args.task_id):
+                    print(f"Task {args.task_id} is not tracked by extend_task.")
+                    return
+                flow_key = None if args.key is None else task_instance.generate_key_bytes(args.key)
+                print(self.counter_extender.query(args.task_id, flow_key))
+                return
             if args.key is None:
                 self.data_collector.query_task(task_instance, None)
             else:
@@ -511,9 +1056,21 @@ class FlyMonController(cmd.Cmd):
         Dangerous! Reset the status of the data plane and the control plane.
         """
         try:
+            self.defragmenter.stop()
+            self.counter_extender.stop()
+            self.data_collector.close()
             self.task_manager = TaskManager(self.runtime, self.cmug_configs)
             self.resource_manager = ResourceManager(self.runtime, self.cmug_configs)
             self.data_collector = DataCollector(self.runtime, self.cmug_configs)
+            self.defragmenter.resource_manager = self.resource_manager
+            self.defragmenter.task_manager = self.task_manager
+            self.defragmenter.data_collector = self.data_collector
+            self.counter_extender = CounterExtender(self.task_manager, self.data_collector, self.defragmenter.lock)
+            # Task IDs restart, so the history of the old tasks is dropped.
+            for task_id in list(self.snapshot_store.times.keys()):
+                self.snapshot_store.drop(task_id)
+            self.topk_trackers = {}
+            self.topk_candidates = {}
             print("Reset Done.")
         except Exception as e:
             print(traceback.format_exc())
@@ -559,6 +1116,8 @@ class FlyMonController(cmd.Cmd):
                 # print(alg, f"'s average delay is:\t{sum(lats)/len(lats)*1e3}ms")
                 tb.add_row([alg, '%.2f'%(sum(lats)/len(lats)*1e3)])
             print(tb)
+            if hasattr(self.runtime, "cache_stats"):
+                print(f"Table lookups saved by the runtime cache: {self.runtime.cache_stats()['saved_lookups']}")
                     
         except Exception as e:
             print(traceback.format_exc())
@@ -579,22 +1138,12 @@ class FlyMonController(cmd.Cmd):
                 # Batch 2, T = 50
                 ("del" , "-t 1"),
                 ("add" , "-f 30.0.0.0/8,* -k hdr.ipv4.src_addr -a existence() -m 12 -q"),
-                ("realoc" , 
-                    [
-                        ("del" , "-t 2"),
-                        ("add" , "-f 20.0.0.0/8,* -k hdr.ipv4.dst_addr -a frequency(1) -m 24 -q")
-                    ]
-                ),
+                ("realoc" , "-t 2 -m 24 -q"),
                 # Batch 3, T = 90
                 ("del" , "-t 3"),
                 ("add" , "-f 40.0.0.0/8,* -k hdr.ipv4.src_addr,hdr.ipv4.dst_addr -a distinct() -m 32 -q"),
                 ("del" , "-t 2"),
-                ("realoc" , 
-                    [
-                        ("del" , "-t 4"),
-                        ("add" , "-f 40.0.0.0/8,* -k hdr.ipv4.src_addr,hdr.ipv4.dst_addr -a distinct() -m 16 -q"),
-                    ]
-                ),
+                ("realoc" , "-t 4 -m 16 -q"),
             ]
             self.do_reset_all("")
             sec = 1
@@ -608,11 +1157,7 @@ class FlyMonController(cmd.Cmd):
                 elif tp == "del":
                     _ = self.do_del_task(cmd)
                 else:
-                    for tb2, cmd2 in cmd:
-                        if tb2 == "add":
-                            _ = self.do_add_task(cmd2)
-                        elif tb2 == "del":
-                            _ = self.do_del_task(cmd2)
+                    _ = self.do_modify_task(cmd)
                 
             self.do_reset_all("")
         except Exception as e:
@@ -627,6 +1172,7 @@ class FlyMonController(cmd.Cmd):
     
     def do_EOF(self, line):
         print("")
+        self.snapshot_store.close()
         return True
     
     def do_shell(self, line):
@@ -654,7 +1200,13 @@ class FlyMonController(cmd.Cmd):
 
         self.target = gc.Target(device_id=0, pipe_id=0xffff)
 
-        self.runtime = FlyMonRuntime_BfRt(self.target, self.bfrt_info)
+        self.runtime = FlyMonRuntime_BfRt(self.target, self.bfrt_info, self.cmug_configs, self.interface)
 
 if __name__ == "__main__":
-    FlyMonController().cmdloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", dest="config", type=str, required=False, default="cmu_groups.json", help="CMU-Group configs generated by flymon_compiler.py")
+    parser.add_argument("--sim", dest="sim", action="store_true", required=False, help="run with the offline data plane emulator instead of a switch")
+    parser.add_argument("-j", "--journal", dest="journal", type=str, required=False, default=None, help="e.g., flymon.journal, restore the tasks from it if it exists")
+    parser.add_argument("-s", "--store", dest="store", type=str, required=False, default=None, help="e.g., flymon_history, the directory of the epoch history on disk")
+    args = parser.parse_args()
+    FlyMonController(args.config, args.sim, args.journal, args.store).cmdloop()
\ No newline at end of file
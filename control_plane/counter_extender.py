@@ -0,0 +1,271 @@
+import threading
+import time
+import numpy as np
+from task_manager import TaskManager
+from data_collector import DataCollector
+from flymonlib.operation import OperationType
+from flymonlib.param import ParamType
+
+
+# Default rate (in Gbps) of the traffic which can be counted into a single bucket, e.g., the line rate of a port.
+LINE_RATE = 100
+# The smallest packet on the wire (in bytes): a 64 bytes frame, 8 bytes of preamble and 12 bytes of IFG.
+MIN_WIRE_PKT = 84
+# A bucket of the CondADD operation stops growing at the bound (see Frequency.param2).
+BUCKET_BOUND = 0xFFFF
+# Buckets at or above the watermark are drained by a poll.
+DRAIN_WATERMARK = 0x8000
+
+def poll_interval(attribute, line_rate=LINE_RATE):
+    """ The longest poll interval with which no bucket saturates:
+    a bucket below the watermark at a poll stays below the bound until the next poll,
+    even if all the traffic is counted into it.
+    Args:
+        attribute: the attribute of the task, its param1 is added to a bucket for each packet.
+        line_rate: the rate (in Gbps) of the traffic counted into a bucket.
+    Returns:
+        the interval (in seconds).
+    """
+    pps = line_rate * 1e9 / 8 / MIN_WIRE_PKT
+    param1 = attribute.param1
+    if param1.type == ParamType.Const:
+        rate = pps * max(param1.content, 1)
+    elif param1.type == ParamType.StdParam and param1.content == "pkt_size":
+        rate = line_rate * 1e9 / 8
+    else:
+        # Other params (e.g., a compressed key) can add up to the bound with a single packet.
+        rate = pps * BUCKET_BOUND
+    return (BUCKET_BOUND - DRAIN_WATERMARK) / rate
+
+
+class CounterExtender:
+    """
+    Extend the 16-bit buckets of CondADD tasks (e.g., frequency) to 64-bit counters in the control plane.
+    The memory of each tracked task is polled and compared with the previous poll:
+        1. the increase of a bucket since the last poll is added to its 64-bit counter.
+        2. a bucket lower than at the last poll has wrapped around, its increase is taken modulo 2^16.
+        3. a bucket at the bound has saturated, the updates past the bound are lost and its counter is a lower bound.
+        4. buckets at or above the watermark are drained (read and reset at once), so that they do not saturate
+           before the next poll if the polls are as frequent as poll_interval.
+    The counters have the same layout as read_task: one numpy.uint64 array for each location of the task.
+    """
+    def __init__(self, task_manager:TaskManager, data_collector:DataCollector, lock=None):
+        """
+        lock: the lock of the changes of the tasks (e.g., Defragmenter.lock), polls are exclusive with them.
+        """
+        self.task_manager = task_manager
+        self.data_collector = data_collector
+        self.lock = lock if lock is not None else threading.RLock()
+        self.tracked = {
+            # key : task id
+            # val : [rows, last, counters, saturated, interval]
+            #       rows: (group_id, cmu_id, hkeys) of each location.
+            #       last: the buckets at the last poll (numpy.int64 arrays).
+            #       counters: the 64-bit counters (numpy.uint64 arrays).
+            #       saturated: the buckets which have saturated since the tracking started (bool arrays).
+            #       interval: the poll interval of the task.
+        }
+        self.worker = None
+        self.stop_event = threading.Event()
+        self.polls = 0
+        self.late_polls = 0
+        self.wraps = 0
+        self.saturations = 0
+        self.drained = 0
+
+    def track(self, task_id, line_rate=LINE_RATE):
+        """ Start extending the counters of a task, they start from the current buckets.
+        Returns:
+            the poll interval of the task (in seconds), or None if it cannot be tracked.
+        """
+        with self.lock:
+            task_instance = self.task_manager.get_instance(task_id)
+            if task_instance is None:
+                print(f"Invalid task id {task_id}")
+                return None
+            if task_instance.attribute.operation != OperationType.CondADD:
+                print(f"Task {task_id} does not count with CondADD, its buckets cannot be extended.")
+                return None
+            data = self.data_collector.read_task(task_instance)
+            last = [row.astype(np.int64) for row in data]
+            self.tracked[task_id] = [self._rows(task_instance), last,
+                                     [row.astype(np.uint64) for row in data],
+                                     [row == BUCKET_BOUND for row in last],
+                                     poll_interval(task_instance.attribute, line_rate)]
+            return self.tracked[task_id][4]
+
+    def untrack(self, task_id):
+        with self.lock:
+            return self.tracked.pop(task_id, None) is not None
+
+    def is_tracked(self, task_id):
+        return task_id in self.tracked
+
+    @property
+    def interval(self):
+        """
+        The poll interval which keeps all tracked tasks from saturating, None if no task is tracked.
+        """
+        if len(self.tracked) == 0:
+            return None
+        return min(state[4] for state in self.tracked.values())
+
+    def rebase(self, task_id, clear=False):
+        """ Take the current buckets as the baseline of the next poll, after the memory of a task is changed
+        by others (e.g., reset or modified).
+        Args:
+            clear: also reset the counters (e.g., when the memory is reset at the end of an epoch).
+                   Otherwise a counter is kept if its location stays in the same CMU with the same keys,
+                   and it is folded or copied into the new memory size as DataCollector.fold_memory does.
+        """
+        with self.lock:
+            if task_id not in self.tracked:
+                return
+            task_instance = self.task_manager.get_instance(task_id)
+            if task_instance is None or task_instance.attribute.operation != OperationType.CondADD:
+                self.tracked.pop(task_id)
+                return
+            rows, _, counters, saturated, interval = self.tracked[task_id]
+            data = self.data_collector.read_task(task_instance)
+            last = [row.astype(np.int64) for row in data]
+            new_rows = self._rows(task_instance)
+            new_counters = []
+            new_saturated = []
+            for row, cur in zip(new_rows, last):
+                if clear or row not in rows:
+                    new_counters.append(cur.astype(np.uint64))
+                    new_saturated.append(cur == BUCKET_BOUND)
+                    continue
+                idx = rows.index(row)
+                if len(counters[idx]) > len(cur):
+                    new_counters.append(counters[idx].reshape(-1, len(cur)).sum(axis=0, dtype=np.uint64))
+                    new_saturated.append(saturated[idx].reshape(-1, len(cur)).any(axis=0))
+                else:
+                    new_counters.append(np.tile(counters[idx], len(cur) // len(counters[idx])))
+                    new_saturated.append(np.tile(saturated[idx], len(cur) // len(saturated[idx])))
+            self.tracked[task_id] = [new_rows, last, new_counters, new_saturated, interval]
+
+    def poll(self, task_ids=None):
+        """ Poll the memory of the tracked tasks (all of them by default) once.
+        The locations of all the tasks are read concurrently.
+        """
+        with self.lock:
+            task_instances = []
+            for task_id in list(self.tracked.keys() if task_ids is None else task_ids):
+                if task_id not in self.tracked:
+                    continue
+                task_instance = self.task_manager.get_instance(task_id)
+                if task_instance is None:
+                    # The task is deleted.
+                    self.tracked.pop(task_id)
+                    continue
+                task_instances.append(task_instance)
+            datas = self.data_collector.read_tasks_concurrently(task_instances)
+            for task_instance, data in zip(task_instances, datas):
+                _, last, counters, saturated, _ = self.tracked[task_instance.id]
+                for idx, loc in enumerate(task_instance.locations):
+                    cur = data[idx].astype(np.int64)
+                    self.wraps += int(np.count_nonzero(cur < last[idx]))
+                    counters[idx] += ((cur - last[idx]) % 2**16).astype(np.uint64)
+                    sat = (cur == BUCKET_BOUND) & ~saturated[idx]
+                    self.saturations += int(np.count_nonzero(sat))
+                    saturated[idx] |= sat
+                    drain = np.nonzero(cur >= DRAIN_WATERMARK)[0]
+                    if len(drain) > 0:
+                        values = self.data_collector.drain_buckets(loc, drain).astype(np.int64)
+                        counters[idx][drain] += ((values - cur[drain]) % 2**16).astype(np.uint64)
+                        saturated[idx][drain] |= values == BUCKET_BOUND
+                        cur[drain] = 0
+                        self.drained += len(drain)
+                    last[idx] = cur
+            self.polls += 1
+
+    def read(self, task_id):
+        """
+        Returns:
+            the 64-bit counters of a task (the same layout as read_task), None if it is not tracked.
+        """
+        with self.lock:
+            if task_id not in self.tracked:
+                return None
+            return [row.copy() for row in self.tracked[task_id][2]]
+
+    def saturated(self, task_id):
+        """
+        Returns:
+            the number of buckets of a task which have saturated (their counters are lower bounds).
+        """
+        with self.lock:
+            if task_id not in self.tracked:
+                return 0
+            return sum(int(np.count_nonzero(row)) for row in self.tracked[task_id][3])
+
+    def query(self, task_id, flow_key_bytes=None):
+        """ Query a tracked task with the 64-bit counters (see DataCollector.query_task2).
+        Returns:
+            the result of the attribute, None if the task is not tracked.
+        """
+        with self.lock:
+            task_instance = self.task_manager.get_instance(task_id)
+            if task_instance is None or task_id not in self.tracked:
+                return None
+            counters = self.tracked[task_id][2]
+            if flow_key_bytes is None:
+                return task_instance.attribute.analyze([row.copy() for row in counters])
+            data = []
+            for loc, row in zip(task_instance.locations, counters):
+                bitw = self.data_collector.cmug_bitw[loc.group_id]
+                low, _ = self.data_collector._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+                data.append(row[loc.address_translate(bitw, flow_key_bytes) - low])
+            return task_instance.attribute.analyze(data)
+
+    def stats(self):
+        return {
+            "tracked"     : len(self.tracked),
+            "polls"       : self.polls,
+            "late_polls"  : self.late_polls,
+            "wraps"       : self.wraps,
+            "saturations" : self.saturations,
+            "drained"     : self.drained
+        }
+
+    def start(self, interval=None):
+        """
+        Poll the tracked tasks in the background, each interval (in seconds), by default the interval of the tracked tasks.
+        The interval is taken again after each poll, so that tasks can be tracked in between.
+        A poll which takes longer than the interval is counted as late, buckets can saturate then.
+        """
+        if self.running:
+            print("Counter extension is already running.")
+            return False
+        self.stop_event.clear()
+        self.worker = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self.worker.start()
+        return True
+
+    def stop(self):
+        """
+        Stop the background polls, the poll in progress is finished.
+        """
+        self.stop_event.set()
+
+    @property
+    def running(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def _run(self, interval):
+        while not self.stop_event.is_set():
+            wait = interval if interval is not None else self.interval
+            if wait is None:
+                # Nothing is tracked yet.
+                self.stop_event.wait(1)
+                continue
+            start = time.time()
+            self.poll()
+            spent = time.time() - start
+            if spent > wait:
+                self.late_polls += 1
+            self.stop_event.wait(max(wait - spent, 0))
+
+    def _rows(self, task_instance):
+        return [(loc.group_id, loc.cmu_id, loc.hkeys) for loc in task_instance.locations]
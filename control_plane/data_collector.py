@@ -1,12 +1,31 @@
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from flymonlib.flow_key import FlowKey
 from flymonlib.flymon_task import FlyMonTask
+from flymonlib.cmu_group import MemoryType
+from flymonlib.snapshot import TaskSnapshot
+from flymonlib.flow_attribute import SleKeyDistinct, AttributeType
 from flymonlib.flymon_runtime import FlyMonRuntime_BfRt
+from flymonlib.operation import OperationType
 
 
+# Default number of register reads in flight for the concurrent read APIs.
+MAX_INFLIGHT_READS = 8
+
 class DataCollector:
 
-    def __init__(self, runtime:FlyMonRuntime_BfRt, cmug_configs):
+    def __init__(self, runtime:FlyMonRuntime_BfRt, cmug_configs, max_inflight=MAX_INFLIGHT_READS):
         self.runtime = runtime
+        # Worker pool of the concurrent reads (created on the first use), its size bounds the reads in flight.
+        self.max_inflight = max_inflight
+        self.read_pool = None
+        # Time spent on the last reset (in seconds).
+        self.last_reset_time = None
+        self.epoch_start = {
+            # key : task id
+            # val : the time its memory was last reset
+        }
         self.cmug_bitw = {
             # key : cmu_group id
             # val : cmu_bitw (total_bits)
@@ -30,7 +49,7 @@ class DataCollector:
         Args:
             group_id
         Returns:
-            a list of data array        
+            a list of data array (numpy.uint16), one for each CMU.
         """
         if group_id not in self.cmug_mem.keys():
             print(f"Invalid CMU-Group ID.")
@@ -41,35 +60,273 @@ class DataCollector:
         cmu_size = self.cmug_mem[group_id][2]
         for idx in range(cmu_num):
             cmu_id = idx + 1
-            low = 0
-            high = cmu_size
             # actually read the data 
-            data.append(self.runtime.read(group_id, group_type, cmu_id, low, high))
+            data.append(self.runtime.read_all(group_id, group_type, cmu_id, cmu_size))
         return data
 
     def read_task(self, task_instance:FlyMonTask):
         data = []
         for loc in task_instance.locations:
-            # first calc the memory range
-            # the address width of this task
-            key_bitw = self.cmug_bitw[loc.group_id] - loc.memory_type + 1  
-            # the lowwer and higher bound of the memory range
-            low = loc.memory_idx*(2**key_bitw)
-            high = (loc.memory_idx+1)*(2**key_bitw)
-            # actually read the data 
-            data.append(self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, low, high))
+            data.append(self._read_location(loc))
         return data
+
+    def read_task_pipes(self, task_instance:FlyMonTask):
+        """Read the data of a task in every pipe (read_task only reads the first pipe).
+        Returns:
+            a list of task data (the same as read_task), one for each pipe.
+        """
+        rows = []
+        for loc in task_instance.locations:
+            low, high = self._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+            rows.append(self.runtime.read_pipes(loc.group_id, loc.group_type, loc.cmu_id, low, high))
+        return [[row[pipe] for row in rows] for pipe in range(len(rows[0]))]
+
+    def read_task_merged(self, task_instance:FlyMonTask):
+        """
+        Read the data of a task in every pipe, merged into one (see FlowAttribute.merge).
+        """
+        return task_instance.attribute.merge(self.read_task_pipes(task_instance))
+
+    def merge_snapshots(self, task_instance:FlyMonTask, snapshots):
+        """Merge snapshots of a task (e.g., many epochs, or the same task on many switches) into one.
+        Returns:
+            a TaskSnapshot spanning all the epochs, None if the snapshots do not have the same memory layout.
+        """
+        layouts = set(tuple(len(row) for row in snapshot.data) for snapshot in snapshots)
+        if len(layouts) != 1:
+            print(f"The snapshots of task {task_instance.id} do not have the same memory layout.")
+            return None
+        starts = [snapshot.epoch_start for snapshot in snapshots]
+        epoch_start = None if None in starts else min(starts)
+        epoch_end = max(snapshot.epoch_end for snapshot in snapshots)
+        data = task_instance.attribute.merge([snapshot.data for snapshot in snapshots])
+        return TaskSnapshot(task_instance.id, data, epoch_start, epoch_end)
+
+    def read_tasks_concurrently(self, task_instances):
+        """Read several tasks, the reads of all their locations are issued in parallel.
+        Args:
+            task_instances: a list of FlyMonTask objects.
+        Returns:
+            a list of task data (the same as read_task), in the order of task_instances.
+        """
+        pool = self._pool()
+        futures = []
+        for task_instance in task_instances:
+            futures.append([pool.submit(self._read_location, loc) for loc in task_instance.locations])
+        return [[f.result() for f in task_futures] for task_futures in futures]
+
+    def read_groups_concurrently(self, group_ids):
+        """Read all memory of several cmu groups, the reads of all CMUs are issued in parallel.
+        Returns:
+            a list of group data (the same as read_group), in the order of group_ids.
+        """
+        for group_id in group_ids:
+            if group_id not in self.cmug_mem.keys():
+                print(f"Invalid CMU-Group ID.")
+                return None
+        pool = self._pool()
+        futures = []
+        for group_id in group_ids:
+            group_type, cmu_num, cmu_size = self.cmug_mem[group_id]
+            futures.append([pool.submit(self.runtime.read_all, group_id, group_type, idx + 1, cmu_size)
+                                for idx in range(cmu_num)])
+        return [[f.result() for f in group_futures] for group_futures in futures]
+
+    def _pool(self):
+        if self.read_pool is None:
+            self.read_pool = ThreadPoolExecutor(max_workers=self.max_inflight)
+        return self.read_pool
+
+    def close(self):
+        """
+        Stop the worker pool of the concurrent reads.
+        """
+        if self.read_pool is not None:
+            self.read_pool.shutdown(wait=False)
+            self.read_pool = None
+
+    def _read_location(self, loc):
+        """
+        Read the memory range of a task location.
+        """
+        if loc.memory_type == MemoryType.WHOLE.value:
+            # The task holds the whole register, read it in bulk.
+            cmu_size = self.cmug_mem[loc.group_id][2]
+            return self.runtime.read_all(loc.group_id, loc.group_type, loc.cmu_id, cmu_size)
+        # first calc the memory range
+        # the address width of this task
+        key_bitw = self.cmug_bitw[loc.group_id] - loc.memory_type + 1  
+        # the lowwer and higher bound of the memory range
+        low = loc.memory_idx*(2**key_bitw)
+        high = (loc.memory_idx+1)*(2**key_bitw)
+        # actually read the data 
+        return self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, low, high, self.cmug_mem[loc.group_id][2])
     
     def clear_task(self, task_instance:FlyMonTask):
-        for loc in task_instance.locations:
-            # first calc the memory range
-            # the address width of this task
-            key_bitw = self.cmug_bitw[loc.group_id] - loc.memory_type + 1  
-            # the lowwer and higher bound of the memory range
-            low = loc.memory_idx*(2**key_bitw)
-            high = (loc.memory_idx+1)*(2**key_bitw)
-            # actually read the data 
-            self.runtime.clear_data(loc.group_id, loc.group_type, loc.cmu_id, low, high)
+        return self.reset_tasks([task_instance])
+
+    def reset_tasks(self, task_instances):
+        """Reset the memory of several tasks (e.g., at the end of a measurement epoch).
+        Locations holding a whole register are cleared by a single table clear,
+        and all the resets are sent in one batch.
+        Args:
+            task_instances: a list of FlyMonTask objects.
+        Returns:
+            the time spent on the reset (in seconds).
+        """
+        start = time.time()
+        self.runtime.begin_batch()
+        try:
+            for task_instance in task_instances:
+                for loc in task_instance.locations:
+                    self._reset_location(loc)
+            self.runtime.commit_batch()
+        except Exception:
+            self.runtime.abort_batch()
+            raise
+        end = time.time()
+        for task_instance in task_instances:
+            self.epoch_start[task_instance.id] = end
+        self.last_reset_time = end - start
+        return self.last_reset_time
+
+    def collect_epoch(self, task_instance:FlyMonTask):
+        """Read and reset the memory of a task in one pass, closing its current measurement epoch.
+        Locations are collected in parallel, each one resets a chunk right after reading it.
+        Returns:
+            a TaskSnapshot holding the data of the epoch (the same as read_task).
+        """
+        pool = self._pool()
+        futures = [pool.submit(self._collect_location, loc) for loc in task_instance.locations]
+        data = [f.result() for f in futures]
+        epoch_end = time.time()
+        epoch_start = self.epoch_start.get(task_instance.id)
+        self.epoch_start[task_instance.id] = epoch_end
+        return TaskSnapshot(task_instance.id, data, epoch_start, epoch_end)
+
+    def _collect_location(self, loc):
+        """
+        Read and reset the memory range of a task location.
+        """
+        cmu_size = self.cmug_mem[loc.group_id][2]
+        if loc.memory_type == MemoryType.WHOLE.value:
+            return self.runtime.read_and_clear(loc.group_id, loc.group_type, loc.cmu_id, 0, cmu_size, cmu_size)
+        key_bitw = self.cmug_bitw[loc.group_id] - loc.memory_type + 1  
+        low = loc.memory_idx*(2**key_bitw)
+        high = (loc.memory_idx+1)*(2**key_bitw)
+        return self.runtime.read_and_clear(loc.group_id, loc.group_type, loc.cmu_id, low, high, cmu_size)
+
+    def _reset_location(self, loc):
+        """
+        Reset the memory range of a task location.
+        """
+        cmu_size = self.cmug_mem[loc.group_id][2]
+        if loc.memory_type == MemoryType.WHOLE.value:
+            self.runtime.clear_data(loc.group_id, loc.group_type, loc.cmu_id, 0, cmu_size, cmu_size)
+            return
+        # first calc the memory range
+        # the address width of this task
+        key_bitw = self.cmug_bitw[loc.group_id] - loc.memory_type + 1  
+        # the lowwer and higher bound of the memory range
+        low = loc.memory_idx*(2**key_bitw)
+        high = (loc.memory_idx+1)*(2**key_bitw)
+        self.runtime.clear_data(loc.group_id, loc.group_type, loc.cmu_id, low, high, cmu_size)
+
+    def _memory_range(self, group_id, memory_type, memory_idx):
+        """
+        The lowwer and higher bound of a memory block.
+        """
+        key_bitw = self.cmug_bitw[group_id] - memory_type + 1
+        return memory_idx*(2**key_bitw), (memory_idx+1)*(2**key_bitw)
+
+    def copy_memory(self, loc, memory_idx):
+        """
+        Copy the memory of a task location to another memory block of the same type in the CMU.
+        """
+        low, high = self._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+        new_low, _ = self._memory_range(loc.group_id, loc.memory_type, memory_idx)
+        data = self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, low, high, self.cmug_mem[loc.group_id][2])
+        self.runtime.write(loc.group_id, loc.group_type, loc.cmu_id, new_low, data)
+
+    def clear_memory(self, loc, memory_idx):
+        """
+        Reset a memory block of the same type as a task location in the CMU (e.g., the block a task moved out of).
+        """
+        low, high = self._memory_range(loc.group_id, loc.memory_type, memory_idx)
+        self.runtime.clear_data(loc.group_id, loc.group_type, loc.cmu_id, low, high, self.cmug_mem[loc.group_id][2])
+
+    def drain_buckets(self, loc, indices):
+        """
+        Read and reset some buckets of a task location.
+            indices: the indices of the buckets in the memory range of the location.
+        Returns:
+            a numpy.uint16 array, one bucket for each index.
+        """
+        low, _ = self._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+        return self.runtime.read_and_clear_indices(loc.group_id, loc.group_type, loc.cmu_id, np.asarray(indices) + low)
+
+    def fold_memory(self, old_loc, loc, operation):
+        """
+        Merge the memory of an old location into a new one of another size in the same CMU (with the same keys),
+        before the task is switched to the new location (see TaskManager.modify_task), so that the data plane
+        does not update the new block while it is written.
+        A bucket index is the low bits of the hash, so a shrinking block folds the buckets with the same low bits together,
+        and a growing block copies each bucket to the buckets it splits into (an overestimate, as in a sketch).
+        Buckets are merged as the operation does: added (saturated) for CondADD, max for Max and or for AndOr.
+        Returns:
+            the buckets of the old location which are folded, to be passed to fold_delta() after the switch.
+        """
+        low, high = self._memory_range(old_loc.group_id, old_loc.memory_type, old_loc.memory_idx)
+        new_low, new_high = self._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+        old_data = self.runtime.read(old_loc.group_id, old_loc.group_type, old_loc.cmu_id, low, high, self.cmug_mem[old_loc.group_id][2]).astype(np.int64)
+        data = self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, new_low, new_high, self.cmug_mem[loc.group_id][2]).astype(np.int64)
+        data = self._merge_buckets(data, self._fold_buckets(old_data, new_high - new_low, operation), operation)
+        self.runtime.write(loc.group_id, loc.group_type, loc.cmu_id, new_low, data.astype(np.uint16))
+        return old_data
+
+    def fold_delta(self, old_loc, loc, operation, folded):
+        """
+        Merge the updates of an old location since fold_memory() into the new one, after the task is switched.
+        Only the buckets of the new location which the updates change are read and written,
+        so the write races with few updates of the data plane.
+            folded: the buckets returned by fold_memory().
+        """
+        low, high = self._memory_range(old_loc.group_id, old_loc.memory_type, old_loc.memory_idx)
+        new_low, new_high = self._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+        old_data = self.runtime.read(old_loc.group_id, old_loc.group_type, old_loc.cmu_id, low, high, self.cmug_mem[old_loc.group_id][2]).astype(np.int64)
+        if operation == OperationType.CondADD:
+            delta = (old_data - folded) % 2**16
+        else:
+            # Max and or are idempotent, the changed buckets are merged again.
+            delta = np.where(old_data != folded, old_data, 0)
+        delta = self._fold_buckets(delta, new_high - new_low, operation)
+        indices = np.nonzero(delta)[0]
+        if len(indices) == 0:
+            return
+        data = self.runtime.read_indices(loc.group_id, loc.group_type, loc.cmu_id, indices + new_low).astype(np.int64)
+        data = self._merge_buckets(data, delta[indices], operation)
+        self.runtime.write_indices(loc.group_id, loc.group_type, loc.cmu_id, indices + new_low, data.astype(np.uint16))
+
+    def _fold_buckets(self, old_data, size, operation):
+        """
+        The buckets of a block folded (or copied) into a block of the size, see fold_memory().
+        """
+        if size < len(old_data):
+            rows = old_data.reshape(-1, size)
+            if operation == OperationType.CondADD:
+                return rows.sum(axis=0)
+            elif operation == OperationType.Max:
+                return rows.max(axis=0)
+            else:
+                return np.bitwise_or.reduce(rows, axis=0)
+        return np.tile(old_data, size // len(old_data))
+
+    def _merge_buckets(self, data, folded, operation):
+        if operation == OperationType.CondADD:
+            return np.minimum(data + folded, 0xFFFF)
+        elif operation == OperationType.Max:
+            return np.maximum(data, folded)
+        return data | folded
 
     def query_task(self, task_instance:FlyMonTask, flow_key_bytes = None):
         data = []
@@ -89,7 +346,7 @@ class DataCollector:
                 # the lowwer and higher bound of the memory range
                 low = loc.memory_idx*(2**key_bitw)
                 high = (loc.memory_idx+1)*(2**key_bitw)
-                data.append(self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, low, high))
+                data.append(self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, low, high, self.cmug_mem[loc.group_id][2]))
         print(task_instance.attribute.analyze(data))
         
     def query_task2(self, task_instance:FlyMonTask, flow_key_bytes = None):
@@ -110,5 +367,78 @@ class DataCollector:
                 # the lowwer and higher bound of the memory range
                 low = loc.memory_idx*(2**key_bitw)
                 high = (loc.memory_idx+1)*(2**key_bitw)
-                data.append(self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, low, high))
-        return task_instance.attribute.analyze(data)
\ No newline at end of file
+                data.append(self.runtime.read(loc.group_id, loc.group_type, loc.cmu_id, low, high, self.cmug_mem[loc.group_id][2]))
+        return task_instance.attribute.analyze(data)
+
+    def query_distinct(self, task_instances):
+        """Estimate the number of distinct keys of several single-key distinct (HyperLogLog) tasks.
+        The tasks are read concurrently and estimated together.
+        Returns:
+            a list of estimates, in the order of task_instances.
+        """
+        datas = self.read_tasks_concurrently(task_instances)
+        return SleKeyDistinct.analyze_all(datas)
+
+    def query_keys(self, task_instance:FlyMonTask, flow_keys_bytes):
+        """Point queries of many flow keys (e.g., estimating their frequencies).
+        All keys are hashed first, then each location is read once: only the distinct buckets
+        the keys hit, or the whole memory range of the location when most of it is needed.
+        Args:
+            task_instance: the queried task.
+            flow_keys_bytes: a list of flow key bytes (see FlyMonTask.generate_key_bytes).
+        Returns:
+            a numpy array of the estimates, one for each key.
+        """
+        datas = []
+        for loc in task_instance.locations:
+            key_bitw = self.cmug_bitw[loc.group_id] - loc.memory_type + 1
+            low = loc.memory_idx*(2**key_bitw)
+            high = (loc.memory_idx+1)*(2**key_bitw)
+            indexes = loc.address_translate_batch(self.cmug_bitw[loc.group_id], flow_keys_bytes)
+            buckets, inverse = np.unique(indexes, return_inverse=True)
+            if len(buckets) * 2 >= high - low:
+                # Most of the range is needed, reading it in bulk is cheaper.
+                data = self._read_location(loc)
+                datas.append(data[indexes - low])
+            else:
+                data = self.runtime.read_indices(loc.group_id, loc.group_type, loc.cmu_id, buckets)
+                datas.append(data[inverse])
+        return task_instance.attribute.analyze_keys(np.array(datas))
+
+    def key_indexes(self, task_instance:FlyMonTask, flow_keys_bytes):
+        """ Hash many flow keys into the locations of a task once, e.g., for the candidate keys of every epoch.
+        Returns:
+            a 2-D numpy array of the bucket indices in the memory range of each location,
+            one row for each location and one column for each key.
+        """
+        indexes = []
+        for loc in task_instance.locations:
+            low, _ = self._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+            indexes.append(loc.address_translate_batch(self.cmug_bitw[loc.group_id], flow_keys_bytes) - low)
+        return np.array(indexes)
+
+    def detect_changes(self, task_instance:FlyMonTask, prev_snapshot:TaskSnapshot, snapshot:TaskSnapshot, indexes, threshold):
+        """Find the keys whose change between two epochs of a frequency task is at least the threshold.
+        The snapshots are subtracted bucket by bucket at the keys, and the change of each key is estimated by the attribute.
+        Args:
+            prev_snapshot, snapshot: two epochs of the task (e.g., consecutive epochs in the history).
+            indexes: the bucket indices of the candidate keys (see key_indexes).
+            threshold: the least absolute change of a reported key.
+        Returns:
+            (positions of the keys in the candidates, their changes), the largest changes first.
+            None if the task cannot detect changes or the snapshots do not match its memory.
+        """
+        if task_instance.attribute.type not in [AttributeType.Frequency, AttributeType.FrequencySuMax]:
+            print(f"Task {task_instance.id} is not a frequency task.")
+            return None
+        sizes = [high - low for low, high in (self._memory_range(loc.group_id, loc.memory_type, loc.memory_idx)
+                                                for loc in task_instance.locations)]
+        if [len(row) for row in prev_snapshot.data] != sizes or [len(row) for row in snapshot.data] != sizes:
+            print(f"The snapshots do not match the memory of task {task_instance.id}.")
+            return None
+        prev_datas = [row[idx] for row, idx in zip(prev_snapshot.data, indexes)]
+        datas = [row[idx] for row, idx in zip(snapshot.data, indexes)]
+        changes = task_instance.attribute.analyze_changes(prev_datas, datas)
+        positions = np.nonzero(np.abs(changes) >= threshold)[0]
+        positions = positions[np.argsort(-np.abs(changes[positions]), kind='stable')]
+        return positions, changes[positions]
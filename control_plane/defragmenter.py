@@ -0,0 +1,116 @@
+import threading
+from resource_manager import ResourceManager
+from task_manager import TaskManager
+from data_collector import DataCollector
+
+
+# Default pause (in seconds) between two moves of the background defragmentation.
+DEFRAG_INTERVAL = 0.1
+
+class Defragmenter:
+    """
+    Online defragmentation of the CMU memory.
+    Memory blocks of running tasks are moved (see ResourceManager.plan_defrag) one at a time:
+        1. the block is moved in the CMU status.
+        2. the register data is copied from the old block to the new one.
+        3. the preprocessing rules of the location are switched to the new block in place.
+        4. the old block is reset.
+    Only the updates between 2 and 3 are lost, and a task is never stopped.
+    """
+    def __init__(self, resource_manager:ResourceManager, task_manager:TaskManager, data_collector:DataCollector, journal=None):
+        """
+        journal: a Journal which is saved after each background move, None to disable.
+        """
+        self.resource_manager = resource_manager
+        self.task_manager = task_manager
+        self.data_collector = data_collector
+        self.journal = journal
+        # Moves are exclusive with other changes of the tasks (e.g., controller commands).
+        self.lock = threading.RLock()
+        self.worker = None
+        self.stop_event = threading.Event()
+        self.moved = 0
+
+    def plan(self, mem_size=None):
+        """
+        Plan the moves, see ResourceManager.plan_defrag.
+        """
+        return self.resource_manager.plan_defrag(mem_size)
+
+    def migrate(self, move):
+        """ Move a memory block of a running task.
+        Args:
+            move: (group_id, cmu_id, task_id, memory_type, memory_idx, new_idx)
+        Returns:
+            True or False (nothing is changed).
+        """
+        group_id, cmu_id, task_id, memory_type, memory_idx, new_idx = move
+        task_instance = self.task_manager.get_instance(task_id)
+        if task_instance is None:
+            print(f"Invalid task id {task_id} when defragment.")
+            return False
+        location = None
+        for loc in task_instance.locations:
+            if (loc.group_id, loc.cmu_id, loc.memory_type, loc.memory_idx) == (group_id, cmu_id, memory_type, memory_idx):
+                location = loc
+        if location is None or not self.resource_manager.move_memory(group_id, cmu_id, task_id, memory_type, memory_idx, new_idx):
+            print(f"Invalid move {move} when defragment.")
+            return False
+        self.data_collector.copy_memory(location, new_idx)
+        if not self.task_manager.relocate_location(task_id, location, new_idx):
+            self.resource_manager.move_memory(group_id, cmu_id, task_id, memory_type, new_idx, memory_idx)
+            self.data_collector.clear_memory(location, new_idx)
+            return False
+        self.data_collector.clear_memory(location, memory_idx)
+        self.moved += 1
+        return True
+
+    def run(self, mem_size=None):
+        """ Defragment the memory in the foreground.
+        Args:
+            mem_size: compact each CMU until a block of the size is free, None to compact the whole memory.
+        Returns:
+            the number of moves.
+        """
+        moved = 0
+        with self.lock:
+            for move in self.plan(mem_size):
+                if not self.migrate(move):
+                    break
+                moved += 1
+        return moved
+
+    def start(self, mem_size=None, interval=DEFRAG_INTERVAL):
+        """
+        Defragment the memory in the background, one move each interval (in seconds).
+        The moves are planned again before each move, so that the tasks can change in between.
+        """
+        if self.running:
+            print("Defragmentation is already running.")
+            return False
+        self.stop_event.clear()
+        self.worker = threading.Thread(target=self._run, args=(mem_size, interval), daemon=True)
+        self.worker.start()
+        return True
+
+    def stop(self):
+        """
+        Stop the background defragmentation, the move in progress is finished.
+        """
+        self.stop_event.set()
+
+    @property
+    def running(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def _run(self, mem_size, interval):
+        while not self.stop_event.is_set():
+            with self.lock:
+                if self.stop_event.is_set():
+                    break
+                moves = self.plan(mem_size)
+                if len(moves) == 0 or not self.migrate(moves[0]):
+                    break
+                if self.journal is not None:
+                    self.journal.save(self.task_manager, self.resource_manager)
+            self.stop_event.wait(interval)
@@ -1,8 +1,9 @@
 # -*- coding:UTF-8 -*-
 from __future__ import print_function 
+import copy
 import math
+import heapq
 from flymonlib.resource import *
-from flymonlib.utils import PerfectBinaryTree
 from flymonlib.flow_key import FlowKey
 
 class MemoryType(Enum):
@@ -15,28 +16,93 @@ class MemoryType(Enum):
     EIGHTH      = 4      #  1/8
     SIXTEENTH   = 5      #  1/16
     THIRTY      = 6      #  1/32
+    SIXTYFOURTH = 7      #  1/64
+    ONETWENTYEIGHTH = 8  #  1/128
+    TWOFIFTYSIXTH   = 9  #  1/256
+    FIVETWELFTH     = 10 #  1/512
+    THOUSANDTH      = 11 #  1/1024
 
-MAX_DIV = 32
+MAX_DIV = 1024
 
 class CMU:
     """
-    A register memory in FlyMon is mananged by a binary tree.
+    A register memory in FlyMon is mananged by a buddy allocator.
+    A memory block is identified by (type, idx):
+        - type is 1,2,3,..., the block holds 1/2**(type-1) of the memory.
+        - idx is offset on the type of memory, for example, if the type is 2(HALF), the idx should be 0 or 1.
+    Blocks are kept in an array of a perfect binary tree (the block (type, idx) is node 2**(type-1)-1+idx),
+    and the free blocks of each type are kept in a min-heap, so that allocate and release are O(log n).
     """
     def __init__(self, max_div=MAX_DIV):
         """
-        max_div is the maximum memory divisions of a CMU, 32 is the default.
-        """
-        self.max_type = int(math.log(max_div, 2)) # maximum divisions : 2**types
-        self.mem_tree = PerfectBinaryTree()
-        for i in range(self.max_type + 1):
-            for j in range(2**i):
-                # (type, type_idx/mem_idx, task_id)
-                #  - type is 1,2,3,...,MIX_DIV
-                #  - mem_idx is offset on the type of memory, for example ,if the type is 2(HALF), the mem_idx should be 1 or 2.
-                #  - task_id, who uses this memory block?
-                self.mem_tree.append([i+1, j, 0]) 
-               
-    
+        max_div is the maximum memory divisions of a CMU, 1024 is the default.
+        """
+        self.max_type = int(math.log(max_div, 2)) + 1 # the smallest block holds 1/max_div of the memory.
+        node_num = 2**self.max_type - 1
+        self.is_free = [False] * node_num
+        self.owner = [0] * node_num  # who uses this memory block? 0 for none.
+        self.free_lists = [[] for _ in range(self.max_type + 1)] # type -> heap of idx (entries of used blocks are skipped lazily).
+        self.task_blocks = {
+            # key : task_id
+            # val : list of (type, idx)
+        }
+        self._push_free(1, 0)
+
+    def _node(self, type, idx):
+        return 2**(type-1) - 1 + idx
+
+    def _push_free(self, type, idx):
+        self.is_free[self._node(type, idx)] = True
+        heapq.heappush(self.free_lists[type], idx)
+
+    def _pop_free(self, type):
+        """
+        Pop the free block with the lowest address of a type, None if there is no one.
+        """
+        free_list = self.free_lists[type]
+        while len(free_list) != 0:
+            idx = heapq.heappop(free_list)
+            if self.is_free[self._node(type, idx)]:
+                self.is_free[self._node(type, idx)] = False
+                return idx
+        return None
+
+    def fork(self):
+        """
+        A copy of the memory status.
+        """
+        forked = copy.copy(self)
+        forked.is_free = self.is_free[:]
+        forked.owner = self.owner[:]
+        forked.free_lists = [free_list[:] for free_list in self.free_lists]
+        forked.task_blocks = {task_id : blocks[:] for task_id, blocks in self.task_blocks.items()}
+        return forked
+
+    def largest_free_type(self):
+        """
+        The type of the largest free block, None if the memory is full.
+        """
+        for type in range(1, self.max_type + 1):
+            free_list = self.free_lists[type]
+            # Drop the entries of used blocks.
+            while len(free_list) != 0 and not self.is_free[self._node(type, free_list[0])]:
+                heapq.heappop(free_list)
+            if len(free_list) != 0:
+                return type
+        return None
+
+    def smallest_free_type(self, type):
+        """
+        The type of the smallest free block which can hold a block of the type, None if there is no one.
+        """
+        for block_type in range(type, 0, -1):
+            free_list = self.free_lists[block_type]
+            while len(free_list) != 0 and not self.is_free[self._node(block_type, free_list[0])]:
+                heapq.heappop(free_list)
+            if len(free_list) != 0:
+                return block_type
+        return None
+
     def alloc_memory(self, type, task_id):
         """
         Allocate memory for task_id with memory type.
@@ -47,54 +113,172 @@ class CMU:
         when call the `show_memory()'
         -------------------------------------------------------------
         Input: Memory Type Enum, and Task ID (Type is always right). 
-        Output: Memory Idx based on the input memory type.
-        """
-        root = self.mem_tree.root()
-        nodes = self.mem_tree.inorderTraversal(root)
-        for node in nodes:
-            # Z the node's size suitable and the node is available
-            if node.data[0] == type and node.data[2] == 0:
-                sub_nodes = self.mem_tree.inorderTraversal(node)
-                is_ok = True
-                # Z check if all the subnode is available
-                for snode in sub_nodes:
-                    if snode.data[2] != 0:
-                        is_ok = False
-                if is_ok:
-                    for snode in sub_nodes:
-                        snode.data[2] = task_id
-                    return node.data[1]
-        return 0
+        Output: Memory Idx based on the input memory type, or None (no enough memory).
+        """
+        if type < 1 or type > self.max_type:
+            return None
+        # Find the smallest free block which is large enough.
+        block_type = type
+        idx = self._pop_free(block_type)
+        while idx is None and block_type > 1:
+            block_type -= 1
+            idx = self._pop_free(block_type)
+        if idx is None:
+            return None
+        # Split it down to the required type, the right halves become free.
+        while block_type < type:
+            block_type += 1
+            idx = idx * 2
+            self._push_free(block_type, idx + 1)
+        self.owner[self._node(type, idx)] = task_id
+        self.task_blocks.setdefault(task_id, []).append((type, idx))
+        return idx
     
     def release_memory(self, task_id):
         """ Release the memory of a given task_id.
         Args:
             task_id: measurement task_id.
         Returns:
-            True/False: is there a memory for the task_id?
+            A list of released memory types (empty if there is no memory for the task_id).
+        """
+        released = []
+        for type, idx in self.task_blocks.pop(task_id, []):
+            self._free_block(type, idx)
+            released.append(type)
+        return released
+
+    def _free_block(self, type, idx):
+        """
+        Free a used block and merge it with the free buddies.
+        """
+        self.owner[self._node(type, idx)] = 0
+        while type > 1 and self.is_free[self._node(type, idx ^ 1)]:
+            self.is_free[self._node(type, idx ^ 1)] = False
+            type -= 1
+            idx = idx // 2
+        self._push_free(type, idx)
+
+    def _claim_block(self, type, idx):
+        """
+        Take the block (type, idx) if it is inside a free block, the free block is split down to it.
+        Returns:
+            True or False (the block is not free).
+        """
+        for block_type in range(type, 0, -1):
+            block_idx = idx >> (type - block_type)
+            if self.is_free[self._node(block_type, block_idx)]:
+                break
+        else:
+            return False
+        self.is_free[self._node(block_type, block_idx)] = False
+        # Split it down to the block, the siblings on the way become free.
+        while block_type < type:
+            block_type += 1
+            block_idx = idx >> (type - block_type)
+            self._push_free(block_type, block_idx ^ 1)
+        return True
+
+    def move_memory(self, task_id, type, idx, new_idx):
+        """ Move a used block of task_id to a free block of the same type.
+        Args:
+            type, idx: the used block.
+            new_idx: offset of the new block on the type of memory.
+        Returns:
+            True or False (the block is not used by the task, or the new block is not free).
         """
-        re = False
-        root = self.mem_tree.root()
-        nodes = self.mem_tree.inorderTraversal(root)
-        for node in nodes:
-            if node.data[1] == task_id:
-                node.data[1] = 0
-                re = True
-        return re
+        blocks = self.task_blocks.get(task_id, [])
+        if (type, idx) not in blocks or not self._claim_block(type, new_idx):
+            return False
+        self.owner[self._node(type, new_idx)] = task_id
+        blocks[blocks.index((type, idx))] = (type, new_idx)
+        self._free_block(type, idx)
+        return True
+
+    def _blocks_in(self, type, idx):
+        """
+        Used blocks inside the block (type, idx), a list of (task_id, type, idx).
+        """
+        blocks = []
+        for task_id, task_blocks in self.task_blocks.items():
+            for block_type, block_idx in task_blocks:
+                if block_type >= type and block_idx >> (block_type - type) == idx:
+                    blocks.append((task_id, block_type, block_idx))
+        return blocks
+
+    def defrag_moves(self, target_type=None):
+        """ Plan the block moves which compact the memory, nothing is changed.
+        While two free blocks of a type are not buddies, the used blocks next to one of them (in its buddy)
+        are moved into the other one with the same layout, so that the free block merges with its buddy.
+        The buddy holding the least used memory is moved each time.
+        Args:
+            target_type: stop once there is a free block of the type (or larger), None to compact the whole memory.
+        Returns:
+            A list of moves in order, each one is (task_id, type, idx, new_idx).
+        """
+        moves = []
+        cmu = self.fork()
+        for type in range(self.max_type, 1, -1):
+            while True:
+                largest_type = cmu.largest_free_type()
+                if target_type is not None and largest_type is not None and largest_type <= target_type:
+                    return moves
+                free_blocks = [idx for idx in range(2**(type-1)) if cmu.is_free[cmu._node(type, idx)]]
+                if len(free_blocks) < 2:
+                    break
+                costs = []
+                for idx in free_blocks:
+                    blocks = cmu._blocks_in(type, idx ^ 1)
+                    costs.append((sum(2**(self.max_type - block_type) for _, block_type, _ in blocks), idx, blocks))
+                _, src, blocks = min(costs, key=lambda x: x[:2])
+                dst = free_blocks[0] if free_blocks[0] != src else free_blocks[1]
+                buddy = src ^ 1
+                for task_id, block_type, block_idx in blocks:
+                    shift = block_type - type
+                    new_idx = (dst << shift) + block_idx - (buddy << shift)
+                    cmu.move_memory(task_id, block_type, block_idx, new_idx)
+                    moves.append((task_id, block_type, block_idx, new_idx))
+        return moves
+
+    def rename_task(self, task_id, new_id):
+        """
+        Hand the blocks of task_id over to new_id.
+        """
+        blocks = self.task_blocks.pop(task_id, [])
+        for type, idx in blocks:
+            self.owner[self._node(type, idx)] = new_id
+        if len(blocks) != 0:
+            self.task_blocks.setdefault(new_id, []).extend(blocks)
+
+    def dump_state(self):
+        """
+        The allocated blocks, a dict of task_id -> [[type, idx]].
+        """
+        return {task_id : [list(block) for block in blocks] for task_id, blocks in self.task_blocks.items()}
+
+    def load_state(self, state):
+        """
+        Rebuild the memory status from the allocated blocks (see dump_state()).
+        """
+        self.__init__(2**(self.max_type-1))
+        for task_id, blocks in state.items():
+            for type, idx in blocks:
+                self._claim_block(type, idx)
+                self.owner[self._node(type, idx)] = int(task_id)
+                self.task_blocks.setdefault(int(task_id), []).append((type, idx))
 
     def show_memory(self):
         """
         Show the memory in line style. There are 'max_div' parts, 
         where a running task are tagged.
         """
-        root = self.mem_tree.root()
-        nodes = self.mem_tree.inorderTraversal(root)
-        leaf_nodes = []
-        for node in nodes:
-            if node.data[0] == self.max_type:
-                leaf_nodes.append(node)
-        for node in leaf_nodes:
-            print("|{:^4}".format(node.data[1]), end = '')
+        parts = [0] * 2**(self.max_type-1)
+        for task_id, blocks in self.task_blocks.items():
+            for type, idx in blocks:
+                width = 2**(self.max_type - type)
+                for part in range(idx * width, (idx + 1) * width):
+                    parts[part] = task_id
+        for task_id in parts:
+            print("|{:^4}".format(task_id), end = '')
         print('|')
 
 
@@ -134,8 +318,87 @@ class CMU_Group():
                                       [Resource(ResourceType.CompressedKey, FlowKey(candidate_key_list)), 16, []] ] 
         
         ## CMU and Memory Resources.
-        self._cmus = [[CMU(), self._memory_size] for i in range(self._cmu_num)]  # Currently we only support 32 divisions.
+        # A memory block holds at least one bucket.
+        self._max_div = min(MAX_DIV, self._memory_size)
+        self._cmus = [[CMU(self._max_div), self._memory_size] for i in range(self._cmu_num)]
+        # Copy-on-write status of a fork: CMUs (by index) and compressed keys still shared with the origin.
+        self._shared_cmus = set()
+        self._shared_keys = False
+        # Tasks using the XOR of hash units 1 and 2 (hkey 12).
+        self._xor_tasks = []
         pass
+
+    def fork(self):
+        """
+        A copy-on-write copy of the CMU-Group, used to try allocations without changing this one.
+        The CMUs and compressed keys are copied when the fork first changes them,
+        so the fork is only valid before this CMU-Group changes.
+        """
+        forked = copy.copy(self)
+        forked._cmus = [[cmu, rest_mem] for cmu, rest_mem in self._cmus]
+        forked._shared_cmus = set(range(self._cmu_num))
+        forked._shared_keys = True
+        return forked
+
+    def _own_cmu(self, idx):
+        if idx in self._shared_cmus:
+            self._cmus[idx][0] = self._cmus[idx][0].fork()
+            self._shared_cmus.remove(idx)
+
+    def _own_keys(self):
+        if self._shared_keys:
+            compressed_keys = []
+            for resource, bitw, tasks in self._compressed_keys:
+                flow_key = copy.copy(resource.content)
+                flow_key.key_list = dict(resource.content.key_list)
+                compressed_keys.append([Resource(ResourceType.CompressedKey, flow_key), bitw, tasks[:]])
+            self._compressed_keys = compressed_keys
+            self._xor_tasks = self._xor_tasks[:]
+            self._shared_keys = False
+
+    def dump_state(self):
+        """
+        The allocation status of the CMU-Group as plain data (e.g., for a journal).
+        """
+        compressed_keys = []
+        for resource, _, tasks in self._compressed_keys:
+            key_list = {name : prefix for name, (_, prefix) in resource.content.key_list.items() if prefix != 0}
+            compressed_keys.append([key_list, tasks[:]])
+        return {
+            "compressed_keys" : compressed_keys,
+            "xor_tasks"       : self._xor_tasks[:],
+            "cmus"            : [cmu.dump_state() for cmu, _ in self._cmus]
+        }
+
+    def load_state(self, state):
+        """
+        Restore the allocation status from dump_state().
+        """
+        self._own_keys()
+        for (resource, _, tasks), (key_list, task_list) in zip(self._compressed_keys, state["compressed_keys"]):
+            resource.content.reset()
+            for name, prefix in key_list.items():
+                resource.content.set_mask(name, prefix)
+            tasks[:] = task_list
+        self._xor_tasks = state["xor_tasks"][:]
+        for idx, blocks in enumerate(state["cmus"]):
+            self._own_cmu(idx)
+            self._cmus[idx][0].load_state(blocks)
+            used = sum(int(self._memory_size/2**(type-1)) for task_blocks in blocks.values() for type, _ in task_blocks)
+            self._cmus[idx][1] = self._memory_size - used
+
+    def rest_memory(self, cmu_id):
+        return self._cmus[cmu_id - 1][1]
+
+    def fragmentation(self, cmu_id):
+        """
+        External fragmentation of a CMU: 1 - largest free block / rest memory.
+        """
+        cmu, rest_mem = self._cmus[cmu_id - 1]
+        largest_type = cmu.largest_free_type()
+        if largest_type is None or rest_mem == 0:
+            return 0.0
+        return 1 - (self._memory_size / 2**(largest_type-1)) / rest_mem
         
     @property
     def cmu_num(self):
@@ -165,7 +428,9 @@ class CMU_Group():
             if str(ck[0].content) == "":
                 print("Compressed Key {} ({}b): Empty".format(idx+1, ck[1]))
             else:
-                print("Compressed Key {} ({}b): {}".format(idx+1, ck[1], str(ck[0].content)))
+                print("Compressed Key {} ({}b): {} (used {} times)".format(idx+1, ck[1], str(ck[0].content), len(ck[2])))
+        served, units, xor = self.key_reuse()
+        print("Hash Reuse: {} keys on {} units ({} by XOR of units 1 and 2)".format(served, units, xor))
         print('-'*LINE_LEN)
         for idx, (cmu, rest_mem) in enumerate(self._cmus):
             print("CMU-{} Rest Memory: {}".format(idx+1, rest_mem))
@@ -185,48 +450,96 @@ class CMU_Group():
                 return False
         return True
 
-    def allocate_compressed_keys(self, task_id, required_key_list):
+    def allocate_compressed_keys(self, task_id, required_key_list, allow_xor=False):
         """
         The required_key should be a flow_key object.
+        Hash results are reused as much as possible, for each required key:
+            1. a hash unit already configured with the key.
+            2. the XOR (hkey 12) of hash units 1 and 2 (group type 1 only, if allow_xor), when both are configured with
+               the key, or with disjoint parts of it (e.g., hdr.ipv4.src_addr and hdr.ipv4.dst_addr for the pair of them).
+            3. a free hash unit.
+        allow_xor: the XOR key only has actions with const param1 (see set_cmuX_hkey12_cparam).
         TODO: need to consider bit size of key (for measurement accuracy reason)
         """
+        self._own_keys()
         hkey_list = []
         for required_key in required_key_list:
-            ok = False
-            for idx in range(len(self._compressed_keys)):
-                task_list = self._compressed_keys[idx][2]
-                if len(task_list) != 0:
-                    # Priority is given to those already in use
-                    # The key as already be allocated.
-                    if self._compressed_keys[idx][1] == 32 and self._compressed_keys[idx][0] == required_key:
-                        # If the CMU-Group is located in Egress Pipeline
-                        # Then the hash bits should be reused.
-                        if task_id not in self._compressed_keys[idx][2]:
-                            self._compressed_keys[idx][2].append(task_id)
-                        hkey_list.append(idx+1)
-                        ok = True
-                        break
-                    elif self._compressed_keys[idx][1] == 16 and self._compressed_keys[idx][0] == required_key and task_id not in task_list:
-                        ok = True
+            hkey = self._reuse_compressed_key(task_id, required_key)
+            if hkey is None and allow_xor and 12 not in hkey_list and self._xor_derivable(required_key):
+                # Both units keep the task, so that they are not reset while it uses the XOR.
+                self._compressed_keys[0][2].append(task_id)
+                self._compressed_keys[1][2].append(task_id)
+                self._xor_tasks.append(task_id)
+                hkey = 12
+            if hkey is None:
+                for idx in range(len(self._compressed_keys)):
+                    if len(self._compressed_keys[idx][2]) == 0:
                         self._compressed_keys[idx][2].append(task_id)
-                        hkey_list.append(idx+1)
+                        self._compressed_keys[idx][0].content.set(required_key.content)
+                        hkey = idx + 1
                         break
-                    else:
-                        pass
-                else:
-                    self._compressed_keys[idx][2].append(task_id)
-                    hkey_list.append(idx+1)
-                    self._compressed_keys[idx][0].content.set(required_key.content)
-                    ok = True
-                    break
-            if not ok:
-                # TODO: support XOR in Ingress Pipeline Here
-                # # return back
-                # print("Here!!!!!!!!!!!!!!!!")
+            if hkey is None:
                 self.release_compressed_keys(task_id, hkey_list)
                 return None
+            hkey_list.append(hkey)
         return hkey_list
 
+    def _reuse_compressed_key(self, task_id, required_key):
+        """
+        Returns:
+            the id of a hash unit already configured with the key (which can be used by the task), or None.
+        """
+        for idx in range(len(self._compressed_keys)):
+            task_list = self._compressed_keys[idx][2]
+            if len(task_list) == 0 or not self._compressed_keys[idx][0] == required_key:
+                continue
+            if self._compressed_keys[idx][1] == 32:
+                # If the CMU-Group is located in Egress Pipeline
+                # Then the hash bits should be reused.
+                if task_id not in task_list:
+                    task_list.append(task_id)
+                return idx + 1
+            elif task_id not in task_list:
+                task_list.append(task_id)
+                return idx + 1
+        return None
+
+    def _xor_derivable(self, required_key):
+        """
+        If the hash of the key can be derived by the XOR of hash units 1 and 2.
+        """
+        if self._group_type != 1 or len(self._compressed_keys[0][2]) == 0 or len(self._compressed_keys[1][2]) == 0:
+            return False
+        key = required_key.content
+        key1 = self._compressed_keys[0][0].content
+        key2 = self._compressed_keys[1][0].content
+        if key == key1 and key == key2:
+            # Two different hashes of the same key.
+            return True
+        for name, (_, prefix) in key.key_list.items():
+            prefix1 = key1.key_list[name][1]
+            prefix2 = key2.key_list[name][1]
+            if not ((prefix1 == prefix and prefix2 == 0) or (prefix2 == prefix and prefix1 == 0)):
+                return False
+        return True
+
+    def compressed_key(self, hkey):
+        """
+        The flow key of a hash unit.
+        """
+        return self._compressed_keys[hkey - 1][0].content
+
+    def key_reuse(self):
+        """
+        Reuse of the hash units.
+        Returns:
+            (the number of keys served, the number of hash units in use, the number of keys served by the XOR).
+        """
+        units = [tasks for _, _, tasks in self._compressed_keys if len(tasks) != 0]
+        # A task using the XOR is kept by both units 1 and 2.
+        served = sum(len(tasks) for tasks in units) - len(self._xor_tasks)
+        return served, len(units), len(self._xor_tasks)
+
     def allocate_memory(self, cmu_id, task_id, mem_size, mode=1):
         """ Try to allocate memory for a specific task.
         Args:
@@ -241,49 +554,129 @@ class CMU_Group():
         mode=1 : accurate.
         mode=2 : efficient.
         """
-        if mem_size > self._memory_size: 
+        if mem_size <= 0 or mem_size > self._memory_size: 
             print("Invalid memory size : {}".format(mem_size))
             return None
         memory_type = int(math.log2(self._memory_size / mem_size)) + 1
         if memory_type < 1:
             print(f"No enough memory, allocated as the max : {self._memory_size}")
             memory_type = 1
-        if memory_type > MAX_DIV:
-            print(f"Too small memory, allocated as the min : {int(self._memory_size/MAX_DIV)}")
-            memory_type = MAX_DIV
+        if memory_type > int(math.log2(self._max_div)) + 1:
+            print(f"Too small memory, allocated as the min : {int(self._memory_size/self._max_div)}")
+            memory_type = int(math.log2(self._max_div)) + 1
         if mode == 2:
             # TODO: need to implement a simple efficient mode.
             pass
         id = cmu_id - 1
-        cmu = self._cmus[id][0]
         if self._cmus[id][1] < mem_size:
             return None
+        self._own_cmu(id)
+        cmu = self._cmus[id][0]
         memory_idx = cmu.alloc_memory(memory_type, task_id)
-        if memory_idx >= 0:
-            self._cmus[id][1] = self._cmus[id][1] - int(self._memory_size/memory_type)
+        if memory_idx is not None:
+            self._cmus[id][1] = self._cmus[id][1] - int(self._memory_size/2**(memory_type-1))
             return memory_type, memory_idx
         return None
 
+    def best_fit_cmus(self, mem_sizes, excluded_cmus=()):
+        """ Best-fit placement of memory rows, each row in a different CMU.
+        Args:
+            - mem_sizes: memory size of each row.
+            - excluded_cmus: ids of the CMUs not to use.
+        Returns:
+            ([cmu_id of each row], waste) Or None (no enough memory).
+            - waste counts the free memory blocks split by the placement, in the smallest blocks.
+        """
+        if len(mem_sizes) > self._cmu_num:
+            return None
+        max_type = int(math.log2(self._max_div)) + 1
+        cmu_ids = [None] * len(mem_sizes)
+        waste = 0
+        # Place the larger rows first.
+        for row in sorted(range(len(mem_sizes)), key=lambda r: -mem_sizes[r]):
+            if mem_sizes[row] <= 0 or mem_sizes[row] > self._memory_size:
+                return None
+            memory_type = min(int(math.log2(self._memory_size / mem_sizes[row])) + 1, max_type)
+            best = None
+            for idx, (cmu, rest_mem) in enumerate(self._cmus):
+                if idx + 1 in cmu_ids or idx + 1 in excluded_cmus or rest_mem < mem_sizes[row]:
+                    continue
+                block_type = cmu.smallest_free_type(memory_type)
+                if block_type is None:
+                    continue
+                score = (2**(max_type - block_type) - 2**(max_type - memory_type), rest_mem)
+                if best is None or score < best[0]:
+                    best = (score, idx + 1)
+            if best is None:
+                return None
+            cmu_ids[row] = best[1]
+            waste += best[0][0]
+        return cmu_ids, waste
+
+    def plan_defrag(self, cmu_id, mem_size=None):
+        """ Plan the block moves which compact the memory of a CMU, nothing is changed.
+        Args:
+            - mem_size: stop once a block of the size is free, None to compact the whole memory.
+        Returns:
+            A list of moves in order, each one is (task_id, memory_type, memory_idx, new_idx).
+        """
+        target_type = None
+        if mem_size is not None:
+            target_type = int(math.log2(self._memory_size / min(mem_size, self._memory_size))) + 1
+            target_type = min(target_type, int(math.log2(self._max_div)) + 1)
+        return self._cmus[cmu_id - 1][0].defrag_moves(target_type)
+
+    def move_memory(self, cmu_id, task_id, memory_type, memory_idx, new_idx):
+        """ Move a memory block of a task to a free block of the same type in the CMU.
+        Returns:
+            True or False (nothing is changed).
+        """
+        self._own_cmu(cmu_id - 1)
+        return self._cmus[cmu_id - 1][0].move_memory(task_id, memory_type, memory_idx, new_idx)
+
     def release_memory(self, task_id, memory_type):
         """
-        Release memory for task_id.
+        Release memory for task_id (in all CMUs).
         """
         for idx in range(len(self._cmus)):
-            re = self._cmus[idx][0].release_memory(task_id)
-            if re:
-                self._cmus[idx][1] += int(self._memory_size/memory_type)
+            if idx in self._shared_cmus and task_id not in self._cmus[idx][0].task_blocks:
+                continue
+            self._own_cmu(idx)
+            for released_type in self._cmus[idx][0].release_memory(task_id):
+                self._cmus[idx][1] += int(self._memory_size/2**(released_type-1))
         pass
 
+    def rename_task(self, task_id, new_id):
+        """
+        Hand the compressed keys and the memory of task_id over to new_id.
+        """
+        self._own_keys()
+        for task_list in [tasks for _, _, tasks in self._compressed_keys] + [self._xor_tasks]:
+            # A task is listed once more for each XOR key it uses.
+            task_list[:] = [new_id if id == task_id else id for id in task_list]
+        for idx in range(len(self._cmus)):
+            if task_id in self._cmus[idx][0].task_blocks:
+                self._own_cmu(idx)
+                self._cmus[idx][0].rename_task(task_id, new_id)
+
     def release_compressed_keys(self, task_id, hkeys):
         """
         Release compressed keys.
         """
         if hkeys is None:
             return 
+        self._own_keys()
         for hkey in hkeys:
-            idx = hkey - 1
-            if task_id not in self._compressed_keys[idx][2]:
-                continue
-            self._compressed_keys[idx][2].remove(task_id)
-            if len(self._compressed_keys[idx][2]) == 0:
-                self._compressed_keys[idx][0].content.reset()
\ No newline at end of file
+            if hkey == 12:
+                if task_id not in self._xor_tasks:
+                    continue
+                self._xor_tasks.remove(task_id)
+                idx_list = [0, 1]
+            else:
+                idx_list = [hkey - 1]
+            for idx in idx_list:
+                if task_id not in self._compressed_keys[idx][2]:
+                    continue
+                self._compressed_keys[idx][2].remove(task_id)
+                if len(self._compressed_keys[idx][2]) == 0:
+                    self._compressed_keys[idx][0].content.reset()
\ No newline at end of file
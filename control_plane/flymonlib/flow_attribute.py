@@ -3,7 +3,52 @@ from flymonlib.resource import Resource, ResourceType
 from flymonlib.operation import *
 from flymonlib.param import *
 from flymonlib.utils import *
-from math import pow, log2
+import numpy as np
+
+# Leading-one ranks of all the 16-bit HyperLogLog buckets, rank = leading ones + 1 (at most 16).
+# An empty bucket (0) has rank 0.
+_values = np.arange(1 << 16, dtype=np.int64)
+_inverted = (~_values) & 0xFFFF
+_bit_length = np.zeros(1 << 16, dtype=np.int64)
+_bit_length[_inverted > 0] = np.floor(np.log2(_inverted[_inverted > 0])).astype(np.int64) + 1
+HLL_RANKS = np.minimum(16 - _bit_length + 1, 16).astype(np.uint8)
+HLL_RANKS[0] = 0
+# 2^(-rank) of all the 16-bit buckets.
+HLL_INV_POW = np.exp2(-HLL_RANKS.astype(np.float64))
+del _values, _inverted, _bit_length
+
+# Size of the hash space, used by the large range correction.
+HLL_HASH_SPACE = float(1 << 32)
+
+
+def hll_alpha(m):
+    if m <= 16:
+        return 0.673
+    if m <= 32:
+        return 0.697
+    if m <= 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+def hll_estimate(registers):
+    """ HyperLogLog estimation of one or more sketches.
+    Args:
+        registers: a numpy.uint16 array, 1-D for a sketch or 2-D (one row for each sketch of the same size).
+    Returns:
+        a numpy.int64 array of the estimates, one for each sketch.
+    """
+    registers = np.atleast_2d(np.asarray(registers, dtype=np.uint16))
+    m = registers.shape[1]
+    E = hll_alpha(m) * m * m / HLL_INV_POW[registers].sum(axis=1)
+    # Small range correction: linear counting on the empty buckets.
+    V = np.count_nonzero(registers == 0, axis=1)
+    small = (E <= 2.5 * m) & (V > 0)
+    E = np.where(small, m * np.log(m / np.maximum(V, 1)), E)
+    # Large range correction.
+    large = E > HLL_HASH_SPACE / 30
+    E = np.where(large, -HLL_HASH_SPACE * np.log(1 - np.minimum(E / HLL_HASH_SPACE, 1 - 1e-12)), E)
+    return E.astype(np.int64)
 
 class AttributeType(Enum):
     """
@@ -35,6 +80,34 @@ class FlowAttribute():
         """ Parse attribute data.
         """
         return 0 # To be implemented by concreate attribute class.
+
+    def analyze_keys(self, datas):
+        """ Parse attribute data of many flow keys.
+            datas: a 2-D array, one row for each location and one column for each key.
+        Returns:
+            a numpy array of the results, one for each key.
+        """
+        return np.array([self.analyze(list(column)) for column in np.asarray(datas).T])
+
+    def merge(self, datas_list):
+        """ Merge the data of a task from many epochs, pipes or switches into one, so that it is analyzed once.
+            datas_list: a list of task data with the same memory layout (a list of data arrays, one for each location).
+        Returns:
+            the merged task data.
+        """
+        return [self.merge_rows(np.stack([np.asarray(datas[idx]) for datas in datas_list]))
+                    for idx in range(len(datas_list[0]))]
+
+    def merge_rows(self, rows):
+        """ Merge the data of a location as the operation updates a bucket:
+        added for CondADD (without the bound of a bucket), max for Max and or for AndOr.
+            rows: a 2-D array, one row for each data to merge.
+        """
+        if self.operation == OperationType.CondADD:
+            return rows.sum(axis=0, dtype=np.int64)
+        elif self.operation == OperationType.Max:
+            return rows.max(axis=0)
+        return np.bitwise_or.reduce(rows, axis=0)
     
     @property
     def type(self):
@@ -69,7 +142,26 @@ class FlowAttribute():
         return "Unknown"
     
 
-class Frequency(FlowAttribute):
+class CounterQueries():
+    """
+    Queries of many flow keys on counter sketches (min over the rows), shared by Frequency and FrequencySuMax.
+    """
+    def analyze_keys(self, datas):
+        """ Parse attribute data of many flow keys.
+            datas: a 2-D array, one row for each location and one column for each key.
+        """
+        return np.asarray(datas).min(axis=0)
+
+    def analyze_changes(self, prev_datas, datas):
+        """ Estimate the change of many flow keys between two epochs.
+            prev_datas, datas: 2-D arrays of the two epochs, one row for each location and one column for each key.
+        A bucket delta is the change of the key plus the changes of the colliding keys, which can be
+        positive or negative, so the median of the rows is taken instead of the min.
+        """
+        return np.median(np.asarray(datas, dtype=np.int64) - np.asarray(prev_datas, dtype=np.int64), axis=0)
+
+
+class Frequency(CounterQueries, FlowAttribute):
     def __init__(self, param_str):
         """
         Implement the built-in algorithm: Count-Min Sketch.
@@ -112,7 +204,7 @@ class Frequency(FlowAttribute):
         return f"frequency({self.param1})"
 
 
-class FrequencySuMax(FlowAttribute):
+class FrequencySuMax(CounterQueries, FlowAttribute):
     def __init__(self, param_str):
         """
         Implement the built-in algorithm: SuMax.
@@ -187,36 +279,28 @@ class SleKeyDistinct(FlowAttribute):
         """ Parse attribute data.
             datas: is an list of data list.
         """
-        datas = datas[0]        
-        V = 0.0
-        dZ = 0.0
-        Z = 0.0   
-        E = 0.0
-        m = len(datas) * 1.0
-        for bits in datas:
-            if bits == 0:
-                V+=1
-            p = 16
-            for i in range(15, -1, -1):
-                bit = int(bits & (1<<i)) >> i
-                if bit == 0:
-                    p = (15 - i) + 1
-                    break
-            dZ += pow(2, -1*p) 
-        Z = 1.0 / dZ
-        E = 0.679 * pow(m, 2) * Z
-        E_star = 0.0
-        if E < 2.5*m:
-            if V != 0:
-                E_star = m * log2(m/V) 
-            else:
-                E_star = E
-        pow232 = pow(2, 32)
-        if E <= pow232/30:
-            E_star = E 
-        else: 
-            E_star = -1*pow232*log2(1-E/pow232)
-        return int(E_star)
+        return int(hll_estimate(datas[0])[0])
+
+    @staticmethod
+    def analyze_all(datas_list):
+        """ Parse the data of many HyperLogLog tasks at once.
+            datas_list: a list of task data (the same as the datas of analyze).
+        Returns:
+            a list of estimates, in the order of datas_list.
+        """
+        estimates = [0] * len(datas_list)
+        # Sketches of the same size are estimated together.
+        by_size = {
+            # key : sketch size
+            # val : list of indexes in datas_list
+        }
+        for idx, datas in enumerate(datas_list):
+            by_size.setdefault(len(datas[0]), []).append(idx)
+        for indexes in by_size.values():
+            results = hll_estimate(np.stack([np.asarray(datas_list[idx][0], dtype=np.uint16) for idx in indexes]))
+            for idx, result in zip(indexes, results):
+                estimates[idx] = int(result)
+        return estimates
 
     @property
     def operation(self):
@@ -305,6 +389,11 @@ class Existence(FlowAttribute):
             param_mapping[(param, mask_value)] = code
         return param_mapping
 
+    def merge_rows(self, rows):
+        """ A bucket holds the codes of the keys hashed into it, so the buckets are or-ed (as a BloomFilter).
+        """
+        return np.bitwise_or.reduce(rows, axis=0)
+
     @property
     def operation(self):
         return OperationType.Max
@@ -329,6 +418,12 @@ class Max(FlowAttribute):
         """
         return min(datas)
 
+    def analyze_keys(self, datas):
+        """ Parse attribute data of many flow keys.
+            datas: a 2-D array, one row for each location and one column for each key.
+        """
+        return np.asarray(datas).min(axis=0)
+
     @property
     def type(self):
         return AttributeType.Max
@@ -1,42 +1,525 @@
 # -*- coding:UTF-8 -*-
 import time
+import numpy as np
 from flymonlib.operation import OperationType
 from flymonlib.param import ParamType
-import bfrt_grpc.client as client
+try:
+    import bfrt_grpc.client as client
+except ImportError:
+    # bfrt_grpc is only needed when talking to a switch (see FlyMonRuntime_Sim for the offline backend).
+    client = None
+
+# Maximum register indexes carried by a single entry_get request.
+REGISTER_BATCH_SIZE = 4096
+# A range read covering at least this share of the register is served by read_all (a sync and a wildcard request).
+WHOLE_READ_RATIO = 0.5
+
+# Stages whose tables hold match-action rules (the others are hash configs and registers).
+RULE_STAGES = ['initialization', 'preprocessing', 'operation']
+
+# Table name (after the CMU-Group prefix) of each stage.
+#  - unit id is the dhash id for the compression stage, and cmu id for others.
+STAGE_TABLES = {
+    'algorithm'      : ".hash_unit{}.algorithm",
+    'configure'      : ".hash_unit{}.configure",
+    'initialization' : ".tbl_cmu{}_initialization",
+    'preprocessing'  : ".tbl_cmu{}_preprocessing",
+    'operation'      : ".tbl_cmu{}_operation",
+    'buckets'        : ".cmu{}_buckets",
+}
 
 class FlyMonRuntime_BfRt():
     """
     A reference implementation of CMU Runtime based on Barefoot Runtime and Tofino.
     """
-    def __init__(self, conn, context):
+    def __init__(self, conn, context, cmug_configs=[], interface=None):
         super(FlyMonRuntime_BfRt,self).__init__()
         self.conn = conn
         self.context = context
+        self.interface = interface
+        self.pending = None # Queued writes when in batch mode: [(table, op, key_list, data_list)]
+        self.pending_hash_status = None
         self.hash_status = {
             # Donot update the hash unit if the new configs are the same as before.
             # key : (group_id, dhash_id)
             # val : flow_key
         }
-        pass
+        self.prefixes = {
+            # key : group_id
+            # val : FlyMonIngress/Egress.cmu_group{group_id}
+        }
+        self.tables = {
+            # A flat index of resolved (and annotated) table handles.
+            # key : (group_id, unit_id, stage), stage in STAGE_TABLES.
+            # val : table handle
+        }
+        self.saved_lookups = 0
+        self.shadow = {
+            # The entries (and default entries) written to the switch, each write is diffed against it.
+            # Registers are data and not shadowed.
+            # key : table handle
+            # val : {entry id : (key, data, data id)}, entry id is None for the default entry.
+        }
+        self.staged = None
+        # The writes of a batch in flight, they are applied to the shadow only after the batch is confirmed.
+        # key : table handle
+        # val : (cleared, {entry id : (key, data, data id), or None if deleted})
+        self.register_tables = set()
+        self.skipped_writes = 0
+        self.register_keys = {
+            # key : (group_id, cmu_id, chunk), a chunk is the aligned indexes [chunk, chunk + 1) * REGISTER_BATCH_SIZE
+            # val : list of $REGISTER_INDEX key objects
+        }
+        self.zero_data = {
+            # key : (group_id, cmu_id)
+            # val : data object which resets a bucket
+        }
+        # Resolve all tables once, so that installing tasks need not look them up again.
+        for cmug in cmug_configs:
+            dhash_num = 3 if cmug["type"] == 1 else 2
+            for dhash_id in range(1, dhash_num + 1):
+                for stage in ['algorithm', 'configure']:
+                    self._resolve(cmug["id"], cmug["type"], dhash_id, stage)
+            for cmu_id in range(1, cmug["cmu_num"] + 1):
+                for stage in ['initialization', 'preprocessing', 'operation', 'buckets']:
+                    self._resolve(cmug["id"], cmug["type"], cmu_id, stage)
 
-    def setup_dhash(self, group_id, group_type, dhash_id, hasher):
-        hash_algorithm_table = ""
-        if group_type == 1:
-            hash_algorithm_table = self.context.table_get(f"FlyMonIngress.cmu_group{group_id}.hash_unit{dhash_id}.algorithm")
+    def prefix(self, group_id, group_type):
+        """
+        Name prefix of the CMU-Group, e.g., FlyMonIngress.cmu_group1
+        """
+        if group_id not in self.prefixes:
+            if group_type == 1:
+                self.prefixes[group_id] = f"FlyMonIngress.cmu_group{group_id}"
+            else:
+                self.prefixes[group_id] = f"FlyMonEgress.cmu_group{group_id}"
+        return self.prefixes[group_id]
+
+    def table(self, group_id, group_type, unit_id, stage):
+        """
+        Get a table handle from the cache.
+            unit_id: dhash id for the 'algorithm' and 'configure' stage, cmu id for others.
+        """
+        handle = self.tables.get((group_id, unit_id, stage))
+        if handle is None:
+            return self._resolve(group_id, group_type, unit_id, stage)
+        self.saved_lookups += 1
+        return handle
+
+    def _resolve(self, group_id, group_type, unit_id, stage):
+        handle = self.context.table_get(self.prefix(group_id, group_type) + STAGE_TABLES[stage].format(unit_id))
+        if stage == 'initialization':
+            handle.info.key_field_annotation_add("hdr.ipv4.src_addr", "ipv4") 
+            handle.info.key_field_annotation_add("hdr.ipv4.dst_addr", "ipv4")
+        if stage == 'buckets':
+            self.register_tables.add(handle)
+        self.tables[(group_id, unit_id, stage)] = handle
+        return handle
+
+    def cache_stats(self):
+        """
+        Returns:
+            a dict with the number of cached tables and the saved table lookups.
+        """
+        return {"tables": len(self.tables), "saved_lookups": self.saved_lookups}
+
+    def shadow_stats(self):
+        """
+        Returns:
+            a dict with the number of shadowed entries and the entry writes skipped as unchanged.
+        """
+        return {"entries": sum(len(entries) for entries in self.shadow.values()), "skipped_writes": self.skipped_writes}
+
+    def begin_batch(self):
+        """
+        Queue all following table writes until commit_batch() or abort_batch().
+        """
+        self.pending = []
+        self.pending_hash_status = dict(self.hash_status)
+
+    def commit_batch(self):
+        """
+        Send all queued writes in a single batched write request.
+        If the request fails, the entries touched by the batch are restored as they were (see _restore)
+        and the exception is re-raised.
+        """
+        pending = self.pending
+        hash_status = self.pending_hash_status
+        self.pending = None
+        self.pending_hash_status = None
+        if pending is None or len(pending) == 0:
+            return
+        try:
+            self._send_batch(pending)
+        except Exception as e:
+            self.hash_status = hash_status
+            raise e
+
+    def abort_batch(self):
+        """
+        Drop all queued writes, nothing has been sent to the switch.
+        """
+        if self.pending_hash_status is not None:
+            self.hash_status = self.pending_hash_status
+        self.pending = None
+        self.pending_hash_status = None
+
+    def begin_reconcile(self):
+        """
+        Queue all following table writes until reconcile_batch() or abort_batch().
+        """
+        self.begin_batch()
+
+    def reconcile_batch(self, cmug_configs):
+        """
+        Send the queued writes as a diff against the rule tables of the CMU-Groups (e.g., after a controller restart).
+            - queued entries missing in the switch are added, and those with different actions are modified.
+            - entries in the switch which are not queued are deleted.
+            - default entries (e.g., hash unit configs) are set unless they are in the shadow.
+        Each rule table is read once into the shadow, the registers are untouched.
+        Returns:
+            a dict with the number of added, modified, deleted and unchanged entries.
+        """
+        pending = self.pending or []
+        hash_status = self.pending_hash_status
+        self.pending = None
+        self.pending_hash_status = None
+        tables = []
+        for cmug in cmug_configs:
+            for cmu_id in range(1, cmug["cmu_num"] + 1):
+                for stage in RULE_STAGES:
+                    table = self.table(cmug["id"], cmug["type"], cmu_id, stage)
+                    self._load_shadow(table)
+                    tables.append(table)
+        # Queued entries which are installed with the same action are taken as written.
+        expected = set()
+        for table, op, key_list, data_list in pending:
+            if op != 'add':
+                continue
+            entries = self.shadow.setdefault(table, {})
+            for key, data in zip(key_list, data_list):
+                entry_id = self._entry_id(key)
+                expected.add((table, entry_id))
+                entry = entries.get(entry_id)
+                if entry is not None and self._same_data(data, entry[1]):
+                    entries[entry_id] = (key, data, self._data_id(data))
+        writes = pending[:]
+        for table in tables:
+            stale = [entry[0] for entry_id, entry in self.shadow[table].items()
+                        if entry_id is not None and (table, entry_id) not in expected]
+            if len(stale) != 0:
+                writes.append((table, 'del', stale, None))
+        try:
+            done = self._send_batch(writes)
+        except Exception as e:
+            self.hash_status = hash_status
+            raise e
+        stats = {"added": 0, "modified": 0, "deleted": 0}
+        for table, op, key_list, _ in done:
+            if op == 'add':
+                stats["added"] += len(key_list)
+            elif op == 'mod':
+                stats["modified"] += len(key_list)
+            elif op == 'del':
+                stats["deleted"] += len(key_list)
+        stats["unchanged"] = len(expected) - stats["added"] - stats["modified"]
+        return stats
+
+    def audit(self, repair=False):
+        """
+        Check the rule tables against the shadow, with one wildcard read (of the driver's copy) for each table.
+        Default entries are not read back, they are rewritten when they change.
+            repair: rewrite the inconsistent entries in one batch.
+        Returns:
+            a dict of table name -> {"missing": n, "extra": n, "different": n} for the inconsistent tables.
+        """
+        report = {}
+        writes = []
+        for (group_id, unit_id, stage), table in self.tables.items():
+            if stage not in RULE_STAGES:
+                continue
+            entries = {entry_id : entry for entry_id, entry in self.shadow.get(table, {}).items() if entry_id is not None}
+            installed = self._read_entries(table)
+            missing = [entry for entry_id, entry in entries.items() if entry_id not in installed]
+            extra = [entry for entry_id, entry in installed.items() if entry_id not in entries]
+            different = [entry for entry_id, entry in entries.items()
+                            if entry_id in installed and not self._same_data(entry[1], installed[entry_id][1])]
+            if len(missing) + len(extra) + len(different) == 0:
+                continue
+            report[self.prefix(group_id, None) + STAGE_TABLES[stage].format(unit_id)] = {
+                "missing" : len(missing), "extra" : len(extra), "different" : len(different)
+            }
+            if repair:
+                # Skip the diff, the shadow is right and the switch is not.
+                if len(missing) != 0:
+                    writes.append((table, 'add', [e[0] for e in missing], [e[1] for e in missing]))
+                if len(different) != 0:
+                    writes.append((table, 'mod', [e[0] for e in different], [e[1] for e in different]))
+                if len(extra) != 0:
+                    writes.append((table, 'del', [e[0] for e in extra], None))
+        if len(writes) != 0:
+            if self.interface is not None:
+                self.interface.begin_batch()
+            try:
+                for write in writes:
+                    self._send(*write)
+            finally:
+                if self.interface is not None:
+                    self.interface.end_batch()
+        return report
+
+    def _read_entries(self, table):
+        """
+        Returns:
+            the installed entries of a table, {entry id : (key, data)}.
+        """
+        return {self._entry_id(key) : (key, data) for data, key in table.entry_get(self.conn, None, {"from_hw": False})}
+
+    def _load_shadow(self, table):
+        """
+        Replace the shadow of a table with its installed entries, whose data ids are unknown.
+        """
+        entries = {entry_id : (key, data, None) for entry_id, (key, data) in self._read_entries(table).items()}
+        default = self.shadow.get(table, {}).get(None)
+        if default is not None:
+            entries[None] = default
+        self.shadow[table] = entries
+
+    def _entry_id(self, key):
+        """
+        A hashable id of a match key.
+        """
+        return tuple(sorted((name, str(value)) for name, value in key.to_dict().items()))
+
+    def _data_id(self, data):
+        """
+        A hashable id of an action (or a default entry).
+        """
+        return tuple(sorted((name, str(value)) for name, value in data.to_dict().items()))
+
+    def _same_data(self, expected, installed):
+        """
+        If the installed data holds all fields (and the action) of the expected one.
+        """
+        installed = installed.to_dict()
+        return all(str(installed.get(name)) == str(value) for name, value in expected.to_dict().items())
+
+    def _write(self, table, op, key_list, data_list=None):
+        """
+        Apply (or queue in batch mode) a write.
+            op: 'add', 'mod', 'del', 'clear' (delete all entries) or 'default' (set the default entry).
+        """
+        if self.pending is not None:
+            self.pending.append((table, op, key_list, data_list))
+            return
+        self._apply(table, op, key_list, data_list)
+
+    def _apply(self, table, op, key_list, data_list):
+        """
+        Send the part of a write which differs from the shadow (and the staged writes of the batch in flight).
+        Returns:
+            the sent writes.
+        """
+        writes = self._diff(table, op, key_list, data_list)
+        for write in writes:
+            self._send(*write)
+            self._record(*write)
+        return writes
+
+    def _diff(self, table, op, key_list, data_list):
+        """
+        Drop the unchanged entries of a write.
+        An 'add' of an existing entry with another action is kept, so that the switch rejects it.
+        """
+        if table in self.register_tables or op == 'clear':
+            return [(table, op, key_list, data_list)]
+        if op == 'default':
+            entry = self._lookup(table, None)
+            if entry is not None and entry[2] == self._data_id(data_list[0]):
+                self.skipped_writes += 1
+                return []
+            return [(table, op, key_list, data_list)]
+        if op == 'del':
+            keys = [key for key in key_list if self._lookup(table, self._entry_id(key)) is not None]
+            self.skipped_writes += len(key_list) - len(keys)
+            return [(table, 'del', keys, None)] if len(keys) != 0 else []
+        keys, datas = [], []
+        for key, data in zip(key_list, data_list):
+            entry = self._lookup(table, self._entry_id(key))
+            if entry is not None and entry[2] is not None and entry[2] == self._data_id(data):
+                self.skipped_writes += 1
+            else:
+                keys.append(key)
+                datas.append(data)
+        return [(table, op, keys, datas)] if len(keys) != 0 else []
+
+    def _lookup(self, table, entry_id):
+        """
+        The entry as it will be when the batch in flight is confirmed, None if there is none.
+        """
+        if self.staged is not None and table in self.staged:
+            cleared, entries = self.staged[table]
+            if entry_id in entries:
+                return entries[entry_id]
+            if cleared:
+                return None
+        return self.shadow.get(table, {}).get(entry_id)
+
+    def _record(self, table, op, key_list, data_list):
+        """
+        Apply a sent write to the shadow, or stage it until the batch in flight is confirmed.
+        """
+        if table in self.register_tables:
+            return
+        if self.staged is None:
+            entries = self.shadow.setdefault(table, {})
+        else:
+            if op == 'clear':
+                self.staged[table] = (True, {})
+            entries = self.staged.setdefault(table, (False, {}))[1]
+        if op == 'clear':
+            entries.clear()
+        elif op == 'default':
+            entries[None] = (None, data_list[0], self._data_id(data_list[0]))
+        elif op == 'del':
+            for key in key_list:
+                if self.staged is None:
+                    entries.pop(self._entry_id(key), None)
+                else:
+                    entries[self._entry_id(key)] = None
+        else:
+            for key, data in zip(key_list, data_list):
+                entries[self._entry_id(key)] = (key, data, self._data_id(data))
+
+    def _commit_staged(self):
+        """
+        Apply the staged writes of a confirmed batch to the shadow.
+        """
+        for table, (cleared, staged) in self.staged.items():
+            entries = self.shadow.setdefault(table, {})
+            if cleared:
+                entries.clear()
+            for entry_id, entry in staged.items():
+                if entry is None:
+                    entries.pop(entry_id, None)
+                else:
+                    entries[entry_id] = entry
+        self.staged = None
+
+    def _send(self, table, op, key_list, data_list):
+        if op == 'add':
+            table.entry_add(self.conn, key_list, data_list)
+        elif op == 'mod':
+            table.entry_mod(self.conn, key_list, data_list)
+        elif op == 'del':
+            table.entry_del(self.conn, key_list)
+        elif op == 'clear':
+            table.entry_del(self.conn)
         else:
-            hash_algorithm_table = self.context.table_get(f"FlyMonEgress.cmu_group{group_id}.hash_unit{dhash_id}.algorithm")
-        if (group_id, dhash_id) not in self.hash_status.keys():
-            data_algo = hash_algorithm_table.make_data([
-                                                client.DataTuple('msb', bool_val=False),
-                                                client.DataTuple('extend', bool_val=False),
-                                                client.DataTuple('polynomial', hasher.polynomial),
-                                                client.DataTuple('reverse', bool_val=hasher.is_reverse),
-                                                client.DataTuple('init', hasher.init_crc),
-                                                client.DataTuple('final_xor', hasher.final_xor),
-                                                client.DataTuple('hash_bit_width', hasher.bit_width)],
-                                            "user_defined")
-            hash_algorithm_table.default_entry_set(self.conn, data_algo)
-            # print(f"    [DHASH-{dhash_id}] : " + str(hasher))
+            table.default_entry_set(self.conn, data_list[0])
+
+    def _send_batch(self, writes):
+        """
+        Send writes in one batched request (if the gRPC interface is given).
+        The writes are staged and applied to the shadow only when the whole batch is confirmed.
+        Errors of a batched write only come back at its end, so if it fails the touched entries are restored
+        (see _restore) and the exception is re-raised.
+        Returns:
+            the sent writes.
+        """
+        sent = []
+        self.staged = {}
+        try:
+            if self.interface is not None:
+                self.interface.begin_batch()
+            try:
+                for write in writes:
+                    sent.extend(self._apply(*write))
+            finally:
+                if self.interface is not None:
+                    self.interface.end_batch()
+        except Exception as e:
+            self.staged = None
+            self._restore(sent)
+            raise e
+        self._commit_staged()
+        return sent
+
+    def _restore(self, sent):
+        """
+        Restore the entries touched by the writes of a failed batch as they are in the shadow (before the batch).
+        Which writes took effect is unknown, so each touched table is read back once and compared with the shadow:
+            - entries not in the shadow are deleted (they are added by the batch, not rejected ones of other owners).
+            - entries of the shadow which are missing or different are added or modified back.
+        Default entries are set again. If the restore fails too, the shadow is reloaded from the switch.
+        """
+        touched = {
+            # key : table handle
+            # val : entry ids touched by the batch
+        }
+        for table, op, key_list, data_list in sent:
+            if table in self.register_tables:
+                continue
+            entry_ids = touched.setdefault(table, set())
+            if op == 'clear':
+                entry_ids.update(entry_id for entry_id in self.shadow.get(table, {}) if entry_id is not None)
+            elif op == 'default':
+                entry_ids.add(None)
+            else:
+                entry_ids.update(self._entry_id(key) for key in key_list)
+        undo = []
+        for table, entry_ids in touched.items():
+            entries = self.shadow.get(table, {})
+            installed = self._read_entries(table) if any(entry_id is not None for entry_id in entry_ids) else {}
+            deleted, added, modified = [], [], []
+            for entry_id in entry_ids:
+                entry = entries.get(entry_id)
+                if entry_id is None:
+                    if entry is not None:
+                        undo.append((table, 'default', None, [entry[1]]))
+                elif entry is None:
+                    if entry_id in installed:
+                        deleted.append(installed[entry_id][0])
+                elif entry_id not in installed:
+                    added.append(entry)
+                elif not self._same_data(entry[1], installed[entry_id][1]):
+                    modified.append(entry)
+            if len(deleted) != 0:
+                undo.append((table, 'del', deleted, None))
+            if len(added) != 0:
+                undo.append((table, 'add', [e[0] for e in added], [e[1] for e in added]))
+            if len(modified) != 0:
+                undo.append((table, 'mod', [e[0] for e in modified], [e[1] for e in modified]))
+        if len(undo) == 0:
+            return
+        try:
+            if self.interface is not None:
+                self.interface.begin_batch()
+            try:
+                for write in undo:
+                    self._send(*write)
+            finally:
+                if self.interface is not None:
+                    self.interface.end_batch()
+        except Exception as e:
+            print(f"{e} when restoring the entries of a failed batch, reload them from the switch.")
+            for table in touched:
+                self._load_shadow(table)
+
+    def setup_dhash(self, group_id, group_type, dhash_id, hasher):
+        hash_algorithm_table = self.table(group_id, group_type, dhash_id, 'algorithm')
+        # Unchanged algorithms are not sent again (see _diff).
+        data_algo = hash_algorithm_table.make_data([
+                                            client.DataTuple('msb', bool_val=False),
+                                            client.DataTuple('extend', bool_val=False),
+                                            client.DataTuple('polynomial', hasher.polynomial),
+                                            client.DataTuple('reverse', bool_val=hasher.is_reverse),
+                                            client.DataTuple('init', hasher.init_crc),
+                                            client.DataTuple('final_xor', hasher.final_xor),
+                                            client.DataTuple('hash_bit_width', hasher.bit_width)],
+                                        "user_defined")
+        self._write(hash_algorithm_table, 'default', None, [data_algo])
+        # print(f"    [DHASH-{dhash_id}] : " + str(hasher))
 
     def compression_stage_config(self, group_id, group_type, dhash_id, flow_key):
         """
@@ -45,11 +528,7 @@ class FlyMonRuntime_BfRt():
             dhash_id: hash unit ID.
             flow_key: FlowKey object in utils/flow_key.py
         """
-        hash_configure_table = ""
-        if group_type == 1:
-            hash_configure_table = self.context.table_get(f"FlyMonIngress.cmu_group{group_id}.hash_unit{dhash_id}.configure")
-        else:
-            hash_configure_table = self.context.table_get(f"FlyMonEgress.cmu_group{group_id}.hash_unit{dhash_id}.configure")
+        hash_configure_table = self.table(group_id, group_type, dhash_id, 'configure')
         
         if (group_id, dhash_id) not in self.hash_status or self.hash_status[(group_id, dhash_id)] != flow_key:
             key_configs = flow_key.to_config_dict()
@@ -69,11 +548,11 @@ class FlyMonRuntime_BfRt():
                     order += 1
                 target_config_list.append(client.DataTuple(key, container_arr_val = inner_tuple))
             data = hash_configure_table.make_data(target_config_list)
-            hash_configure_table.default_entry_set(self.conn, data)
+            self._write(hash_configure_table, 'default', None, [data])
             self.hash_status[(group_id, dhash_id)] = flow_key
         return True
 
-    def initialization_stage_add(self, group_id, group_type, cmu_id, filter, task_id, key, param1, param2):
+    def initialization_stage_add(self, group_id, group_type, cmu_id, filter, task_id, key, param1, param2, key_mask=0xFFFF, modify=False):
         """
         Match fields:
             filter: [(ipsrc, mask1), (ipdst, mask2)]
@@ -87,36 +566,33 @@ class FlyMonRuntime_BfRt():
                    for hparam, value should in [1, 2] in group type1, [1, 2, 3] in group type2.
                    for std, value should in ['timestamp'], ['queue_length', 'queue_size', 'pktsize'] for group type2.
             param2 : a const value
+            key_mask : applied to the key.
+            modify : modify the action of the existing entry of the filter in place.
         Reutrns:
             Return match key list as rule handler (usded for deleting) / [] for failed.
         """
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        initialization_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_initialization")
-        initialization_table.info.key_field_annotation_add("hdr.ipv4.src_addr", "ipv4") 
-        initialization_table.info.key_field_annotation_add("hdr.ipv4.dst_addr", "ipv4")
+        prefix = self.prefix(group_id, group_type)
+        initialization_table = self.table(group_id, group_type, cmu_id, 'initialization')
         match = initialization_table.make_key([client.KeyTuple(f'hdr.ipv4.src_addr', filter[0][0], filter[0][1]),
                                                client.KeyTuple(f'hdr.ipv4.dst_addr', filter[1][0], filter[1][1])])
         action = None
+        mask_data = [client.DataTuple('key_mask', key_mask)]
         if param1[0].type == ParamType.CompressedKey or param1[0].type == ParamType.Key:
             action = initialization_table.make_data([ client.DataTuple('task_id', task_id),
-                                                      client.DataTuple('param2', param2.content),], 
+                                                      client.DataTuple('param2', param2.content),] + mask_data, 
                                                       prefix + f".set_cmu{cmu_id}_hkey{key}_hparam{param1[1]}")
         elif param1[0].type == ParamType.Const:
             action = initialization_table.make_data([ client.DataTuple('task_id', task_id),
                                                       client.DataTuple('param1', param1[0].content),
-                                                      client.DataTuple('param2', param2.content),], 
+                                                      client.DataTuple('param2', param2.content),] + mask_data, 
                                                       prefix + f".set_cmu{cmu_id}_hkey{key}_cparam")
         elif param1[0].type == ParamType.StdParam:
             action = initialization_table.make_data([ client.DataTuple('task_id', task_id),
-                                                      client.DataTuple('param2', param2.content)], 
+                                                      client.DataTuple('param2', param2.content)] + mask_data, 
                                                       prefix + f".set_cmu{cmu_id}_hkey{key}_{param1[0].content}")
         else:
             raise RuntimeError(f"Unkonwn ParamType of param 1.")
-        initialization_table.entry_add(self.conn, [match], [action])
+        self._write(initialization_table, 'mod' if modify else 'add', [match], [action])
         return [match]
 
     def initialization_stage_del(self, group_id, group_type, cmu_id, key_list):
@@ -125,13 +601,8 @@ class FlyMonRuntime_BfRt():
         """
         if len(key_list) == 0:
             return
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        initialization_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_initialization")
-        initialization_table.entry_del(self.conn, key_list)
+        initialization_table = self.table(group_id, group_type, cmu_id, 'initialization')
+        self._write(initialization_table, 'del', key_list)
         pass
 
     def preprocessing_stage_add(self, group_id, group_type, cmu_id, task_id, key_mappings, param_mappings):
@@ -140,12 +611,41 @@ class FlyMonRuntime_BfRt():
          key_mappings: used to implement address translation. e.g., [(key1, mask1, key_offset)]
          param_mappings: used to encode the params. e.g., [(param1, mask1, new param)]
         """
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        perprocessing_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_preprocessing")
+        perprocessing_table = self.table(group_id, group_type, cmu_id, 'preprocessing')
+        batch_match, batch_action = self._preprocessing_entries(group_id, group_type, cmu_id, task_id, key_mappings, param_mappings)
+        self._write(perprocessing_table, 'add', batch_match, batch_action)
+        return batch_match
+
+    def preprocessing_stage_update(self, group_id, group_type, cmu_id, task_id, old_key_mappings, key_mappings, param_mappings):
+        """
+        Switch the key mappings of a task in place (e.g., when its memory block is moved).
+        Entries of the keys in both mappings are modified, so that the keys are always translated.
+         old_key_mappings: the installed key mappings ({} if there is no preprocessing rule).
+        Returns:
+            match key list of the new key mappings.
+        """
+        perprocessing_table = self.table(group_id, group_type, cmu_id, 'preprocessing')
+        kept = {k : v for k, v in key_mappings.items() if k in old_key_mappings}
+        added = {k : v for k, v in key_mappings.items() if k not in old_key_mappings}
+        removed = {k : v for k, v in old_key_mappings.items() if k not in key_mappings}
+        mod_match, mod_action = self._preprocessing_entries(group_id, group_type, cmu_id, task_id, kept, param_mappings)
+        add_match, add_action = self._preprocessing_entries(group_id, group_type, cmu_id, task_id, added, param_mappings)
+        del_match, _ = self._preprocessing_entries(group_id, group_type, cmu_id, task_id, removed, param_mappings)
+        if len(mod_match) != 0:
+            self._write(perprocessing_table, 'mod', mod_match, mod_action)
+        if len(add_match) != 0:
+            self._write(perprocessing_table, 'add', add_match, add_action)
+        if len(del_match) != 0:
+            self._write(perprocessing_table, 'del', del_match)
+        return mod_match + add_match
+
+    def _preprocessing_entries(self, group_id, group_type, cmu_id, task_id, key_mappings, param_mappings):
+        """
+        Returns:
+            match keys and actions of the preprocessing rules.
+        """
+        prefix = self.prefix(group_id, group_type)
+        perprocessing_table = self.table(group_id, group_type, cmu_id, 'preprocessing')
         # batch entries to make operations faster
         batch_match = []
         batch_action = []
@@ -166,10 +666,9 @@ class FlyMonRuntime_BfRt():
                     action = perprocessing_table.make_data([ client.DataTuple('offset', key_mappings[(key, mask)]),
                                                              client.DataTuple('code', param_mappings[(param, pmask)])], 
                                                             prefix + f".process_cmu{cmu_id}_key_param")
-                batch_match.append(match)
-                batch_action.append(action)
-        perprocessing_table.entry_add(self.conn, batch_match, batch_action)
-        return batch_match
+                    batch_match.append(match)
+                    batch_action.append(action)
+        return batch_match, batch_action
 
     def preprocessing_stage_del(self, group_id, group_type, cmu_id, key_list):
         """
@@ -177,25 +676,17 @@ class FlyMonRuntime_BfRt():
         """
         if len(key_list) == 0:
             return
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        perprocessing_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_preprocessing")
-        perprocessing_table.entry_del(self.conn, key_list)
+        perprocessing_table = self.table(group_id, group_type, cmu_id, 'preprocessing')
+        self._write(perprocessing_table, 'del', key_list)
         pass
 
-    def operation_stage_add(self, group_id, group_type, cmu_id, task_id, operation_type):
+    def operation_stage_add(self, group_id, group_type, cmu_id, task_id, operation_type, modify=False):
         """
          task_id: which task to match.
+         modify: modify the action of the existing entry of the task in place.
         """
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        operation_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_operation")
+        prefix = self.prefix(group_id, group_type)
+        operation_table = self.table(group_id, group_type, cmu_id, 'operation')
         match = operation_table.make_key([client.KeyTuple(f'meta.cmu_group{group_id}.cmu{cmu_id}.task_id', task_id)])
         if operation_type == OperationType.AndOr:
             action = operation_table.make_data([], prefix + f".op_cmu{cmu_id}_and_or")
@@ -206,99 +697,287 @@ class FlyMonRuntime_BfRt():
         else:
             print("Invalid operation type when install runtime rules.")
             return []
-        operation_table.entry_add(self.conn, [match], [action])
+        self._write(operation_table, 'mod' if modify else 'add', [match], [action])
         return [match] # a key list. 
 
     def operation_stage_del(self, group_id, group_type, cmu_id, key_list):
         if len(key_list) == 0:
             return
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        operation_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_operation")
-        operation_table.entry_del(self.conn, key_list)
+        operation_table = self.table(group_id, group_type, cmu_id, 'operation')
+        self._write(operation_table, 'del', key_list)
 
-    def read(self, group_id, group_type, cmu_id, begin, end):
+    def read(self, group_id, group_type, cmu_id, begin, end, memory_size=None):
         """
         read memories in [begin, end)
+            memory_size: size of the register. If [begin, end) covers WHOLE_READ_RATIO of it or more,
+                         the whole register is read by read_all() without a key for each index.
+        Returns:
+            a packed numpy.uint16 array holding (end - begin) buckets.
         """
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        register_table = self.context.table_get(prefix + f".cmu{cmu_id}_buckets")
-        # buf = [0] * (end-begin)
-        buf = []
-        # batch entries to read faster
-        batch_key = []
-        for register_idx in range(begin, end):
-            batch_key.append(register_table.make_key([client.KeyTuple('$REGISTER_INDEX', register_idx)]))
-        
-        # before_timestamp = time.time()
+        if memory_size is not None and end - begin >= memory_size * WHOLE_READ_RATIO:
+            return self.read_all(group_id, group_type, cmu_id, memory_size)[begin:end]
+        prefix = self.prefix(group_id, group_type)
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = prefix + f".cmu{cmu_id}_buckets.f1"
+        buf = np.zeros(end - begin, dtype=np.uint16)
+        # Read the range with a few large requests instead of one request per index.
+        for batch_begin, batch_end in self._register_batches(begin, end):
+            batch_key = self._register_keys(register_table, group_id, cmu_id, batch_begin, batch_end)
+            resp = register_table.entry_get(
+                    self.conn,
+                    batch_key,
+                    {"from_hw": True})
+            # The value list of f1 has one item for each pipe, we take the first one.
+            buf[batch_begin-begin : batch_end-begin] = np.fromiter(
+                    (self._bucket_value(data, field_name) for data, _ in resp),
+                    dtype=np.uint16, count=batch_end-batch_begin)
+        return buf
+
+    def read_pipes(self, group_id, group_type, cmu_id, begin, end):
+        """
+        read memories in [begin, end) of every pipe (read only takes the first one).
+        Returns:
+            a 2-D numpy.uint16 array, one row for each pipe.
+        """
+        prefix = self.prefix(group_id, group_type)
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = prefix + f".cmu{cmu_id}_buckets.f1"
+        rows = []
+        for batch_begin, batch_end in self._register_batches(begin, end):
+            batch_key = self._register_keys(register_table, group_id, cmu_id, batch_begin, batch_end)
+            resp = register_table.entry_get(
+                    self.conn,
+                    batch_key,
+                    {"from_hw": True})
+            # The value list of f1 has one item for each pipe.
+            rows.extend(self._bucket_value(data, field_name, all_pipes=True) for data, _ in resp)
+        return np.array(rows, dtype=np.uint16).reshape(end - begin, -1).T
+
+    def read_indices(self, group_id, group_type, cmu_id, indices):
+        """
+        read the memories at the given indices.
+        Returns:
+            a packed numpy.uint16 array, one bucket for each index.
+        """
+        prefix = self.prefix(group_id, group_type)
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = prefix + f".cmu{cmu_id}_buckets.f1"
+        buf = np.zeros(len(indices), dtype=np.uint16)
+        for batch_begin in range(0, len(indices), REGISTER_BATCH_SIZE):
+            batch_end = min(batch_begin + REGISTER_BATCH_SIZE, len(indices))
+            batch_key = [register_table.make_key([client.KeyTuple('$REGISTER_INDEX', int(register_idx))])
+                            for register_idx in indices[batch_begin:batch_end]]
+            resp = register_table.entry_get(
+                    self.conn,
+                    batch_key,
+                    {"from_hw": True})
+            buf[batch_begin:batch_end] = np.fromiter(
+                    (self._bucket_value(data, field_name) for data, _ in resp),
+                    dtype=np.uint16, count=batch_end-batch_begin)
+        return buf
+
+    def read_and_clear_indices(self, group_id, group_type, cmu_id, indices):
+        """
+        read the memories at the given indices and reset them in the same pass.
+        Each chunk is reset right after it is read, so only the updates in between are lost.
+        Returns:
+            a packed numpy.uint16 array, one bucket for each index.
+        """
+        prefix = self.prefix(group_id, group_type)
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = prefix + f".cmu{cmu_id}_buckets.f1"
+        zero_data = self._zero_data(register_table, group_id, group_type, cmu_id)
+        buf = np.zeros(len(indices), dtype=np.uint16)
+        for batch_begin in range(0, len(indices), REGISTER_BATCH_SIZE):
+            batch_end = min(batch_begin + REGISTER_BATCH_SIZE, len(indices))
+            batch_key = [register_table.make_key([client.KeyTuple('$REGISTER_INDEX', int(register_idx))])
+                            for register_idx in indices[batch_begin:batch_end]]
+            resp = register_table.entry_get(
+                    self.conn,
+                    batch_key,
+                    {"from_hw": True})
+            buf[batch_begin:batch_end] = np.fromiter(
+                    (self._bucket_value(data, field_name) for data, _ in resp),
+                    dtype=np.uint16, count=batch_end-batch_begin)
+            register_table.entry_mod(self.conn, batch_key, [zero_data] * (batch_end-batch_begin))
+        return buf
+
+    def read_all(self, group_id, group_type, cmu_id, memory_size):
+        """
+        read the whole register of a CMU with a single sync and a single wildcard request.
+        Returns:
+            a packed numpy.uint16 array holding memory_size buckets.
+        """
+        prefix = self.prefix(group_id, group_type)
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = prefix + f".cmu{cmu_id}_buckets.f1"
+        # Sync the register into the software shadow once, then read the shadow in bulk.
+        register_table.operations_execute(self.conn, 'Sync')
         resp = register_table.entry_get(
                 self.conn,
-                batch_key,
-                {"from_hw": True})
-        # print(f"read lantency: {time.time() - before_timestamp}")
-        
-        for data, _ in resp:
-        # data, _ = next(resp)
-            data_dict = data.to_dict()
-            ## first is lo, second is hi.
-            # print(data_dict)
-            value_lo = data_dict[prefix + f".cmu{cmu_id}_buckets.f1"][0]
-            buf.append(value_lo)
+                None,
+                {"from_hw": False})
+        return self._register_buffer(resp, field_name, memory_size)
+
+    def read_and_clear(self, group_id, group_type, cmu_id, begin, end, memory_size=None):
+        """
+        read memories in [begin, end) and reset them in the same pass.
+        Each chunk is reset right after it is read, so only the updates in between are lost.
+            memory_size: size of the register. If [begin, end) covers the whole register,
+                         it is synced and then reset by a single table clear.
+        Returns:
+            a packed numpy.uint16 array holding (end - begin) buckets.
+        """
+        prefix = self.prefix(group_id, group_type)
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = prefix + f".cmu{cmu_id}_buckets.f1"
+        buf = np.zeros(end - begin, dtype=np.uint16)
+        if memory_size is not None and begin == 0 and end >= memory_size:
+            register_table.operations_execute(self.conn, 'Sync')
+            resp = list(register_table.entry_get(
+                    self.conn,
+                    None,
+                    {"from_hw": False}))
+            # The shadow is fetched, reset the hardware before decoding it.
+            register_table.entry_del(self.conn)
+            return self._register_buffer(resp, field_name, end)
+        zero_data = self._zero_data(register_table, group_id, group_type, cmu_id)
+        for batch_begin, batch_end in self._register_batches(begin, end):
+            batch_key = self._register_keys(register_table, group_id, cmu_id, batch_begin, batch_end)
+            resp = register_table.entry_get(
+                    self.conn,
+                    batch_key,
+                    {"from_hw": True})
+            buf[batch_begin-begin : batch_end-begin] = np.fromiter(
+                    (self._bucket_value(data, field_name) for data, _ in resp),
+                    dtype=np.uint16, count=batch_end-batch_begin)
+            register_table.entry_mod(self.conn, batch_key, [zero_data] * (batch_end-batch_begin))
         return buf
-    
-    def clear_data(self, group_id, group_type, cmu_id, begin, end):
+
+    def clear_data(self, group_id, group_type, cmu_id, begin, end, memory_size=None):
         """
         reset memories in [begin, end)
+            memory_size: size of the register. If [begin, end) covers the whole register,
+                         it is reset by a single table clear.
         """
-        prefix = ""
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        if memory_size is not None and begin == 0 and end >= memory_size:
+            self._write(register_table, 'clear', None)
+            return
+        batch_key = self._register_keys(register_table, group_id, cmu_id, begin, end)
+        batch_data = [self._zero_data(register_table, group_id, group_type, cmu_id)] * (end-begin)
+        self._write(register_table, 'mod', batch_key, batch_data)
+
+    def write(self, group_id, group_type, cmu_id, begin, values):
+        """
+        write memories in [begin, begin + len(values))
+            values: bucket values, e.g., a numpy.uint16 array.
+        """
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = self.prefix(group_id, group_type) + f".cmu{cmu_id}_buckets.f1"
+        for batch_begin, batch_end in self._register_batches(begin, begin + len(values)):
+            batch_key = self._register_keys(register_table, group_id, cmu_id, batch_begin, batch_end)
+            batch_data = [register_table.make_data([client.DataTuple(field_name, int(value))])
+                            for value in values[batch_begin-begin : batch_end-begin]]
+            self._write(register_table, 'mod', batch_key, batch_data)
+
+    def write_indices(self, group_id, group_type, cmu_id, indices, values):
+        """
+        write the memories at the given indices.
+            values: one bucket value for each index.
+        """
+        register_table = self.table(group_id, group_type, cmu_id, 'buckets')
+        field_name = self.prefix(group_id, group_type) + f".cmu{cmu_id}_buckets.f1"
+        for batch_begin in range(0, len(indices), REGISTER_BATCH_SIZE):
+            batch_end = min(batch_begin + REGISTER_BATCH_SIZE, len(indices))
+            batch_key = [register_table.make_key([client.KeyTuple('$REGISTER_INDEX', int(register_idx))])
+                            for register_idx in indices[batch_begin:batch_end]]
+            batch_data = [register_table.make_data([client.DataTuple(field_name, int(value))])
+                            for value in values[batch_begin:batch_end]]
+            self._write(register_table, 'mod', batch_key, batch_data)
+
+    def _bucket_value(self, data, field_name, all_pipes=False):
+        """
+        Decode a bucket from a register entry of a read, the value of the first pipe (or of each pipe if all_pipes).
+        The client exposes the fields of a response entry through to_dict() only, which decodes every data field
+        of the entry. A register entry has the single data field f1, so each entry is decoded once here,
+        and there is no second pass over the response.
+        """
+        values = data.to_dict()[field_name]
+        return values if all_pipes else values[0]
+
+    def _register_buffer(self, resp, field_name, memory_size):
+        """
+        Pack the entries of a wildcard register read into memory_size buckets (the entries past it are dropped).
+        The entries come in the order of the register indexes, so only the first and the last keys are decoded.
+        The keys of all the entries are decoded only if they are not consecutive.
+        """
+        resp = list(resp)
+        buf = np.zeros(memory_size, dtype=np.uint16)
+        if len(resp) == 0:
+            return buf
+        values = np.fromiter((self._bucket_value(data, field_name) for data, _ in resp), dtype=np.uint16, count=len(resp))
+        first = resp[0][1].to_dict()['$REGISTER_INDEX']['value']
+        last = resp[-1][1].to_dict()['$REGISTER_INDEX']['value']
+        if last - first + 1 == len(resp):
+            indexes = np.arange(first, last + 1)
         else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        register_table = self.context.table_get(prefix + f".cmu{cmu_id}_buckets")
-        # buf = [0] * (end-begin)
-        buf = []
-        # batch entries to read faster
-        batch_key = []
-        for register_idx in range(begin, end):
-            batch_key.append(register_table.make_key([client.KeyTuple('$REGISTER_INDEX', register_idx)]))
-        batch_data = [register_table.make_data(
-                                        [client.DataTuple(f'{prefix + f".cmu{cmu_id}_buckets"}.f1', 0)]
-                                              )
-                     ] * (end-begin)
-        register_table.entry_add(
-            self.conn,
-            batch_key,
-            batch_data)
-        register_table.entry_add( self.conn, batch_key, batch_data)
-      
+            indexes = np.fromiter((key.to_dict()['$REGISTER_INDEX']['value'] for _, key in resp), dtype=np.int64, count=len(resp))
+        inside = indexes < memory_size
+        buf[indexes[inside]] = values[inside]
+        return buf
+
+    def _register_batches(self, begin, end):
+        """
+        Split [begin, end) at the chunk boundaries of REGISTER_BATCH_SIZE, so that each batch takes its keys from a single chunk.
+        """
+        batches = []
+        batch_begin = begin
+        while batch_begin < end:
+            batch_end = min((batch_begin // REGISTER_BATCH_SIZE + 1) * REGISTER_BATCH_SIZE, end)
+            batches.append((batch_begin, batch_end))
+            batch_begin = batch_end
+        return batches
+
+    def _register_keys(self, register_table, group_id, cmu_id, begin, end):
+        """
+        Key objects of the register indexes in [begin, end).
+        They are built once for each aligned chunk of REGISTER_BATCH_SIZE indexes, so the cache holds
+        at most one key for each index of a register, whatever ranges are read.
+        """
+        keys = []
+        for chunk in range(begin // REGISTER_BATCH_SIZE, (end - 1) // REGISTER_BATCH_SIZE + 1):
+            chunk_begin = chunk * REGISTER_BATCH_SIZE
+            if (group_id, cmu_id, chunk) not in self.register_keys:
+                self.register_keys[(group_id, cmu_id, chunk)] = [register_table.make_key([client.KeyTuple('$REGISTER_INDEX', register_idx)])
+                                                                     for register_idx in range(chunk_begin, chunk_begin + REGISTER_BATCH_SIZE)]
+            chunk_keys = self.register_keys[(group_id, cmu_id, chunk)]
+            if begin <= chunk_begin and chunk_begin + REGISTER_BATCH_SIZE <= end:
+                keys.extend(chunk_keys)
+            else:
+                keys.extend(chunk_keys[max(begin - chunk_begin, 0) : end - chunk_begin])
+        return keys
+
+    def _zero_data(self, register_table, group_id, group_type, cmu_id):
+        if (group_id, cmu_id) not in self.zero_data:
+            field_name = self.prefix(group_id, group_type) + f".cmu{cmu_id}_buckets.f1"
+            self.zero_data[(group_id, cmu_id)] = register_table.make_data([client.DataTuple(field_name, 0)])
+        return self.zero_data[(group_id, cmu_id)]
     
     def clear_all(self, group_id, group_type, cmu_num):
         """
         Clear all table rules.
         """
-        if group_type == 1:
-            prefix = f"FlyMonIngress.cmu_group{group_id}"
-        else:
-            prefix = f"FlyMonEgress.cmu_group{group_id}"
-        
         for idx in range(cmu_num):
             cmu_id = idx + 1
             ## Clear all tasks.
-            initialization_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_initialization")
-            perprocessing_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_preprocessing")
-            operation_table = self.context.table_get(prefix+f".tbl_cmu{cmu_id}_operation")
-            initialization_table.entry_del(self.conn)
-            perprocessing_table.entry_del(self.conn)
-            operation_table.entry_del(self.conn)
+            initialization_table = self.table(group_id, group_type, cmu_id, 'initialization')
+            perprocessing_table = self.table(group_id, group_type, cmu_id, 'preprocessing')
+            operation_table = self.table(group_id, group_type, cmu_id, 'operation')
+            self._write(initialization_table, 'clear', None)
+            self._write(perprocessing_table, 'clear', None)
+            self._write(operation_table, 'clear', None)
 
             ## Clear all datas.
-            register_table = self.context.table_get(prefix + f".cmu{cmu_id}_buckets")
+            register_table = self.table(group_id, group_type, cmu_id, 'buckets')
             register_table.entry_del(self.conn)
\ No newline at end of file
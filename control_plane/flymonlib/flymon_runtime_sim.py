@@ -0,0 +1,478 @@
+# -*- coding:UTF-8 -*-
+import socket
+import struct
+import numpy as np
+from flymonlib.operation import OperationType
+from flymonlib.param import ParamType
+from flymonlib.flow_key import FlowKey
+
+# Packet fields read by the emulated hash units (in the order of the candidate key list).
+PACKET_FIELDS = ["hdr.ipv4.src_addr", "hdr.ipv4.dst_addr", "hdr.ports.src_port", "hdr.ports.dst_port", "hdr.ipv4.protocol"]
+
+# Sources of param1 in the initialization stage.
+PARAM1_CONST = 0
+PARAM1_HASH  = 1
+PARAM1_STD   = 2
+
+def ip2int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+class SimTable():
+    """
+    A match-action table of the emulator.
+    Each entry is a row of an int64 numpy array: the match columns go first, and the action columns follow.
+    Entries are matched in the order of insertion (the first one hits).
+    """
+    def __init__(self, match_num, action_num):
+        self.match_num = match_num
+        self.entries = np.zeros((0, match_num + action_num), dtype=np.int64)
+
+    def add(self, rows):
+        if len(rows) == 0:
+            return
+        rows = np.array(rows, dtype=np.int64).reshape(len(rows), self.entries.shape[1])
+        for row in rows:
+            if self.find(row[:self.match_num]) is not None:
+                raise RuntimeError(f"Entry {tuple(int(v) for v in row[:self.match_num])} already exists.")
+        self.entries = np.concatenate([self.entries, rows])
+
+    def delete(self, key_list):
+        keep = np.ones(len(self.entries), dtype=bool)
+        for key in key_list:
+            keep &= ~np.all(self.entries[:, :self.match_num] == np.array(key, dtype=np.int64), axis=1)
+        self.entries = self.entries[keep]
+
+    def find(self, key):
+        hits = np.nonzero(np.all(self.entries[:, :self.match_num] == np.array(key, dtype=np.int64), axis=1))[0]
+        if len(hits) == 0:
+            return None
+        return hits[0]
+
+    def modify(self, rows):
+        """
+        Replace the actions of existing entries.
+        """
+        for row in rows:
+            idx = self.find(row[:self.match_num])
+            if idx is None:
+                raise RuntimeError(f"Entry {tuple(int(v) for v in row[:self.match_num])} does not exist.")
+            self.entries[idx, self.match_num:] = row[self.match_num:]
+
+    def clear(self):
+        self.entries = self.entries[:0]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FlyMonRuntime_Sim():
+    """
+    An offline CMU Runtime which emulates the CMU-Groups in process.
+    It provides the same interfaces as FlyMonRuntime_BfRt, keeps all tables and the
+    16-bit cmuN_buckets registers in numpy arrays, and executes packets in batches through
+    the compression -> initialization -> preprocessing -> operation stages
+    generated by p4_templates/cmu_groups.p4_template.
+    """
+    def __init__(self, cmug_configs):
+        self.cmug_configs = {
+            # key : group_id
+            # val : cmu_group config
+        }
+        self.hashers = {
+            # key : (group_id, dhash_id)
+            # val : hasher object
+        }
+        self.hash_status = {
+            # key : (group_id, dhash_id)
+            # val : flow_key
+        }
+        self.tables = {
+            # key : (group_id, cmu_id, stage), stage is one of 'initialization', 'preprocessing', 'operation'.
+            # val : SimTable
+        }
+        self.registers = {
+            # key : (group_id, cmu_id)
+            # val : numpy.uint16 array
+        }
+        for cmug in cmug_configs:
+            group_id = cmug["id"]
+            self.cmug_configs[group_id] = cmug
+            for idx in range(cmug["cmu_num"]):
+                cmu_id = idx + 1
+                # (src_addr, src_mask, dst_addr, dst_mask) -> (task_id, key, param1_type, param1, param2, key_mask)
+                self.tables[(group_id, cmu_id, 'initialization')] = SimTable(4, 6)
+                # (task_id, key, key_mask, param1, param1_mask) -> (offset, has_code, code)
+                self.tables[(group_id, cmu_id, 'preprocessing')] = SimTable(5, 3)
+                # (task_id) -> (operation)
+                self.tables[(group_id, cmu_id, 'operation')] = SimTable(1, 1)
+                self.registers[(group_id, cmu_id)] = np.zeros(cmug["cmu_size"], dtype=np.uint16)
+        self.batch_snapshot = None
+
+    def begin_batch(self):
+        """
+        Writes take effect at once in the emulator, a batch keeps a snapshot of the tables for aborting.
+        """
+        self.batch_snapshot = ({key : table.entries.copy() for key, table in self.tables.items()}, dict(self.hash_status))
+
+    def commit_batch(self):
+        self.batch_snapshot = None
+
+    def abort_batch(self):
+        """
+        Restore the tables to the beginning of the batch.
+        """
+        if self.batch_snapshot is None:
+            return
+        entries, hash_status = self.batch_snapshot
+        for key, table_entries in entries.items():
+            self.tables[key].entries = table_entries
+        self.hash_status = hash_status
+        self.batch_snapshot = None
+
+    def begin_reconcile(self):
+        """
+        The same as FlyMonRuntime_BfRt.begin_reconcile.
+        Writes take effect at once in the emulator, so the rule tables are rebuilt from empty ones.
+        """
+        self.begin_batch()
+        for table in self.tables.values():
+            table.clear()
+
+    def reconcile_batch(self, cmug_configs):
+        """
+        The same as FlyMonRuntime_BfRt.reconcile_batch, the diff is taken against the beginning of the batch.
+        """
+        stats = {"added": 0, "modified": 0, "deleted": 0, "unchanged": 0}
+        if self.batch_snapshot is not None:
+            entries, _ = self.batch_snapshot
+            for key, table in self.tables.items():
+                before = {tuple(row[:table.match_num]) : tuple(row) for row in entries[key].tolist()}
+                for row in table.entries.tolist():
+                    old_row = before.pop(tuple(row[:table.match_num]), None)
+                    if old_row is None:
+                        stats["added"] += 1
+                    elif old_row == tuple(row):
+                        stats["unchanged"] += 1
+                    else:
+                        stats["modified"] += 1
+                stats["deleted"] += len(before)
+        self.batch_snapshot = None
+        return stats
+
+    def audit(self, repair=False):
+        """
+        The same as FlyMonRuntime_BfRt.audit, the emulator tables are the only copy and always consistent.
+        """
+        return {}
+
+    def setup_dhash(self, group_id, group_type, dhash_id, hasher):
+        self.hashers[(group_id, dhash_id)] = hasher
+
+    def compression_stage_config(self, group_id, group_type, dhash_id, flow_key):
+        """
+        Set hash unit mask portion of the fields.
+            group_id: CMU-Group ID.
+            dhash_id: hash unit ID.
+            flow_key: FlowKey object in utils/flow_key.py
+        """
+        key_copy = FlowKey(self.cmug_configs[group_id]["candidate_key_list"])
+        key_copy.set(flow_key)
+        self.hash_status[(group_id, dhash_id)] = key_copy
+        return True
+
+    def initialization_stage_add(self, group_id, group_type, cmu_id, filter, task_id, key, param1, param2, key_mask=0xFFFF, modify=False):
+        """
+        The same as FlyMonRuntime_BfRt.initialization_stage_add.
+        Reutrns:
+            Return match key list as rule handler (usded for deleting).
+        """
+        if param1[0].type == ParamType.CompressedKey or param1[0].type == ParamType.Key:
+            if key == 12 or param1[1] not in self._hash_units(group_type):
+                raise RuntimeError(f"No action set_cmu{cmu_id}_hkey{key}_hparam{param1[1]} in CMU-Group {group_id}.")
+            param1_type, param1_value = PARAM1_HASH, param1[1]
+        elif param1[0].type == ParamType.Const:
+            param1_type, param1_value = PARAM1_CONST, param1[0].content
+        elif param1[0].type == ParamType.StdParam:
+            std_params = list(self.cmug_configs[group_id]["std_params"].keys())
+            if key != 1 or param1[0].content not in std_params:
+                raise RuntimeError(f"No action set_cmu{cmu_id}_hkey{key}_{param1[0].content} in CMU-Group {group_id}.")
+            param1_type, param1_value = PARAM1_STD, std_params.index(param1[0].content)
+        else:
+            raise RuntimeError(f"Unkonwn ParamType of param 1.")
+        if key not in self._hash_units(group_type) and not (key == 12 and group_type == 1):
+            raise RuntimeError(f"No compressed key {key} in CMU-Group {group_id}.")
+        match = (ip2int(filter[0][0]), ip2int(filter[0][1]), ip2int(filter[1][0]), ip2int(filter[1][1]))
+        table = self.tables[(group_id, cmu_id, 'initialization')]
+        row = match + (task_id, key, param1_type, param1_value, param2.content, key_mask)
+        if modify:
+            table.modify([row])
+        else:
+            table.add([row])
+        return [match]
+
+    def initialization_stage_del(self, group_id, group_type, cmu_id, key_list):
+        self.tables[(group_id, cmu_id, 'initialization')].delete(key_list)
+
+    def preprocessing_stage_add(self, group_id, group_type, cmu_id, task_id, key_mappings, param_mappings):
+        """
+         task_id: which task to match.
+         key_mappings: used to implement address translation. e.g., [(key1, mask1, key_offset)]
+         param_mappings: used to encode the params. e.g., [(param1, mask1, new param)]
+        """
+        batch_match, batch_action = self._preprocessing_entries(task_id, key_mappings, param_mappings)
+        self.tables[(group_id, cmu_id, 'preprocessing')].add([m + a for m, a in zip(batch_match, batch_action)])
+        return batch_match
+
+    def preprocessing_stage_update(self, group_id, group_type, cmu_id, task_id, old_key_mappings, key_mappings, param_mappings):
+        """
+        The same as FlyMonRuntime_BfRt.preprocessing_stage_update.
+        """
+        table = self.tables[(group_id, cmu_id, 'preprocessing')]
+        kept = {k : v for k, v in key_mappings.items() if k in old_key_mappings}
+        added = {k : v for k, v in key_mappings.items() if k not in old_key_mappings}
+        removed = {k : v for k, v in old_key_mappings.items() if k not in key_mappings}
+        mod_match, mod_action = self._preprocessing_entries(task_id, kept, param_mappings)
+        add_match, add_action = self._preprocessing_entries(task_id, added, param_mappings)
+        del_match, _ = self._preprocessing_entries(task_id, removed, param_mappings)
+        table.modify([m + a for m, a in zip(mod_match, mod_action)])
+        table.add([m + a for m, a in zip(add_match, add_action)])
+        table.delete(del_match)
+        return mod_match + add_match
+
+    def _preprocessing_entries(self, task_id, key_mappings, param_mappings):
+        batch_match = []
+        batch_action = []
+        for key, mask in key_mappings.keys():
+            if len(param_mappings) == 0:
+                batch_match.append((task_id, key, mask, 0, 0))
+                batch_action.append((key_mappings[(key, mask)], 0, 0))
+            else:
+                for param, pmask in param_mappings.keys():
+                    batch_match.append((task_id, key, mask, param, pmask))
+                    batch_action.append((key_mappings[(key, mask)], 1, param_mappings[(param, pmask)]))
+        return batch_match, batch_action
+
+    def preprocessing_stage_del(self, group_id, group_type, cmu_id, key_list):
+        self.tables[(group_id, cmu_id, 'preprocessing')].delete(key_list)
+
+    def operation_stage_add(self, group_id, group_type, cmu_id, task_id, operation_type, modify=False):
+        """
+         task_id: which task to match.
+         modify: modify the action of the existing entry of the task in place.
+        """
+        if operation_type not in [OperationType.AndOr, OperationType.CondADD, OperationType.Max]:
+            print("Invalid operation type when install runtime rules.")
+            return []
+        match = (task_id,)
+        if modify:
+            self.tables[(group_id, cmu_id, 'operation')].modify([match + (operation_type.value,)])
+        else:
+            self.tables[(group_id, cmu_id, 'operation')].add([match + (operation_type.value,)])
+        return [match]
+
+    def operation_stage_del(self, group_id, group_type, cmu_id, key_list):
+        self.tables[(group_id, cmu_id, 'operation')].delete(key_list)
+
+    def read(self, group_id, group_type, cmu_id, begin, end, memory_size=None):
+        """
+        read memories in [begin, end), memory_size is not needed by the emulator.
+        """
+        return self.registers[(group_id, cmu_id)][begin:end].copy()
+
+    def read_pipes(self, group_id, group_type, cmu_id, begin, end):
+        """
+        read memories in [begin, end) of every pipe, the emulator has a single pipe.
+        """
+        return self.registers[(group_id, cmu_id)][begin:end].copy().reshape(1, -1)
+
+    def read_indices(self, group_id, group_type, cmu_id, indices):
+        """
+        read the memories at the given indices.
+        """
+        return self.registers[(group_id, cmu_id)][np.asarray(indices, dtype=np.int64)]
+
+    def read_and_clear_indices(self, group_id, group_type, cmu_id, indices):
+        """
+        read the memories at the given indices and reset them.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        buf = self.registers[(group_id, cmu_id)][indices].copy()
+        self.registers[(group_id, cmu_id)][indices] = 0
+        return buf
+
+    def read_all(self, group_id, group_type, cmu_id, memory_size):
+        return self.registers[(group_id, cmu_id)][:memory_size].copy()
+
+    def read_and_clear(self, group_id, group_type, cmu_id, begin, end, memory_size=None):
+        """
+        read memories in [begin, end) and reset them.
+        """
+        buf = self.registers[(group_id, cmu_id)][begin:end].copy()
+        self.registers[(group_id, cmu_id)][begin:end] = 0
+        return buf
+
+    def write(self, group_id, group_type, cmu_id, begin, values):
+        """
+        write memories in [begin, begin + len(values))
+        """
+        self.registers[(group_id, cmu_id)][begin:begin + len(values)] = values
+
+    def write_indices(self, group_id, group_type, cmu_id, indices, values):
+        """
+        write the memories at the given indices.
+        """
+        self.registers[(group_id, cmu_id)][np.asarray(indices, dtype=np.int64)] = values
+
+    def clear_data(self, group_id, group_type, cmu_id, begin, end, memory_size=None):
+        """
+        reset memories in [begin, end)
+        """
+        self.registers[(group_id, cmu_id)][begin:end] = 0
+
+    def clear_all(self, group_id, group_type, cmu_num):
+        """
+        Clear all table rules.
+        """
+        for idx in range(cmu_num):
+            cmu_id = idx + 1
+            for stage in ['initialization', 'preprocessing', 'operation']:
+                self.tables[(group_id, cmu_id, stage)].clear()
+            self.registers[(group_id, cmu_id)][:] = 0
+
+    def process(self, packets):
+        """
+        Execute a batch of packets through all CMU-Groups.
+        Args:
+            packets: a dict of numpy arrays with the same length.
+               - keys in PACKET_FIELDS, e.g., packets["hdr.ipv4.src_addr"] = np.array([0x0a000001, ...])
+               - standard params (e.g., 'pkt_size', 'queue_size' and 'timestamp').
+               Missing fields are treated as zeros.
+        """
+        pkt_num = len(next(iter(packets.values())))
+        fields = {}
+        for name in PACKET_FIELDS:
+            fields[name] = np.asarray(packets.get(name, np.zeros(pkt_num)), dtype=np.int64)
+        for group_id in sorted(self.cmug_configs.keys()):
+            cmug = self.cmug_configs[group_id]
+            group_type = cmug["type"]
+            # Shared compression stage.
+            compressed_keys = {}
+            for dhash_id in self._hash_units(group_type):
+                compressed_keys[dhash_id] = self._compress(group_id, group_type, dhash_id, fields, pkt_num)
+            std_params = [np.asarray(packets.get(name, np.zeros(pkt_num)), dtype=np.int64) & 0xFFFF
+                              for name in cmug["std_params"].keys()]
+            for idx in range(cmug["cmu_num"]):
+                self._process_cmu(group_id, group_type, idx + 1, fields, compressed_keys, std_params, pkt_num)
+
+    def _hash_units(self, group_type):
+        if group_type == 1:
+            return [1, 2, 3]
+        return [1, 2]
+
+    def _compress(self, group_id, group_type, dhash_id, fields, pkt_num):
+        """
+        Emulate a hash unit: hash the enabled (masked) fields of the configured key.
+        """
+        bit_width = 32 if (group_type == 2 and dhash_id == 1) else 16
+        flow_key = self.hash_status.get((group_id, dhash_id))
+        if flow_key is None or (group_id, dhash_id) not in self.hashers:
+            return np.zeros(pkt_num, dtype=np.int64)
+        columns = []
+        for name in PACKET_FIELDS:
+            if name not in flow_key.key_list:
+                continue
+            bits, prefix = flow_key.key_list[name]
+            if prefix == 0:
+                continue
+            mask = ((1 << prefix) - 1) << (bits - prefix)
+            values = fields[name] & mask
+            for byte in range(bits // 8 - 1, -1, -1):
+                columns.append((values >> (byte * 8)) & 0xFF)
+        if len(columns) == 0:
+            return np.zeros(pkt_num, dtype=np.int64)
+        key_bytes = np.stack(columns, axis=1).astype(np.uint8)
+        return self.hashers[(group_id, dhash_id)].compute_batch(bit_width, key_bytes)
+
+    def _process_cmu(self, group_id, group_type, cmu_id, fields, compressed_keys, std_params, pkt_num):
+        # Initialization stage.
+        init_table = self.tables[(group_id, cmu_id, 'initialization')]
+        if len(init_table) == 0:
+            return
+        task_id = np.zeros(pkt_num, dtype=np.int64)
+        key = np.zeros(pkt_num, dtype=np.int64)
+        param1 = np.zeros(pkt_num, dtype=np.int64)
+        param2 = np.zeros(pkt_num, dtype=np.int64)
+        matched = np.zeros(pkt_num, dtype=bool)
+        for src, src_mask, dst, dst_mask, e_task, e_key, e_p1_type, e_p1, e_p2, e_kmask in init_table.entries:
+            hit = ~matched & ((fields["hdr.ipv4.src_addr"] & src_mask) == (src & src_mask)) \
+                           & ((fields["hdr.ipv4.dst_addr"] & dst_mask) == (dst & dst_mask))
+            if not hit.any():
+                continue
+            matched |= hit
+            task_id[hit] = e_task
+            if e_key == 12:
+                key[hit] = (compressed_keys[1][hit] ^ compressed_keys[2][hit]) & 0xFFFF
+            elif e_key == 1 and group_type == 2:
+                key[hit] = (compressed_keys[1][hit] >> ((cmu_id - 1) * 8)) & 0xFFFF
+            else:
+                key[hit] = compressed_keys[e_key][hit] & 0xFFFF
+            key[hit] &= e_kmask
+            if e_p1_type == PARAM1_CONST:
+                param1[hit] = e_p1
+            elif e_p1_type == PARAM1_HASH:
+                param1[hit] = compressed_keys[e_p1][hit] & 0xFFFF
+            else:
+                param1[hit] = std_params[e_p1][hit]
+            param2[hit] = e_p2
+        if not matched.any():
+            return
+        task_id, key, param1, param2 = task_id[matched], key[matched], param1[matched], param2[matched]
+
+        # Preprocessing stage.
+        prep_table = self.tables[(group_id, cmu_id, 'preprocessing')]
+        hit_any = np.zeros(len(task_id), dtype=bool)
+        for e_task, e_key, e_kmask, e_p1, e_pmask, offset, has_code, code in prep_table.entries:
+            hit = ~hit_any & (task_id == e_task) & ((key & e_kmask) == (e_key & e_kmask)) \
+                           & ((param1 & e_pmask) == (e_p1 & e_pmask))
+            if not hit.any():
+                continue
+            hit_any |= hit
+            key[hit] = (key[hit] + offset) & 0xFFFF   # Implementing '-' by '+' overflow.
+            if has_code:
+                param1[hit] = code
+
+        # Operation stage.
+        oper_table = self.tables[(group_id, cmu_id, 'operation')]
+        register = self.registers[(group_id, cmu_id)]
+        index = key & ((1 << self.cmug_configs[group_id]["key_bitw"]) - 1)
+        for e_task, e_op in oper_table.entries:
+            hit = task_id == e_task
+            if not hit.any():
+                continue
+            if e_op == OperationType.CondADD.value:
+                self._cond_add(register, index[hit], param1[hit], param2[hit])
+            elif e_op == OperationType.Max.value:
+                np.maximum.at(register, index[hit], param1[hit].astype(np.uint16))
+            else:
+                is_and = param2[hit] == 1
+                np.bitwise_and.at(register, index[hit][is_and], param1[hit][is_and].astype(np.uint16))
+                np.bitwise_or.at(register, index[hit][~is_and], param1[hit][~is_and].astype(np.uint16))
+
+    def _cond_add(self, register, index, param1, param2):
+        """
+        Vectorized version of:
+            if (value < param2) value = value |+| param1;
+        The threshold param2 is a constant of the task, so the updates which take effect
+        in a bucket are always a prefix of the packets hashed into that bucket.
+        """
+        order = np.argsort(index, kind='stable')
+        index, param1, param2 = index[order], param1[order], param2[order]
+        buckets, starts, counts = np.unique(index, return_index=True, return_counts=True)
+        cum = np.cumsum(param1)
+        before = cum - param1
+        before = before - np.repeat(before[starts], counts)
+        origin = register[index].astype(np.int64)
+        effect = np.where(origin + before < param2, param1, 0)
+        added = np.add.reduceat(effect, starts)
+        register[buckets] = np.minimum(register[buckets].astype(np.int64) + added, 0xFFFF)
@@ -21,6 +21,7 @@ class FlyMonTask:
         memory_size: 65536
         """
         self._id = task_id
+        self._spec = (filter, flow_key, flow_attr) # The input strings, used to rebuild the task.
         self._filter = parse_filter(filter) # [(src_ip, src_mask), (dst_ip, dst_mask)] 
         self._key = parse_key(flow_key)
         self.attribute = parse_attribute(flow_attr)
@@ -60,6 +61,13 @@ class FlyMonTask:
     def mem_size(self, mem):
         self._mem_size = mem
     
+    @property
+    def spec(self):
+        """
+        (filter, flow_key, flow_attr, mem_size), the same as the input of FlyMonTask.
+        """
+        return self._spec + (self.mem_size,)
+
     @property
     def mem_num(self):
         return self._attribute.memory_num
@@ -1,4 +1,5 @@
 import crcmod
+import numpy as np
 
 class Hasher:
     """
@@ -13,14 +14,61 @@ class Hasher:
             "final_xor"  : final_xor
         }
         self._func = crcmod.mkCrcFun(((1 << bit_width) | polynomial), initCrc=init_crc, rev=is_reverse)
+        self._table = self._make_table()
         pass
 
+    def _make_table(self):
+        """
+        Byte-wise lookup table of the crc (the same algorithm as crcmod).
+        """
+        bit_width = self._conf["bit_width"]
+        width_mask = (1 << bit_width) - 1
+        table = np.zeros(256, dtype=np.uint32)
+        if self._conf["is_reverse"]:
+            polynomial = int(format(self._conf["polynomial"], f'0{bit_width}b')[::-1], base=2)
+            for byte in range(256):
+                crc = byte
+                for _ in range(8):
+                    crc = (crc >> 1) ^ polynomial if crc & 1 else crc >> 1
+                table[byte] = crc
+        else:
+            polynomial = self._conf["polynomial"]
+            top_bit = 1 << (bit_width - 1)
+            for byte in range(256):
+                crc = byte << (bit_width - 8)
+                for _ in range(8):
+                    crc = ((crc << 1) ^ polynomial) & width_mask if crc & top_bit else (crc << 1) & width_mask
+                table[byte] = crc
+        return table
+
     def compute(self, phy_bitw, input, offset = 0):
         """
         calcute the crc code for input.
         """
-        # return (self._func(input) ^ self._conf["final_xor"]) & int('0'*(32-phy_bitw) + '1'*phy_bitw, base=2)
-        return ((self._func(input) ^ self._conf["final_xor"]) >> offset) & int('0'*(32-phy_bitw) + '1'*phy_bitw, base=2)
+        return ((self._func(input) ^ self._conf["final_xor"]) >> offset) & ((1 << phy_bitw) - 1)
+
+    def compute_batch(self, phy_bitw, inputs, offset = 0):
+        """
+        calcute the crc codes of many inputs at once.
+        Args:
+            inputs: a 2-D numpy.uint8 array, one packed key (of the same length) for each row.
+        Returns:
+            a numpy.int64 array, the same as compute() on each row.
+        """
+        # One contiguous row for each byte position.
+        columns = np.ascontiguousarray(np.asarray(inputs, dtype=np.uint8).T)
+        bit_width = self._conf["bit_width"]
+        width_mask = np.uint32((1 << bit_width) - 1)
+        crc = np.full(columns.shape[1], self._conf["init_crc"], dtype=np.uint32)
+        if self._conf["is_reverse"]:
+            for column in columns:
+                crc = (crc >> np.uint32(8)) ^ self._table[(crc ^ column) & np.uint32(0xFF)]
+        else:
+            shift = np.uint32(bit_width - 8)
+            for column in columns:
+                crc = ((crc << np.uint32(8)) & width_mask) ^ self._table[((crc >> shift) ^ column) & np.uint32(0xFF)]
+        crc = (crc ^ np.uint32(self._conf["final_xor"])) >> np.uint32(offset)
+        return (crc & np.uint32(((1 << phy_bitw) - 1) & 0xFFFFFFFF)).astype(np.int64)
 
     @property
     def polynomial(self):
@@ -46,6 +94,48 @@ class Hasher:
         return str(self._conf)
 
 
+class XorHasher:
+    """
+    The XOR of two hash units (e.g., hkey 12 of CMU-Group type 1), each one hashes its own fields of the flow key.
+    """
+    def __init__(self, hasher1, hasher2, flow_key, flow_key1, flow_key2):
+        """
+        flow_key: the key of the task, its fields are packed in the input (see FlyMonTask.generate_key_bytes).
+        flow_key1, flow_key2: the keys configured in the two hash units.
+        """
+        self._hasher1 = hasher1
+        self._hasher2 = hasher2
+        # Byte positions (in the input) of the fields of each hash unit.
+        self._bytes1 = []
+        self._bytes2 = []
+        pos = 0
+        for name, (bits, prefix) in flow_key.key_list.items():
+            if prefix == 0:
+                continue
+            positions = list(range(pos, pos + bits // 8))
+            if flow_key1.key_list[name][1] != 0:
+                self._bytes1.extend(positions)
+            if flow_key2.key_list[name][1] != 0:
+                self._bytes2.extend(positions)
+            pos += bits // 8
+
+    def compute(self, phy_bitw, input, offset = 0):
+        """
+        calcute the hash code for input.
+        """
+        input1 = bytes(input[pos] for pos in self._bytes1)
+        input2 = bytes(input[pos] for pos in self._bytes2)
+        return self._hasher1.compute(phy_bitw, input1, offset) ^ self._hasher2.compute(phy_bitw, input2, offset)
+
+    def compute_batch(self, phy_bitw, inputs, offset = 0):
+        """
+        calcute the hash codes of many inputs at once, the same as Hasher.compute_batch.
+        """
+        inputs = np.asarray(inputs, dtype=np.uint8)
+        return self._hasher1.compute_batch(phy_bitw, inputs[:, self._bytes1], offset) ^ \
+               self._hasher2.compute_batch(phy_bitw, inputs[:, self._bytes2], offset)
+
+
 HASHES_16 = [
     # reference: https://crccalc.com/
     Hasher(0x04C11DB7, 32,    0xFFFFFFFF,     True,      0xFFFFFFFF),
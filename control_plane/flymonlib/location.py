@@ -1,3 +1,4 @@
+import numpy as np
 from flymonlib.cmu_group import MemoryType
 from flymonlib.flow_key import FlowKey
 
@@ -43,6 +44,26 @@ class Location:
         # print(f"address_base:{address_base}, offset:{offset}, read:{address_base + offset}")
         return address_base + offset
 
+    def address_translate_batch(self, phy_bitw, bufs):
+        """
+        Args:
+            A list of flow keys to be hash and translate.
+        Returns:
+            Real memory addresses (numpy.int64 array).
+        """
+        offset = 0
+        if self.group_type == 2:
+            offset = (self.cmu_id - 1) * 8
+        mem_range = int( (2**phy_bitw)  /  (2**(self._memory_type-1)) )
+        if len(bufs) > 0 and all(len(buf) == len(bufs[0]) for buf in bufs):
+            # Keys of the same length are packed and hashed at once.
+            packed = np.frombuffer(b''.join(bufs), dtype=np.uint8).reshape(len(bufs), len(bufs[0]))
+            address_base = self._hash.compute_batch(phy_bitw, packed, offset)
+        else:
+            address_base = np.fromiter((self._hash.compute(phy_bitw, buf, offset) for buf in bufs),
+                                       dtype=np.int64, count=len(bufs))
+        return address_base % mem_range + self._memory_idx * mem_range
+
     @property
     def group_id(self):
         return self._group_id
@@ -71,6 +92,10 @@ class Location:
     def memory_idx(self):
         return self._memory_idx
 
+    @memory_idx.setter
+    def memory_idx(self, memory_idx):
+        self._memory_idx = memory_idx
+
     @property
     def init_rules(self):
         return self._init_rules
@@ -0,0 +1,42 @@
+# -*- coding:UTF-8 -*-
+
+
+class AllocationPlan:
+    """
+    Result of a what-if allocation (see ResourceManager.plan).
+    """
+    def __init__(self):
+        self.locations = {
+            # key : index of the task spec
+            # val : list of planned Location
+        }
+        self.rejections = {
+            # key : index of the task spec
+            # val : reason of the rejection
+        }
+        self.leftover = {
+            # key : (group_id, cmu_id)
+            # val : rest memory (buckets) after the plan
+        }
+        self.fragmentation = {
+            # key : (group_id, cmu_id)
+            # val : 1 - largest free block / rest memory, 0 for no fragmentation
+        }
+        # Allocated memory / total memory of all CMUs after the plan.
+        self.utilization = 0.0
+
+    @property
+    def accepted(self):
+        return len(self.locations)
+
+    @property
+    def rejected(self):
+        return len(self.rejections)
+
+    def __str__(self):
+        info = f"Accepted: {self.accepted}, Rejected: {self.rejected}, Memory Utilization: {self.utilization*100:.2f}%\n"
+        for idx, reason in sorted(self.rejections.items()):
+            info += f"  Task {idx} rejected: {reason}\n"
+        for (group_id, cmu_id), rest_mem in sorted(self.leftover.items()):
+            info += f"  CMU-Group {group_id} CMU-{cmu_id} Rest Memory: {rest_mem}, Fragmentation: {self.fragmentation[(group_id, cmu_id)]:.2f}\n"
+        return info
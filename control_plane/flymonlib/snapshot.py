@@ -0,0 +1,42 @@
+# -*- coding:UTF-8 -*-
+
+
+class TaskSnapshot:
+    """
+    Data of a task collected at the end of a measurement epoch.
+    """
+    def __init__(self, task_id, data, epoch_start, epoch_end):
+        """
+        data: a list of data array (numpy.uint16), one for each location of the task.
+        epoch_start: the time (time.time()) the memory was last reset, None if unknown.
+        epoch_end: the time the memory was read and reset.
+        """
+        self._task_id = task_id
+        self._data = data
+        self._epoch_start = epoch_start
+        self._epoch_end = epoch_end
+
+    @property
+    def task_id(self):
+        return self._task_id
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def epoch_start(self):
+        return self._epoch_start
+
+    @property
+    def epoch_end(self):
+        return self._epoch_end
+
+    @property
+    def duration(self):
+        if self._epoch_start is None:
+            return None
+        return self._epoch_end - self._epoch_start
+
+    def __str__(self):
+        return f"Snapshot of task {self._task_id}, epoch: [{self._epoch_start}, {self._epoch_end}]"
@@ -180,6 +180,32 @@ def calc_keymapping(total_bitw, mem_type, mem_idx):
             key_mapping[(match_value, mask_value)] = (offset+2**total_bitw)%(2**total_bitw)
     return key_mapping
 
+def calc_key_mask(total_bitw, mem_type):
+    """Calculate the key mask of a location, which is applied in the initialization stage.
+    Args:
+        total_bitw: total biw width of a cmu memory. (address bit width)
+        mem_type: int, 1 for whold, 2 for half, 3 for quartar...
+    Returns:
+        the mask keeping the address bits inside a memory block of the type.
+    """
+    return (1 << int(total_bitw - (mem_type-1))) - 1
+
+def calc_compact_keymapping(total_bitw, mem_type, mem_idx):
+    """Calculate the key mapping of a location whose key is masked by calc_key_mask().
+    As the masked key is inside [0, mem_range), a single rule moves it to the memory block,
+    whatever the memory type is.
+    Args:
+        total_bitw: total biw width of a cmu memory. (address bit width)
+        mem_type: int, 1 for whold, 2 for half, 3 for quartar...
+        mem_idx: memory_idx on this type.
+    Returns:
+        a dict of mappings (the same as calc_keymapping()).
+        key : (key, mask)
+        val : offset
+    """
+    mem_range = int(2**total_bitw/2**(mem_type-1))
+    return {(0,0) : mem_idx * mem_range}
+
 def parse_filter(filter_str):
     """
     Args:
@@ -218,6 +244,19 @@ def parse_filter(filter_str):
         raise RuntimeError("Invalid filter format, example: 10.0.0.0/8,20.0.0.0/16 or 10.0.0.0/8,* or *,*")
     return results
 
+def filters_overlap(filter1, filter2):
+    """
+    Args:
+        filter1, filter2: parsed filters, e.g., [(a.b.c.d, 255.255.0.0), (0.0.0.0, 0.0.0.0)]
+    Returns:
+        True if a packet can match both ternary filters.
+    """
+    for (ip1, mask1), (ip2, mask2) in zip(filter1, filter2):
+        ip1, mask1, ip2, mask2 = [int.from_bytes(bytes(int(b) for b in x.split('.')), 'big') for x in (ip1, mask1, ip2, mask2)]
+        if ip1 & mask1 & mask2 != ip2 & mask1 & mask2:
+            return False
+    return True
+
 def s2d(d, count = 1000):
     #convert string key to tuple.
     limit = count
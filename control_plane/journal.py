@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import traceback
+from resource_manager import ResourceManager
+from task_manager import TaskManager
+
+
+JOURNAL_VERSION = 1
+
+class Journal:
+    """
+    Persistent state of the controller, so that a restarted controller resumes the running tasks
+    without clearing the data plane (and losing the counters).
+    The journal holds the tasks, their locations and the allocation status of the CMU-Groups.
+    The rules are rebuilt from the locations and reconciled with the data plane (see TaskManager.reconcile).
+    """
+    def __init__(self, path, cmug_configs):
+        self.path = path
+        self.cmug_configs = cmug_configs
+        self.last_saved = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def save(self, task_manager:TaskManager, resource_manager:ResourceManager):
+        """
+        Write the state atomically (the old journal is kept until the new one is complete).
+        Nothing is written if the state is not changed since the last save.
+        """
+        text = json.dumps({
+            "version"   : JOURNAL_VERSION,
+            "config"    : self.cmug_configs,
+            "tasks"     : task_manager.dump_state(),
+            "resources" : resource_manager.dump_state()
+        })
+        if text == self.last_saved:
+            return True
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"{e} when saving the journal {self.path}")
+            return False
+        self.last_saved = text
+        return True
+
+    def load(self):
+        """
+        Returns:
+            the journal content, or None if it is invalid or for other CMU-Group configs.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except Exception as e:
+            print(f"{e} when loading the journal {self.path}")
+            return None
+        if state.get("version") != JOURNAL_VERSION or state.get("config") != self.cmug_configs:
+            print(f"The journal {self.path} does not match the CMU-Group configs.")
+            return None
+        return state
+
+    def restore(self, task_manager:TaskManager, resource_manager:ResourceManager):
+        """ Restore the managers (which should be newly created without clearing the data plane).
+        Returns:
+            True or False (the data plane should be cleared then).
+        """
+        start = time.time()
+        state = self.load()
+        if state is None:
+            return False
+        try:
+            resource_manager.load_state(state["resources"])
+            for task in state["tasks"]["tasks"]:
+                if task.get("holder", task["id"]) != task["id"]:
+                    task_manager.share_task(task["id"], task["holder"], task["status"])
+                    continue
+                task_instance = task_manager.restore_task(task["id"], task["spec"], task["status"])
+                task_instance.locations = [resource_manager.restore_location(loc, task_instance.key)
+                                            for loc in task["locations"]]
+            task_manager.TASK_INC = max(task_manager.TASK_INC, state["tasks"]["task_inc"])
+        except Exception as e:
+            print(traceback.format_exc())
+            print(f"{e} when restoring the journal {self.path}")
+            return False
+        stats = task_manager.reconcile(self.cmug_configs)
+        if stats is None:
+            return False
+        self.last_saved = None
+        print(f"Restored {len(state['tasks']['tasks'])} tasks in {(time.time() - start)*1000:.2f} ms, rules: {stats}")
+        return True
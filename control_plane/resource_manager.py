@@ -1,15 +1,21 @@
-from flymonlib.hash import HASHES_16, HASHES_32
+import math
+from flymonlib.hash import HASHES_16, HASHES_32, XorHasher
 from flymonlib.flymon_runtime import FlyMonRuntime_BfRt
 from flymonlib.location import Location
 from flymonlib.flymon_task import FlyMonTask
 from flymonlib.resource import ResourceType
 from flymonlib.cmu_group import CMU_Group
+from flymonlib.plan import AllocationPlan
+from flymonlib.utils import filters_overlap
 
 class ResourceManager():
     """
     ResourceManager manages all hardware resources.
     """
-    def __init__(self, runtime : FlyMonRuntime_BfRt, cmug_configs):
+    def __init__(self, runtime : FlyMonRuntime_BfRt, cmug_configs, clear=True):
+        """
+        clear: clear all rules and data of the CMU-Groups, False to keep them (e.g., to restore from a journal).
+        """
         self.runtime = runtime
         self.cmu_groups = []
         self.dhashes = {
@@ -34,7 +40,8 @@ class ResourceManager():
                                              stage_start=mau_start, 
                                              candidate_key_list=candidate_key_list, 
                                              std_params=std_params))
-            self.runtime.clear_all(id, type, cmu_num)
+            if clear:
+                self.runtime.clear_all(id, type, cmu_num)
             # Setup Dashes.
             dhash_num = 0
             if type == 1:
@@ -59,12 +66,13 @@ class ResourceManager():
             return
         self.cmu_groups[group_id-1].show_status()
     
-    def allocate_resources(self, task_id, resource_list, mode=1):
+    def allocate_resources(self, task_id, resource_list, mode=1, excluded_cmus=()):
         """
         Dynamic allocate resources for a task.
         Args: 
          - A list of resource object.
          - task_id : used for mark the memory.
+         - excluded_cmus : (group_id, cmu_id) not to use, e.g., CMUs of tasks with overlapping filters (see TaskManager.filter_conflicts).
         Returns:
          - [locations] : a list of Location(group_id, group_type, (hkey1, ...), cmu_id, memory_type, memory_idx)
          - mem_idx is offset on the type of memory, for example ,if the type is 2(HALF)
@@ -84,41 +92,45 @@ class ResourceManager():
                 e) Else, iterate the next CMU-Group.
             f) If don't have enough memory for all CMU-Groups. Release Resources and Return None.
         --------------------------------------------------------------------------------
+        Compressed keys reuse existing hash results, including the XOR of hash units (see CMU_Group.allocate_compressed_keys).
         TODO: Implement a Smarter Allocation strategy. 
-        For example, we need to carefully allocate compressed keys to save hash resources.
-         - If the required compressed key can be generated from XOR from existing keys, we should also reuse the hash results.
          - How to efficient allocate the memory (I mean, improved memory utilization)?
         """
+        locations, _ = self._allocate(self.cmu_groups, task_id, resource_list, excluded_cmus)
+        return locations
+
+    def _allocate(self, cmu_groups, task_id, resource_list, excluded_cmus=()):
+        """
+        The allocation strategy of allocate_resources(), on the given CMU-Groups.
+        Returns:
+         - ([locations], None) or (None, the reason of the failure).
+        """
         locations = []
         if resource_list is None:
-            return locations
-        required_keys = []
-        required_params = []
-        required_memorys = []
-        for resource in resource_list:
-            if resource.type == ResourceType.Memory:
-                required_memorys.append(resource)
-            elif resource.type == ResourceType.CompressedKey:
-                required_keys.append(resource)
-            elif resource.type == ResourceType.StdParam:
-                required_params.append(resource)
-        
-        priority_cmug_list = self.cmu_groups
+            return locations, None
+        required_keys, required_params, required_memorys = self._split_resources(resource_list)
+        reasons = []
+        priority_cmug_list = cmu_groups
         if len(required_memorys) > 1:
             # We favor group_type 2 for multi-row algorithms.
-            priority_cmug_list = sorted(self.cmu_groups, key=lambda x: -x.group_type)
+            priority_cmug_list = sorted(cmu_groups, key=lambda x: -x.group_type)
         for cmug in priority_cmug_list:
             # TODO: each cmug need not to have all required_keys, just at least one flowkey.
-            hkeys = cmug.allocate_compressed_keys(task_id, required_keys) 
+            hkeys = cmug.allocate_compressed_keys(task_id, required_keys, self._xor_allowed(required_keys, required_params, required_memorys))
             has_param = cmug.check_parameters(required_params)
-            if hkeys is not None and has_param:
+            if hkeys is None:
+                reasons.append(f"CMU-Group {cmug.group_id}: no compressed key available")
+            elif not has_param:
+                reasons.append(f"CMU-Group {cmug.group_id}: missing parameters {[str(p.content) for p in required_params]}")
+                cmug.release_compressed_keys(task_id, hkeys)
+            else:
                 used_cmu = []
                 for required_memory in list(required_memorys): # shallow copy
                     if len(used_cmu) == cmug.cmu_num : 
                         break
                     for id in range(cmug.cmu_num):
                         cmu_id = id + 1
-                        if cmu_id not in used_cmu:
+                        if cmu_id not in used_cmu and (cmug.group_id, cmu_id) not in excluded_cmus:
                             # Each task cannot use the same CMU twice.
                             re = cmug.allocate_memory(cmu_id, task_id, required_memory.content, mode=1)
                             if re is not None:
@@ -128,7 +140,7 @@ class ResourceManager():
                                 flow_key = hkeys.pop(0) # use this hkey as flow key
                                 locations.append(Location(                                
                                                            [cmug.group_id, cmug.group_type, hkeys_for_this_location, cmu_id, memory_type, memory_idx], 
-                                                           hasher=self.dhashes[(cmug.group_id, flow_key)] 
+                                                           hasher=self._hasher(cmug, flow_key, required_keys[0].content)
                                                          )
                                                 )
                                 required_memorys.remove(required_memory)
@@ -138,8 +150,15 @@ class ResourceManager():
                             else:
                                 # print("No enough memory")
                                 pass
-                # if len(hkeys) != 0:
-                #     cmug.release_compressed_keys(task_id, hkeys) # release unused hkeys.
+                if len(used_cmu) == 0:
+                    # Nothing is placed in this group, release the unused hkeys.
+                    cmug.release_compressed_keys(task_id, hkeys)
+                elif len(required_memorys) != 0:
+                    # Some rows are not placed in this group, release their hkeys (unless a placed row shares it).
+                    used_hkeys = [hkey for loc in locations if loc.group_id == cmug.group_id for hkey in loc.hkeys]
+                    cmug.release_compressed_keys(task_id, [hkey for hkey in hkeys[:len(required_memorys)] if hkey not in used_hkeys])
+                if len(required_memorys) != 0:
+                    reasons.append(f"CMU-Group {cmug.group_id}: no enough memory for {[r.content for r in required_memorys]}")
                 if len(required_memorys) == 0:
                     break
         if len(required_memorys) != 0:
@@ -147,10 +166,274 @@ class ResourceManager():
             for location in locations:
                 group_id = location.group_id
                 memory_type = location.memory_type
-                self.cmu_groups[group_id-1].release_memory(task_id, memory_type)
-                self.cmu_groups[group_id-1].release_compressed_keys(task_id, location.hkeys)
-            return None
-        return locations
+                cmu_groups[group_id-1].release_memory(task_id, memory_type)
+                cmu_groups[group_id-1].release_compressed_keys(task_id, location.hkeys)
+            return None, "; ".join(reasons)
+        return locations, None
+
+    def _split_resources(self, resource_list):
+        """
+        Returns:
+         - required keys, required params and required memorys of a resource list.
+        """
+        required_keys = []
+        required_params = []
+        required_memorys = []
+        for resource in resource_list:
+            if resource.type == ResourceType.Memory:
+                required_memorys.append(resource)
+            elif resource.type == ResourceType.CompressedKey:
+                required_keys.append(resource)
+            elif resource.type == ResourceType.StdParam:
+                required_params.append(resource)
+        return required_keys, required_params, required_memorys
+
+    def _xor_allowed(self, required_keys, required_params, required_memorys):
+        """
+        The XOR key can only be used with const param1, i.e., there is no param key nor standard param.
+        """
+        return len(required_params) == 0 and len(required_keys) == len(required_memorys)
+
+    def _hasher(self, cmug, hkey, flow_key):
+        """
+        The hasher of a location using the hash unit hkey for the flow key.
+        """
+        if hkey == 12:
+            return XorHasher(self.dhashes[(cmug.group_id, 1)], self.dhashes[(cmug.group_id, 2)],
+                             flow_key, cmug.compressed_key(1), cmug.compressed_key(2))
+        return self.dhashes[(cmug.group_id, hkey)]
+
+    def dump_state(self):
+        """
+        The allocation status of all CMU-Groups as plain data (e.g., for a journal).
+        """
+        return [cmug.dump_state() for cmug in self.cmu_groups]
+
+    def load_state(self, state):
+        """
+        Restore the allocation status from dump_state().
+        """
+        for cmug, cmug_state in zip(self.cmu_groups, state):
+            cmug.load_state(cmug_state)
+
+    def restore_location(self, location_list, flow_key):
+        """
+        Rebuild an allocated location.
+        Args:
+         - location_list : [group_id, group_type, hkeys, cmu_id, memory_type, memory_idx], the same as Location.
+         - flow_key : the key of the task.
+        """
+        cmug = self.cmu_groups[location_list[0]-1]
+        return Location(location_list, hasher=self._hasher(cmug, location_list[2][0], flow_key))
+
+    def key_reuse(self):
+        """
+        Reuse of the hash units in all CMU-Groups, see CMU_Group.key_reuse.
+        Returns:
+            a dict, key : group_id, val : (keys served, hash units in use, keys served by XOR).
+        """
+        return {cmug.group_id : cmug.key_reuse() for cmug in self.cmu_groups}
+
+    def _allocate_best_fit(self, cmu_groups, task_id, resource_list, excluded_cmus=()):
+        """
+        Best-fit allocation of a task: all its memory rows are placed in the CMU-Group (and CMUs)
+        where they split the fewest free blocks, ties are broken by the least rest memory.
+        Falls back to _allocate() if no single CMU-Group can hold the task.
+        Returns:
+         - ([locations], None) or (None, the reason of the failure).
+        """
+        if resource_list is None:
+            return [], None
+        required_keys, required_params, required_memorys = self._split_resources(resource_list)
+        candidates = []
+        for cmug in cmu_groups:
+            if not cmug.check_parameters(required_params):
+                continue
+            fit = cmug.best_fit_cmus([r.content for r in required_memorys],
+                                     [cmu_id for group_id, cmu_id in excluded_cmus if group_id == cmug.group_id])
+            if fit is not None:
+                cmu_ids, waste = fit
+                rest_mem = sum(cmug.rest_memory(cmu_id) for cmu_id in cmu_ids)
+                candidates.append((waste, rest_mem, cmug.group_id, cmug, cmu_ids))
+        candidates.sort(key=lambda x: x[:3])
+        for _, _, _, cmug, cmu_ids in candidates:
+            hkeys = cmug.allocate_compressed_keys(task_id, required_keys, self._xor_allowed(required_keys, required_params, required_memorys))
+            if hkeys is None:
+                continue
+            locations = []
+            row_num = len(required_memorys)
+            for row, (required_memory, cmu_id) in enumerate(zip(required_memorys, cmu_ids)):
+                memory_type, memory_idx = cmug.allocate_memory(cmu_id, task_id, required_memory.content, mode=1)
+                locations.append(Location([cmug.group_id, cmug.group_type, [hkeys[row]] + hkeys[row_num:], cmu_id, memory_type, memory_idx],
+                                          hasher=self._hasher(cmug, hkeys[row], required_keys[row].content)))
+            return locations, None
+        return self._allocate(cmu_groups, task_id, resource_list, excluded_cmus)
+
+    def allocate_batch(self, task_instances, conflicts=None):
+        """
+        Allocate resources for many tasks at once.
+        Both first-fit (allocate_resources one by one in the given order) and best-fit decreasing
+        (tasks with larger memory footprints first, each one by _allocate_best_fit()) are planned on forks,
+        the plan accepting more tasks (then with the higher memory utilization) is applied.
+        Tasks of the batch with overlapping filters are not placed in the same CMU.
+        Args:
+         - task_instances : a list of FlyMonTask.
+         - conflicts : a function which returns the (group_id, cmu_id) a task can not use,
+                       e.g., TaskManager.filter_conflicts for the installed tasks.
+        Returns:
+         - a dict, key : task_id, val : [locations] or None (rejected).
+        """
+        ordered = self._decreasing(task_instances)
+        first_fit = self._plan_tasks(task_instances, self._allocate, conflicts)
+        best_fit = self._plan_tasks(ordered, self._allocate_best_fit, conflicts)
+        print(f"Batch allocation: best-fit decreasing accepted {best_fit.accepted}/{len(task_instances)}, "
+              f"memory utilization {best_fit.utilization*100:.2f}%; "
+              f"first-fit accepted {first_fit.accepted}/{len(task_instances)}, "
+              f"memory utilization {first_fit.utilization*100:.2f}%")
+        if (first_fit.accepted, first_fit.utilization) > (best_fit.accepted, best_fit.utilization):
+            print("Apply the first-fit allocation.")
+            ordered, strategy = task_instances, self._allocate
+        else:
+            print("Apply the best-fit decreasing allocation.")
+            strategy = self._allocate_best_fit
+        # The strategies are deterministic, so replaying the plan gives the same allocation.
+        allocated = self._assign(self.cmu_groups, ordered, strategy, conflicts)
+        return {task_id : locations for task_id, (locations, _) in allocated.items()}
+
+    def _decreasing(self, task_instances):
+        """
+        Tasks ordered by their memory footprint (rows x block size), the largest first.
+        Tasks with more rows go first on ties, as they need more CMUs of a group.
+        """
+        def footprint(task_instance):
+            block_size = 2**math.ceil(math.log2(max(task_instance.mem_size / task_instance.mem_num, 1)))
+            return (-task_instance.mem_num * block_size, -task_instance.mem_num)
+        return sorted(task_instances, key=footprint)
+
+    def _utilization(self, cmu_groups):
+        total = 0
+        used = 0
+        for cmug in cmu_groups:
+            for cmu_id in range(1, cmug.cmu_num + 1):
+                total += cmug.memory_size
+                used += cmug.memory_size - cmug.rest_memory(cmu_id)
+        return used / total if total != 0 else 0.0
+
+    def plan(self, task_specs, batch=False, conflicts=None):
+        """
+        What-if allocation of a set of tasks, nothing is changed in the CMU-Groups.
+        The tasks are allocated one by one (the same as allocate_resources) on copy-on-write forks of the CMU-Groups.
+        Args:
+         - task_specs : a list of (filter, key, attribute, mem_size), the same as TaskManager.register_task.
+         - batch : plan them as allocate_batch() (best-fit decreasing) instead of allocate_resources() one by one.
+         - conflicts : the same as allocate_batch().
+        Returns:
+         - an AllocationPlan, indexed by the position in task_specs.
+        """
+        task_instances = []
+        invalid = {}
+        for idx, (filter, key, attribute, mem_size) in enumerate(task_specs):
+            # Planned tasks are marked with negative ids, which are never used by real tasks.
+            try:
+                task_instances.append(FlyMonTask(-(idx + 1), filter, key, attribute, mem_size))
+            except Exception as e:
+                invalid[-(idx + 1)] = f"Invalid task: {e}"
+        if batch:
+            plan = self._plan_tasks(self._decreasing(task_instances), self._allocate_best_fit, conflicts)
+        else:
+            plan = self._plan_tasks(task_instances, self._allocate, conflicts)
+        plan.rejections.update(invalid)
+        # Index the plan by the position of the specs.
+        plan.locations = {-task_id - 1 : locations for task_id, locations in plan.locations.items()}
+        plan.rejections = {-task_id - 1 : reason for task_id, reason in plan.rejections.items()}
+        return plan
+
+    def _assign(self, cmu_groups, task_instances, strategy, conflicts=None):
+        """
+        Allocate the tasks in order with the strategy on the CMU-Groups.
+        A task does not use the CMUs returned by conflicts, nor the CMUs assigned to the earlier tasks
+        whose filters overlap its filter.
+        Returns:
+         - a dict, key : task_id, val : ([locations], None) or (None, the reason of the failure).
+        """
+        allocated = {}
+        placed = []
+        for task_instance in task_instances:
+            excluded_cmus = set(conflicts(task_instance)) if conflicts is not None else set()
+            for filter, locations in placed:
+                if filters_overlap(filter, task_instance.filter):
+                    excluded_cmus.update((loc.group_id, loc.cmu_id) for loc in locations)
+            locations, reason = strategy(cmu_groups, task_instance.id, task_instance.resource_list(), excluded_cmus)
+            if locations is not None:
+                placed.append((task_instance.filter, locations))
+            allocated[task_instance.id] = (locations, reason)
+        return allocated
+
+    def _plan_tasks(self, task_instances, strategy, conflicts=None):
+        """
+        Allocate the tasks in order with the strategy on forks of the CMU-Groups.
+        Returns:
+         - an AllocationPlan, indexed by task id.
+        """
+        cmu_groups = [cmug.fork() for cmug in self.cmu_groups]
+        plan = AllocationPlan()
+        for task_id, (locations, reason) in self._assign(cmu_groups, task_instances, strategy, conflicts).items():
+            if locations is None:
+                plan.rejections[task_id] = reason
+            else:
+                plan.locations[task_id] = locations
+        for cmug in cmu_groups:
+            for cmu_id in range(1, cmug.cmu_num + 1):
+                plan.leftover[(cmug.group_id, cmu_id)] = cmug.rest_memory(cmu_id)
+                plan.fragmentation[(cmug.group_id, cmu_id)] = cmug.fragmentation(cmu_id)
+        plan.utilization = self._utilization(cmu_groups)
+        return plan
+
+    def plan_defrag(self, mem_size=None):
+        """
+        Plan the memory moves which compact the CMUs of all CMU-Groups, nothing is changed.
+        Args:
+         - mem_size : compact each CMU until a block of the size is free, None to compact the whole memory.
+        Returns:
+         - a list of moves in order, each one is (group_id, cmu_id, task_id, memory_type, memory_idx, new_idx).
+        """
+        moves = []
+        for cmug in self.cmu_groups:
+            for cmu_id in range(1, cmug.cmu_num + 1):
+                for task_id, memory_type, memory_idx, new_idx in cmug.plan_defrag(cmu_id, mem_size):
+                    moves.append((cmug.group_id, cmu_id, task_id, memory_type, memory_idx, new_idx))
+        return moves
+
+    def move_memory(self, group_id, cmu_id, task_id, memory_type, memory_idx, new_idx):
+        """
+        Move a memory block of a task to a free block of the same type in the CMU.
+        """
+        return self.cmu_groups[group_id-1].move_memory(cmu_id, task_id, memory_type, memory_idx, new_idx)
+
+    def reallocate_resources(self, task_id, resource_list, excluded_cmus=()):
+        """ Allocate resources for a new version of a task (see TaskManager.modify_task).
+        The old version keeps its resources, the new ones are held by a temporary id (-task_id)
+        until commit_reallocation() or abort_reallocation().
+        Returns:
+         - a list of locations, or None (nothing is changed).
+        """
+        return self.allocate_resources(-task_id, resource_list, excluded_cmus=excluded_cmus)
+
+    def commit_reallocation(self, task_instance: FlyMonTask):
+        """
+        Release the resources of the old version of a task, and hand the new ones over to the task id.
+        """
+        self.release_task(task_instance)
+        for cmug in self.cmu_groups:
+            cmug.rename_task(-task_instance.id, task_instance.id)
+
+    def abort_reallocation(self, task_id, locations):
+        """
+        Release the resources allocated by reallocate_resources().
+        """
+        for location in locations:
+            self.cmu_groups[location.group_id-1].release_memory(-task_id, location.memory_type)
+            self.cmu_groups[location.group_id-1].release_compressed_keys(-task_id, location.hkeys)
 
     def release_task(self, task_instance: FlyMonTask):
         """
@@ -0,0 +1,277 @@
+import os
+import bisect
+import json
+import mmap
+import zlib
+from collections import deque
+import numpy as np
+from flymonlib.snapshot import TaskSnapshot
+
+
+# Default number of recent epochs of each task kept in memory.
+RING_SIZE = 16
+# Default number of epochs between two keyframes on disk, it bounds the deltas decoded for a read.
+KEYFRAME_INTERVAL = 32
+
+class SnapshotStore:
+    """
+    Local history of the task memories, so that analyses over epochs run without reading the switch again.
+    Snapshots are keyed by (task_id, epoch), with one data array for each location of the task:
+        1. the recent epochs of a task are kept in memory, in a ring buffer.
+        2. older epochs are spilled to a data file of the task, which is memory-mapped for reading.
+           Each location is stored as the zlib compressed delta to the previous epoch (with wrap-around
+           in its dtype), or in full as a keyframe every KEYFRAME_INTERVAL epochs or when the layout changes.
+        3. an index of each task holds the epoch end times in order, so a time range is found by bisection.
+    The index of the spilled epochs is appended to an index file, so the history survives a restart.
+    """
+    def __init__(self, path=None, ring_size=RING_SIZE, keyframe_interval=KEYFRAME_INTERVAL):
+        """
+        path: the directory of the spilled epochs, None to keep the ring buffers only (older epochs are dropped).
+        """
+        self.path = path
+        self.ring_size = ring_size
+        self.keyframe_interval = keyframe_interval
+        self.rings = {
+            # key : task id
+            # val : a deque of (epoch, TaskSnapshot), the most recent last.
+        }
+        self.index = {
+            # key : task id
+            # val : a list of records of the spilled epochs in order, see _spill.
+        }
+        self.times = {
+            # key : task id
+            # val : [epoch ids, epoch end times] of all the stored epochs, in order.
+        }
+        self.next_epoch = {
+            # key : task id
+            # val : id of the next epoch
+        }
+        self.maps = {
+            # key : task id
+            # val : (file object, mmap) of the data file.
+        }
+        self.decoded = {
+            # key : task id
+            # val : (epoch, data) of the last epoch decoded from disk, so that sequential reads apply one delta.
+        }
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._load_index()
+
+    def add(self, snapshot:TaskSnapshot):
+        """ Keep the snapshot of an epoch.
+        Returns:
+            the epoch id (increasing for each task).
+        """
+        task_id = snapshot.task_id
+        epoch = self.next_epoch.get(task_id, 0)
+        self.next_epoch[task_id] = epoch + 1
+        ring = self.rings.setdefault(task_id, deque())
+        ring.append((epoch, snapshot))
+        epochs, ends = self.times.setdefault(task_id, ([], []))
+        epochs.append(epoch)
+        ends.append(snapshot.epoch_end)
+        while len(ring) > self.ring_size:
+            old_epoch, old_snapshot = ring.popleft()
+            if self.path is not None:
+                self._spill(old_epoch, old_snapshot)
+            else:
+                del epochs[0]
+                del ends[0]
+        return epoch
+
+    def get(self, task_id, epoch):
+        """
+        Returns:
+            the TaskSnapshot of an epoch, None if it is not stored.
+        """
+        for ring_epoch, snapshot in self.rings.get(task_id, ()):
+            if ring_epoch == epoch:
+                return snapshot
+        records = self.index.get(task_id, [])
+        if len(records) == 0 or not records[0]["epoch"] <= epoch <= records[-1]["epoch"]:
+            return None
+        # Spilled epochs are continuous.
+        record = records[epoch - records[0]["epoch"]]
+        return TaskSnapshot(task_id, self._decode(task_id, epoch), record["start"], record["end"])
+
+    def read_location(self, task_id, location_idx, epoch):
+        """
+        Returns:
+            the data array of a location of the task in an epoch, None if it is not stored.
+        """
+        snapshot = self.get(task_id, epoch)
+        if snapshot is None or location_idx >= len(snapshot.data):
+            return None
+        return snapshot.data[location_idx]
+
+    def epochs(self, task_id, begin=None, end=None):
+        """
+        Returns:
+            the ids of the stored epochs of the task which end in [begin, end] (None for no bound), in order.
+        """
+        if task_id not in self.times:
+            return []
+        epochs, ends = self.times[task_id]
+        low = 0 if begin is None else bisect.bisect_left(ends, begin)
+        high = len(ends) if end is None else bisect.bisect_right(ends, end)
+        return epochs[low:high]
+
+    def range(self, task_id, begin=None, end=None):
+        """
+        Returns:
+            the TaskSnapshots of the task which end in [begin, end], in order.
+        """
+        return [self.get(task_id, epoch) for epoch in self.epochs(task_id, begin, end)]
+
+    def latest(self, task_id, num=1):
+        """
+        Returns:
+            the last num TaskSnapshots of the task, in order.
+        """
+        return [self.get(task_id, epoch) for epoch in self.epochs(task_id)[-num:]]
+
+    def drop(self, task_id):
+        """
+        Forget the history of a task (e.g., it is deleted), its files are removed.
+        """
+        self.rings.pop(task_id, None)
+        self.index.pop(task_id, None)
+        self.times.pop(task_id, None)
+        self.decoded.pop(task_id, None)
+        self._unmap(task_id)
+        if self.path is not None:
+            for file_name in [self._data_file(task_id), self._index_file(task_id)]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def stats(self):
+        memory_bytes = sum(sum(data.nbytes for data in snapshot.data)
+                            for ring in self.rings.values() for _, snapshot in ring)
+        raw_bytes = sum(record["raw"] for records in self.index.values() for record in records)
+        compressed_bytes = sum(sum(blob[1] for blob in record["blobs"])
+                                for records in self.index.values() for record in records)
+        return {
+            "tasks"         : len(self.times),
+            "memory_epochs" : sum(len(ring) for ring in self.rings.values()),
+            "memory_bytes"  : memory_bytes,
+            "disk_epochs"   : sum(len(records) for records in self.index.values()),
+            "disk_bytes"    : compressed_bytes,
+            "ratio"         : raw_bytes / compressed_bytes if compressed_bytes > 0 else None
+        }
+
+    def close(self):
+        """
+        Spill the ring buffers to disk (if there is a path) and unmap the data files.
+        """
+        if self.path is not None:
+            for ring in self.rings.values():
+                while len(ring) > 0:
+                    self._spill(*ring.popleft())
+        for task_id in list(self.maps.keys()):
+            self._unmap(task_id)
+
+    def _spill(self, epoch, snapshot:TaskSnapshot):
+        """
+        Append an epoch to the data file of its task, and its record to the index file.
+        A record: {"epoch", "start", "end", "key" : the epoch of its keyframe, "raw" : the bytes before compression,
+                   "blobs" : [offset, length, dtype, size] of each location in the data file}.
+        """
+        task_id = snapshot.task_id
+        records = self.index.setdefault(task_id, [])
+        data = [np.asarray(row) for row in snapshot.data]
+        last = records[-1] if len(records) > 0 else None
+        keyframe = (last is None or last["epoch"] != epoch - 1
+                    or epoch - last["key"] >= self.keyframe_interval
+                    or [(blob[2], blob[3]) for blob in last["blobs"]] != [(row.dtype.str, len(row)) for row in data])
+        if not keyframe:
+            prev = self._decode(task_id, last["epoch"])
+        self._unmap(task_id)
+        blobs = []
+        with open(self._data_file(task_id), 'ab') as f:
+            offset = f.tell()
+            for idx, row in enumerate(data):
+                # Unsigned subtraction wraps around, so the delta is reversible.
+                payload = row if keyframe else row - prev[idx]
+                blob = zlib.compress(payload.tobytes(), 1)
+                f.write(blob)
+                blobs.append([offset, len(blob), row.dtype.str, len(row)])
+                offset += len(blob)
+        record = {
+            "epoch" : epoch,
+            "start" : snapshot.epoch_start,
+            "end"   : snapshot.epoch_end,
+            "key"   : epoch if keyframe else last["key"],
+            "raw"   : sum(row.nbytes for row in data),
+            "blobs" : blobs
+        }
+        records.append(record)
+        with open(self._index_file(task_id), 'a') as f:
+            f.write(json.dumps(record) + "\n")
+        self.decoded[task_id] = (epoch, [row.copy() for row in data])
+
+    def _decode(self, task_id, epoch):
+        """
+        Rebuild the data of a spilled epoch from its keyframe (or the last decoded epoch) and the deltas.
+        """
+        records = self.index[task_id]
+        first = records[0]["epoch"]
+        record = records[epoch - first]
+        decoded_epoch, data = self.decoded.get(task_id, (None, None))
+        if decoded_epoch == epoch:
+            return [row.copy() for row in data]
+        if decoded_epoch is not None and record["key"] <= decoded_epoch < epoch:
+            begin = decoded_epoch + 1
+        else:
+            begin = record["key"]
+        buf = self._map(task_id)
+        for step in range(begin, epoch + 1):
+            step_record = records[step - first]
+            rows = [np.frombuffer(zlib.decompress(buf[offset:offset + length]), dtype=dtype, count=size)
+                        for offset, length, dtype, size in step_record["blobs"]]
+            if step == step_record["key"]:
+                data = rows
+            else:
+                data = [prev + row for prev, row in zip(data, rows)]
+        self.decoded[task_id] = (epoch, data)
+        return [row.copy() for row in data]
+
+    def _map(self, task_id):
+        if task_id not in self.maps:
+            f = open(self._data_file(task_id), 'rb')
+            self.maps[task_id] = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return self.maps[task_id][1]
+
+    def _unmap(self, task_id):
+        if task_id in self.maps:
+            f, buf = self.maps.pop(task_id)
+            buf.close()
+            f.close()
+
+    def _load_index(self):
+        """
+        Load the index files of the spilled epochs (e.g., after a restart).
+        """
+        for file_name in sorted(os.listdir(self.path)):
+            if not (file_name.startswith("task") and file_name.endswith(".idx")):
+                continue
+            task_id = int(file_name[len("task"):-len(".idx")])
+            records = []
+            with open(os.path.join(self.path, file_name), 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if len(records) > 0 and records[-1]["epoch"] != record["epoch"] - 1:
+                        records.clear()
+                    records.append(record)
+            if len(records) == 0:
+                continue
+            self.index[task_id] = records
+            self.times[task_id] = ([record["epoch"] for record in records], [record["end"] for record in records])
+            self.next_epoch[task_id] = records[-1]["epoch"] + 1
+
+    def _data_file(self, task_id):
+        return os.path.join(self.path, f"task{task_id}.dat")
+
+    def _index_file(self, task_id):
+        return os.path.join(self.path, f"task{task_id}.idx")
@@ -4,7 +4,10 @@ from flymonlib.param import ParamType
 from flymonlib.resource import *
 from flymonlib.flymon_task import FlyMonTask
 from flymonlib.flymon_runtime import FlyMonRuntime_BfRt
-from flymonlib.utils import calc_keymapping
+from flymonlib.utils import calc_key_mask, calc_compact_keymapping, filters_overlap
+
+# The task id is 8 bits in the data plane, and 0 is not a task.
+MAX_TASK_ID = 255
 
 class TaskManager:
     def __init__(self, runtime : FlyMonRuntime_BfRt, cmug_configs : dict):
@@ -21,6 +24,7 @@ class TaskManager:
             # key : task_id
             # val : [status, task_instance, [init_rules], [preprocessing_rules], [operation_rules]]
             #        status : True (Active) / False (Idle)
+            # Tasks with the same spec share one instance (see share_task), whose id is the task holding the rules.
         }
         self.TASK_INC = 0
 
@@ -34,13 +38,29 @@ class TaskManager:
             A task object with resource lists and data querier.
         Exceptions:
             may rase some exception when generate a FlyMonTask object.
+            RuntimeError if all the task ids are in use.
         """
-        task_id = self.TASK_INC + 1
-        self.TASK_INC += 1
+        task_id = self._next_task_id()
+        if task_id is None:
+            raise RuntimeError(f"No task id available, at most {MAX_TASK_ID} tasks can be active.")
+        self.TASK_INC = task_id
         task_instance = FlyMonTask(task_id, filter, key, attribute, mem_size)
         self.tasks[task_id] = [False, task_instance] 
         return task_instance
     
+    def _next_task_id(self):
+        """
+        The next task id after the last one, ids wrap around to the ids of deleted tasks
+        once MAX_TASK_ID is taken. An id is in use while a task is active or its rules are shared by an active task.
+        """
+        used = set(instance.id for status, instance in self.tasks.values() if status is True)
+        used.update(task_id for task_id, (status, _) in self.tasks.items() if status is True)
+        for offset in range(MAX_TASK_ID):
+            task_id = (self.TASK_INC + offset) % MAX_TASK_ID + 1
+            if task_id not in used:
+                return task_id
+        return None
+
     def install_task(self, task_id):
         """ Install rules for a task instance and make it active.
         Args:
@@ -57,70 +77,365 @@ class TaskManager:
                 3. install preprocessing stage rules according to locations and attribute.param_mapping
                 4. install operation stage rules according to attribute.operation
         """
+        return self.install_tasks([task_id])
+
+    def install_tasks(self, task_ids):
+        """ Install rules for several tasks in a single batched write request.
+        Args:
+            task_ids: a list of task ids.
+        Returns:
+            True if all the tasks are installed. 
+            False if any rule fails, and then no rule of these tasks remains in the data plane.
+        """
+        self.runtime.begin_batch()
+        try:
+            for task_id in task_ids:
+                self._install_rules(self.tasks[task_id][1])
+            self.runtime.commit_batch()
+        except Exception as e:
+            print(f"Failed! {e} when install rules for task {task_ids}")
+            print(traceback.format_exc())
+            # withdraw installed rules (nothing has been written if the batch is not sent).
+            self.runtime.abort_batch()
+            for task_id in task_ids:
+                for loc in self.tasks[task_id][1].locations:
+                    loc.init_rules = []
+                    loc.prep_rules = []
+                    loc.oper_rules = []
+            return False
+        for task_id in task_ids:
+            self.tasks[task_id][0] = True
+        return True
+
+    def find_identical(self, task_instance):
+        """
+        Returns:
+            the id of an active task which measures the same as task_instance (filter, key, attribute and memory size), or None.
+        """
+        spec = self._normalized_spec(task_instance)
+        for task_id, (status, instance) in self.tasks.items():
+            if status is True and instance is not task_instance and self._normalized_spec(instance) == spec:
+                return task_id
+        return None
+
+    def _normalized_spec(self, task_instance):
+        return (task_instance.filter, str(task_instance.key), task_instance.spec[2].replace(" ", ""), task_instance.mem_size)
+
+    def share_task(self, task_id, shared_id, status=True):
+        """ Make a task use the rules and memory of an identical task (see find_identical), nothing is installed.
+        The rules are removed (and the resources can be released) when the last task using them is uninstalled.
+        The tasks also share the counters: the new task reads the traffic counted since shared_id was installed,
+        and a reset of either task clears the data of both. So is_shared tasks are not reset (see FlyMonController).
+        """
+        self.tasks[task_id] = [status, self.tasks[shared_id][1]]
+        self.TASK_INC = max(self.TASK_INC, task_id)
+
+    def ref_count(self, task_id):
+        """
+        Returns:
+            the number of active tasks using the rules of the task (itself included).
+        """
+        instance = self.tasks[task_id][1]
+        return sum(1 for status, other in self.tasks.values() if status is True and other is instance)
+
+    def is_shared(self, task_id):
+        """
+        If the rules of the task are used by another active task, its resources should not be released.
+        """
+        instance = self.tasks[task_id][1]
+        return any(status is True and other is instance for other_id, (status, other) in self.tasks.items() if other_id != task_id)
+
+    def filter_conflicts(self, task_instance):
+        """
+        A CMU applies one task to a packet, so tasks with overlapping filters can not run in the same CMU.
+        Other versions of the task itself (see modify_task) are not conflicts.
+        Returns:
+            a set of (group_id, cmu_id) used by active tasks whose filters overlap the filter of task_instance.
+        """
+        conflicts = set()
+        for status, instance in self.tasks.values():
+            if status is True and instance.id != task_instance.id and filters_overlap(instance.filter, task_instance.filter):
+                conflicts.update((loc.group_id, loc.cmu_id) for loc in instance.locations)
+        return conflicts
+
+    def _install_rules(self, task_instance):
+        for location in task_instance.locations:
+            self._install_location(task_instance, location)
+
+    def _install_location(self, task_instance, location):
+        key_mask, key_mapping = self._key_mapping(location)
+        # Install the compression stage, an unchanged hash config is not sent again by the runtime.
+        if location.hkeys[0] != 12:
+            # The XOR key reuses the hash units 1 and 2, which are configured by other tasks.
+            self.runtime.compression_stage_config(location.group_id, location.group_type,
+                                                  location.hkeys[0], task_instance.key)
+        # Install the initialization stage.
+        location.init_rules = self._initialization_rules(task_instance, location, key_mask)
+        # # Install the pre-processing stage.
+        if self._need_preprocessing(task_instance, key_mapping):
+            location.prep_rules = self.runtime.preprocessing_stage_add(location.group_id, location.group_type, location.cmu_id,
+                                                task_instance.id, 
+                                                key_mapping,  # Key mappings.
+                                                task_instance.attribute.param_mapping) # Param1 mappings.
+        # # Install the operation stage.
+        location.oper_rules = self.runtime.operation_stage_add(location.group_id, location.group_type, location.cmu_id,
+                                               task_instance.id, task_instance.attribute.operation)
+
+    def _initialization_rules(self, task_instance, location, key_mask, modify=False):
+        """
+        Install (or modify in place) the initialization stage rule of a location.
+        """
+        if task_instance.attribute.param1.type == ParamType.CompressedKey:
+            self.runtime.compression_stage_config(location.group_id, location.group_type,
+                                                  location.hkeys[1], task_instance.attribute.param1.content)
+            param1 = (task_instance.attribute.param1, location.hkeys[1])
+        elif task_instance.attribute.param1.type == ParamType.Key:
+            self.runtime.compression_stage_config(location.group_id, location.group_type,
+                                                  location.hkeys[1], task_instance.key)
+            param1 = (task_instance.attribute.param1, location.hkeys[1])
+        else:
+            param1 = (task_instance.attribute.param1, None)
+        return self.runtime.initialization_stage_add(location.group_id, location.group_type, location.cmu_id,
+                                                task_instance.filter, # Filter
+                                                task_instance.id,
+                                                location.hkeys[0],   # key
+                                                param1,
+                                                task_instance.attribute.param2,
+                                                key_mask, modify)
+
+    def _need_preprocessing(self, task_instance, key_mapping):
+        return any(offset != 0 for offset in key_mapping.values()) or len(task_instance.attribute.param_mapping) != 0
+
+    def _key_mapping(self, location):
+        """
+        Address translation into the memory block of a location.
+        Returns:
+            key_mask (of the initialization stage) and key_mapping (of the preprocessing stage).
+        """
+        # The key is masked into the block size, then a single rule moves it to the block.
+        key_mask = calc_key_mask(self.cmug_bitw[location.group_id], location.memory_type)
+        key_mapping = calc_compact_keymapping(self.cmug_bitw[location.group_id], location.memory_type, location.memory_idx)
+        return key_mask, key_mapping
+
+    def relocate_location(self, task_id, location, memory_idx):
+        """ Move a location of a task to another memory block of the same type.
+        Only the preprocessing rules (address translation) are switched, in place.
+        Args:
+            location: one of the task locations, its memory_idx is updated.
+            memory_idx: offset of the new block on the type of memory.
+        Returns:
+            True or False (nothing is changed).
+        """
         task_instance = self.tasks[task_id][1]
+        old_idx = location.memory_idx
+        old_mapping = {}
+        if len(location.prep_rules) != 0:
+            old_mapping = self._key_mapping(location)[1]
+        location.memory_idx = memory_idx
+        if self.ref_count(task_id) == 0:
+            return True
+        _, key_mapping = self._key_mapping(location)
+        self.runtime.begin_batch()
+        try:
+            prep_rules = self.runtime.preprocessing_stage_update(location.group_id, location.group_type, location.cmu_id,
+                                                                 task_id, old_mapping, key_mapping,
+                                                                 task_instance.attribute.param_mapping)
+            self.runtime.commit_batch()
+        except Exception as e:
+            print(f"Failed! {e} when relocate task {task_id}")
+            print(traceback.format_exc())
+            self.runtime.abort_batch()
+            location.memory_idx = old_idx
+            return False
+        location.prep_rules = prep_rules
+        return True
+
+    def derive_task(self, task_id, filter=None, attribute=None, mem_size=None):
+        """ A new version of a task with another filter, attribute or memory size (None to keep it).
+        The version is not registered, see modify_task.
+        Returns:
+            A task object with the same id and key.
+        """
+        old_filter, key, old_attribute, old_mem_size = self.tasks[task_id][1].spec
+        return FlyMonTask(task_id, filter if filter is not None else old_filter, key,
+                                   attribute if attribute is not None else old_attribute,
+                                   mem_size if mem_size is not None else old_mem_size)
+
+    def modify_task(self, task_id, task_instance):
+        """ Switch a task to a new version (see derive_task) without stopping the measurement.
+        The locations of the new version should be allocated while the old ones are still held (see ResourceManager.reallocate_resources).
+            - in a CMU used by both versions, the rules are modified in place (a filter change adds the new entry before deleting the old one).
+            - in a CMU used by the new version only, the rules are added before any old rule is deleted.
+            - in a CMU used by the old version only, the rules are deleted at last.
+        Args:
+            task_instance: the new version, which replaces the old one if succeeded.
+        Returns:
+            True or False (the old version is kept).
+        """
+        status, old_instance = self.tasks[task_id][0], self.tasks[task_id][1]
+        if old_instance.id != task_id or self.is_shared(task_id):
+            print(f"Task {task_id} shares rules with other tasks, it can not be modified.")
+            return False
+        if status is False:
+            self.tasks[task_id][1] = task_instance
+            return True
+        old_locations = {(loc.group_id, loc.cmu_id) : loc for loc in old_instance.locations}
+        self.runtime.begin_batch()
         try:
             for location in task_instance.locations:
-                # Install the compression stage.
-                # TODO: if the hash is already configured, do not configure again.
-                self.runtime.compression_stage_config(location.group_id, location.group_type,
-                                                      location.hkeys[0], task_instance.key)
-                # Install the initialization stage.
-                if task_instance.attribute.param1.type == ParamType.CompressedKey:
-                    self.runtime.compression_stage_config(location.group_id, location.group_type,
-                                                          location.hkeys[1], task_instance.attribute.param1.content)
-                    location.init_rules = self.runtime.initialization_stage_add(location.group_id, location.group_type, location.cmu_id,
-                                                            task_instance.filter, # Filter
-                                                            task_instance.id,
-                                                            location.hkeys[0],   # key
-                                                            (task_instance.attribute.param1, location.hkeys[1]),
-                                                            task_instance.attribute.param2)
-                elif task_instance.attribute.param1.type == ParamType.Key:
-                    self.runtime.compression_stage_config(location.group_id, location.group_type,
-                                                          location.hkeys[1], task_instance.key)
-                    location.init_rules = self.runtime.initialization_stage_add(location.group_id, location.group_type, location.cmu_id,
-                                                            task_instance.filter, # Filter
-                                                            task_instance.id,
-                                                            location.hkeys[0],   # key
-                                                            (task_instance.attribute.param1, location.hkeys[1]),
-                                                            task_instance.attribute.param2)
+                old_location = old_locations.pop((location.group_id, location.cmu_id), None)
+                if old_location is None:
+                    self._install_location(task_instance, location)
                 else:
-                    location.init_rules = self.runtime.initialization_stage_add(location.group_id, location.group_type, location.cmu_id,
-                                                            task_instance.filter, # Filter
-                                                            task_instance.id,
-                                                            location.hkeys[0],
-                                                            (task_instance.attribute.param1, None),
-                                                            task_instance.attribute.param2)
-                # # Install the pre-processing stage.
-                if location.memory_type != MemoryType.WHOLE.value or len(task_instance.attribute.param_mapping) != 0:
-                    location.prep_rules = self.runtime.preprocessing_stage_add(location.group_id, location.group_type, location.cmu_id,
-                                                        task_instance.id, 
-                                                        calc_keymapping(self.cmug_bitw[location.group_id], 
-                                                                        location.memory_type, 
-                                                                        location.memory_idx),  # Key mappings.
-                                                        task_instance.attribute.param_mapping) # Param1 mappings.
-                # # Install the operation stage.
-                location.oper_rules = self.runtime.operation_stage_add(location.group_id, location.group_type, location.cmu_id,
-                                                       task_instance.id, task_instance.attribute.operation)
-                # pass
-            self.tasks[task_instance.id][0] = True
+                    self._update_location(old_instance, old_location, task_instance, location)
+            for loc in old_locations.values():
+                self.runtime.initialization_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.init_rules)
+                self.runtime.preprocessing_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.prep_rules)
+                self.runtime.operation_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.oper_rules)
+            self.runtime.commit_batch()
         except Exception as e:
-            print(f"Failed! {e} when install rules for task {task_instance.id}")
+            print(f"Failed! {e} when modify task {task_id}")
             print(traceback.format_exc())
-            # withdraw installed rules.
-            self.uninstall_task(task_id)
+            self.runtime.abort_batch()
+            for loc in task_instance.locations:
+                loc.init_rules = []
+                loc.prep_rules = []
+                loc.oper_rules = []
             return False
+        self.tasks[task_id][1] = task_instance
         return True
 
+    def _update_location(self, old_instance, old_location, task_instance, location):
+        """
+        Switch the rules of a CMU from an old location to a new one in place.
+        The key mask and the block offset are switched in the order that keeps addresses inside one of the blocks:
+        a growing block is moved first and then unmasked, a shrinking block is masked first and then moved.
+        """
+        key_mask, key_mapping = self._key_mapping(location)
+        old_mapping = self._key_mapping(old_location)[1] if len(old_location.prep_rules) != 0 else {}
+        if not self._need_preprocessing(task_instance, key_mapping):
+            key_mapping = {}
+        if location.hkeys[0] != 12:
+            self.runtime.compression_stage_config(location.group_id, location.group_type,
+                                                  location.hkeys[0], task_instance.key)
+        def switch_initialization():
+            if task_instance.filter == old_instance.filter:
+                location.init_rules = self._initialization_rules(task_instance, location, key_mask, modify=True)
+            else:
+                location.init_rules = self._initialization_rules(task_instance, location, key_mask)
+                self.runtime.initialization_stage_del(location.group_id, location.group_type, location.cmu_id, old_location.init_rules)
+        def switch_preprocessing():
+            if task_instance.attribute.param_mapping == old_instance.attribute.param_mapping:
+                location.prep_rules = self.runtime.preprocessing_stage_update(location.group_id, location.group_type, location.cmu_id,
+                                                                              task_instance.id, old_mapping, key_mapping,
+                                                                              task_instance.attribute.param_mapping)
+            else:
+                # The match keys change with the param mappings, they can not be modified in place.
+                self.runtime.preprocessing_stage_del(location.group_id, location.group_type, location.cmu_id, old_location.prep_rules)
+                location.prep_rules = []
+                if len(key_mapping) != 0:
+                    location.prep_rules = self.runtime.preprocessing_stage_add(location.group_id, location.group_type, location.cmu_id,
+                                                                               task_instance.id, key_mapping,
+                                                                               task_instance.attribute.param_mapping)
+        if location.memory_type < old_location.memory_type:
+            switch_preprocessing()
+            switch_initialization()
+        else:
+            switch_initialization()
+            switch_preprocessing()
+        if task_instance.attribute.operation != old_instance.attribute.operation:
+            location.oper_rules = self.runtime.operation_stage_add(location.group_id, location.group_type, location.cmu_id,
+                                                                   task_instance.id, task_instance.attribute.operation, modify=True)
+        else:
+            location.oper_rules = old_location.oper_rules
+
+    def dump_state(self):
+        """
+        The tasks and their locations as plain data (e.g., for a journal).
+        The rules are not included, they are rebuilt from the locations.
+        """
+        tasks = []
+        for task_id, (status, task_instance) in self.tasks.items():
+            locations = [[loc.group_id, loc.group_type, loc.hkeys, loc.cmu_id, loc.memory_type, loc.memory_idx]
+                            for loc in task_instance.locations]
+            tasks.append({"id" : task_id, "status" : status, "spec" : list(task_instance.spec), "locations" : locations,
+                          "holder" : task_instance.id})
+        return {"task_inc" : self.TASK_INC, "tasks" : tasks}
+
+    def restore_task(self, task_id, spec, status):
+        """ Rebuild a task instance (e.g., from a journal), its rules are not installed.
+        Args:
+            spec: (filter, key, attribute, mem_size), the same as register_task.
+            status: True (Active) / False (Idle)
+        Returns:
+            the task object, whose locations should be restored.
+        """
+        task_instance = FlyMonTask(task_id, *spec)
+        self.tasks[task_id] = [status, task_instance]
+        self.TASK_INC = max(self.TASK_INC, task_id)
+        return task_instance
+
+    def reconcile(self, cmug_configs):
+        """ Rebuild the rules of the active tasks and reconcile them with the data plane.
+        Only the missing (or different) rules are written, and the rules of unknown tasks are deleted.
+        Returns:
+            the diff stats (see FlyMonRuntime_BfRt.reconcile_batch), or None if failed.
+        """
+        self.runtime.begin_reconcile()
+        try:
+            installed = set()
+            for status, task_instance in self.tasks.values():
+                if status is True and task_instance.id not in installed:
+                    # Shared rules are installed once.
+                    installed.add(task_instance.id)
+                    self._install_rules(task_instance)
+            return self.runtime.reconcile_batch(cmug_configs)
+        except Exception as e:
+            print(f"Failed! {e} when reconcile rules")
+            print(traceback.format_exc())
+            self.runtime.abort_batch()
+            return None
+
     def uninstall_task(self, task_id):
-        task_instance = self.tasks[task_id][1]
-        for loc in task_instance.locations:
-            self.runtime.initialization_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.init_rules)
-            loc.init_rules = []
-            self.runtime.preprocessing_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.prep_rules)
-            loc.prep_rules = []
-            self.runtime.operation_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.oper_rules)
-            loc.oper_rules = []
-        self.tasks[task_instance.id][0] = False
+        return self.uninstall_tasks([task_id])
+
+    def uninstall_tasks(self, task_ids):
+        """
+        Delete the rules of several tasks in a single batched write request.
+        Returns:
+            True if the tasks are uninstalled.
+            False if the batch fails, and then the tasks stay active and their rules remain in the data plane.
+        """
+        # Rules shared with other active tasks are kept.
+        instances = []
+        for task_id in task_ids:
+            instance = self.tasks[task_id][1]
+            if self.ref_count(task_id) == 0 or any(other is instance for other in instances):
+                continue
+            if not any(status is True and other is instance and other_id not in task_ids
+                           for other_id, (status, other) in self.tasks.items()):
+                instances.append(instance)
+        self.runtime.begin_batch()
+        try:
+            for task_instance in instances:
+                for loc in task_instance.locations:
+                    self.runtime.initialization_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.init_rules)
+                    self.runtime.preprocessing_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.prep_rules)
+                    self.runtime.operation_stage_del(loc.group_id, loc.group_type, loc.cmu_id, loc.oper_rules)
+            self.runtime.commit_batch()
+        except Exception as e:
+            print(f"Failed! {e} when uninstall rules for task {task_ids}")
+            print(traceback.format_exc())
+            self.runtime.abort_batch()
+            return False
+        for task_id in task_ids:
+            self.tasks[task_id][0] = False
+        for task_instance in instances:
+            for loc in task_instance.locations:
+                loc.init_rules = []
+                loc.prep_rules = []
+                loc.oper_rules = []
+        return True
     
     def show_tasks(self):
         """
@@ -144,6 +459,8 @@ class TaskManager:
         else:
             status = "Idle Task"
         print(f"[{status}] \n{str(instance)}")
+        if instance.id != task_id:
+            print(f"Shares the rules and memory of task {instance.id}.")
 
     def query_task(self, task_id, query_key):
         return 0
@@ -0,0 +1,99 @@
+import heapq
+import numpy as np
+from data_collector import DataCollector
+from flymonlib.flymon_task import FlyMonTask
+from flymonlib.flow_attribute import AttributeType
+
+
+# Default number of heavy hitters reported.
+TOPK = 10
+
+class TopKTracker:
+    """
+    Heavy hitters of a frequency task over epochs.
+    Each epoch, a stream of candidate keys (e.g., from the ground truth of a trace) is scored against a snapshot:
+        1. all candidates are hashed at once (the indices are kept while the candidates and the locations are the same).
+        2. the estimates are the min over the rows (Frequency.analyze_keys), and the k heaviest are taken by a partition.
+        3. they are merged into a bounded heap of the k heaviest keys across epochs (the largest estimate of each key).
+    The keys in the heap are scored again in the following epochs, even if they are not in the candidates.
+    """
+    def __init__(self, data_collector:DataCollector, task_instance:FlyMonTask, k=TOPK):
+        self.data_collector = data_collector
+        self.task_instance = task_instance
+        self.k = k
+        self.heavy = {
+            # key : flow key bytes
+            # val : the largest estimate of the key in an epoch
+        }
+        self.labels = {
+            # key : flow key bytes
+            # val : the key string to report
+        }
+        self.cache = None
+        self.epochs = 0
+
+    def update(self, data, flow_keys_bytes, labels=None):
+        """ Score the candidate keys against the data of an epoch.
+        Args:
+            data: the data of the task (e.g., TaskSnapshot.data or read_task).
+            flow_keys_bytes: a list of candidate flow key bytes (see FlyMonTask.generate_key_bytes).
+            labels: the key strings of the candidates to report, None to report the bytes.
+        Returns:
+            the k heaviest candidates of the epoch: a list of (estimate, key bytes), the heaviest first.
+        """
+        if self.task_instance.attribute.type not in [AttributeType.Frequency, AttributeType.FrequencySuMax]:
+            print(f"Task {self.task_instance.id} is not a frequency task.")
+            return []
+        indexes = self._indexes(flow_keys_bytes)
+        estimates = self.task_instance.attribute.analyze_keys([row[idx] for row, idx in zip(data, indexes)])
+        if len(estimates) > self.k:
+            top = np.argpartition(-estimates, self.k - 1)[:self.k]
+        else:
+            top = np.arange(len(estimates))
+        top = top[np.argsort(-estimates[top], kind='stable')]
+        epoch_top = [(int(estimates[idx]), flow_keys_bytes[idx]) for idx in top]
+        if labels is not None:
+            for idx in top:
+                self.labels[flow_keys_bytes[idx]] = labels[idx]
+        # The heavy keys of earlier epochs which are not in the candidates.
+        scored = set(key for _, key in epoch_top)
+        others = [key for key in self.heavy if key not in scored]
+        if len(others) > 0:
+            rows = self.data_collector.key_indexes(self.task_instance, others)
+            other_estimates = self.task_instance.attribute.analyze_keys([row[idx] for row, idx in zip(data, rows)])
+            epoch_top.extend((int(estimate), key) for estimate, key in zip(other_estimates, others))
+        for estimate, key in epoch_top:
+            self.heavy[key] = max(self.heavy.get(key, 0), estimate)
+        self.heavy = dict((key, estimate) for estimate, key in
+                            heapq.nlargest(self.k, ((estimate, key) for key, estimate in self.heavy.items())))
+        for key in list(self.labels.keys()):
+            if key not in self.heavy:
+                self.labels.pop(key)
+        self.epochs += 1
+        return sorted(epoch_top, reverse=True)[:self.k]
+
+    def top(self):
+        """
+        Returns:
+            the k heaviest keys across the epochs: a list of (estimate, key string or bytes), the heaviest first.
+        """
+        return [(estimate, self.labels.get(key, key)) for key, estimate in
+                    sorted(self.heavy.items(), key=lambda item: item[1], reverse=True)]
+
+    def candidates(self):
+        """
+        Returns:
+            the key bytes of the heavy keys, e.g., to be the candidates of the next epoch.
+        """
+        return list(self.heavy.keys())
+
+    def _indexes(self, flow_keys_bytes):
+        """
+        Hash the candidates into the locations, unless they are the same as the last epoch.
+        """
+        layout = [(loc.group_id, loc.cmu_id, loc.memory_type, loc.memory_idx) for loc in self.task_instance.locations]
+        if self.cache is not None and self.cache[0] is flow_keys_bytes and self.cache[1] == layout:
+            return self.cache[2]
+        indexes = self.data_collector.key_indexes(self.task_instance, flow_keys_bytes)
+        self.cache = (flow_keys_bytes, layout, indexes)
+        return indexes